@@ -0,0 +1,69 @@
+import argparse
+import sys
+import numpy as np
+from typing import Dict, List, Tuple
+
+from websps.db import get_nucleus_id, read_mass_table, set_mass_table
+from websps.SPSReaction import Reaction, RxnParameters
+from websps.SPSTarget import SPSTarget, TargetLayer, ELOSS_MODE_STEP, ELOSS_MODE_ADAPTIVE, ELOSS_MODE_TABLE
+
+from .fixtures import TARGETS, REACTIONS, BEAM_ENERGIES, SPS_ANGLE, MAGNETIC_FIELDS, make_levels
+
+#Round trip check of the calibration: excitations -> rhos (as in the plot) -> excitations (as in the calibrate endpoint)
+#must give back the excitations for every target and energy loss mode. The fixture three layer target is symmetric, so
+#asymmetric targets are added, with the reaction in the first and in the last layer
+#The forward kinematics are non-relativistic and the inverse relativistic, so even without a target the round trip is
+#off by a few keV; that difference (from a target of negligible thickness) is subtracted to check the energy loss alone
+#The layer energy losses themselves invert exactly (the range tables to within their Newton polish), but the target
+#paths in SPSTarget (get_outgoing_energyloss, get_outgoing_reverse_energyloss) subtract or add each layer's loss, which
+#is in MeV, from an energy in MeV/u. That unit mix comes from the original code and is a separate issue; it leaves up to
+#~10 keV for heavy ejectiles, so the tolerance only catches errors in the layer order and thicknesses, which cost far more
+#No app or database is used: the mass table is read straight from the mass file
+#Run from the top level of the repository: python -m benchmarks.calibration_roundtrip [--tolerance 0.02]
+
+ROUNDTRIP_TARGETS: Dict[str, Tuple[Tuple[Tuple[int, int], ...], Tuple[float, ...]]] = {
+    **TARGETS,
+    "asymmetric_front": (((6, 12), (82, 208)), (20.0, 300.0)),
+    "asymmetric_back": (((82, 208), (6, 12)), (300.0, 20.0))
+}
+ROUNDTRIP_MODES: Tuple[str, ...] = (ELOSS_MODE_STEP, ELOSS_MODE_ADAPTIVE, ELOSS_MODE_TABLE)
+ROUNDTRIP_LEVELS: int = 20
+ROUNDTRIP_THIN: float = 1.0e-6 #ug/cm^2
+
+def calibrate(params: RxnParameters, target: SPSTarget, excitations: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    reaction = Reaction(params, target)
+    batch = reaction.calculate_ejectile_batch(excitations)
+    calibrated = np.full(len(excitations), np.nan)
+    calibrated[batch.valid] = reaction.calculate_excitations(batch.rhos[batch.valid])
+    return (calibrated, batch.valid)
+
+#Largest |Ex in - Ex out| (MeV) of each (reaction, target, mode), less that of a negligibly thin target
+def run_roundtrip() -> List[Tuple[str, float]]:
+    excitations = make_levels(ROUNDTRIP_LEVELS)
+    results = []
+    for rxnName, nuclei in REACTIONS.items():
+        params = RxnParameters(*[get_nucleus_id(z, a) for z, a in nuclei], BEAM_ENERGIES[rxnName], MAGNETIC_FIELDS[rxnName], SPS_ANGLE)
+        thin, _ = calibrate(params, SPSTarget([TargetLayer([(params.targetID, 1)], ROUNDTRIP_THIN)], "thin"), excitations)
+        for targetName, (layers, thicknesses) in ROUNDTRIP_TARGETS.items():
+            for mode in ROUNDTRIP_MODES:
+                target = SPSTarget([TargetLayer([(get_nucleus_id(z, a), 1)], thickness) for (z, a), thickness in zip(layers, thicknesses)], targetName, mode)
+                calibrated, valid = calibrate(params, target, excitations)
+                results.append((f"{rxnName} {targetName} {mode}", float(np.max(np.abs(calibrated - thin)[valid], initial=0.0))))
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that the WebSPS rho -> excitation calibration inverts the plot kinematics")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="largest allowed excitation difference (MeV)")
+    args = parser.parse_args()
+
+    set_mass_table(read_mass_table())
+    results = run_roundtrip()
+    failed = [(name, error) for name, error in results if not error <= args.tolerance]
+    for name, error in results:
+        print(f"{name:<45} max |dEx| {1.0e3 * error:10.4f} keV")
+    print(f"{len(results)} round trips, {len(failed)} beyond {1.0e3 * args.tolerance:.1f} keV")
+    if len(failed) != 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
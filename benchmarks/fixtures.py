@@ -0,0 +1,90 @@
+import numpy as np
+from itertools import product
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional, Tuple
+from flask import Flask
+from sqlalchemy import select
+
+from websps import create_app
+from websps.db import db, init_db, get_mass_table, get_nucleus_id, make_target_layers, User, TargetMaterial, ReactionData, Level
+
+BENCH_USERNAME: str = "benchmark"
+
+#Targets as (name, [(z, a) per layer], [thickness per layer] ug/cm^2). The reaction target nucleus must be in one of the layers
+TARGETS: Dict[str, Tuple[Tuple[Tuple[int, int], ...], Tuple[float, ...]]] = {
+    "single_layer": (((6, 12),), (50.0,)),
+    "three_layer": (((6, 12), (82, 208), (6, 12)), (20.0, 300.0, 20.0))
+}
+
+#Reactions as (target, projectile, ejectile, residual) (z, a) pairs
+REACTIONS: Dict[str, Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int], Tuple[int, int]]] = {
+    "light_ejectile": ((6, 12), (1, 2), (1, 1), (6, 13)), #12C(d,p)13C
+    "heavy_ejectile": ((6, 12), (8, 16), (6, 12), (8, 16)) #12C(16O,12C)16O
+}
+
+LEVEL_COUNTS: Tuple[int, ...] = (10, 100, 1000)
+LEVEL_EX_MAX: float = 8.0 #MeV
+
+BEAM_ENERGIES: Dict[str, float] = {"light_ejectile": 16.0, "heavy_ejectile": 60.0} #MeV
+SPS_ANGLE: float = 20.0 #deg
+MAGNETIC_FIELDS: Dict[str, float] = {"light_ejectile": 8.0, "heavy_ejectile": 12.0} #kG
+
+def make_levels(count: int) -> np.ndarray:
+    return np.linspace(0.0, LEVEL_EX_MAX, count)
+
+#Flask app with an in-memory SQLite database, the nucleus table and the mass table loaded
+def make_app(config: Optional[Mapping[str, Any]] = None) -> Flask:
+    test_config = {
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite+pysqlite:///:memory:",
+        "WTF_CSRF_ENABLED": False,
+        "NNDC_FETCH_ASYNC": False,
+        "PROCESS_POOL_SIZE": 0
+    }
+    if config is not None:
+        test_config.update(config)
+    app = create_app(test_config)
+    with app.app_context():
+        init_db()
+        get_mass_table()
+    return app
+
+#Add a user owning one TargetMaterial per target and one ReactionData per (reaction, target), each with nLevels levels
+#The levels are user levels, as NNDC levels are shared by every reaction with the same residual nucleus
+#copies repeats the whole set of targets and reactions. Must be called inside an app context. Returns the user id
+def add_fixture_user(nLevels: int, username: str = BENCH_USERNAME, copies: int = 1) -> int:
+    user = User(username=username, password="", date_created=datetime.now(), date_last_login=datetime.now())
+    db.session.add(user)
+    db.session.flush()
+    levels = make_levels(nLevels).tolist()
+    for _, (targetName, (layers, thicknesses)) in product(range(copies), TARGETS.items()):
+        material = TargetMaterial(
+            user_id=user.id,
+            mat_name=targetName,
+            layers=make_target_layers([f"{a}({z})" for z, a in layers], [[(get_nucleus_id(z, a), 1)] for z, a in layers], list(thicknesses))
+        )
+        db.session.add(material)
+        db.session.flush()
+        for rxnName, nuclei in REACTIONS.items():
+            ids = [get_nucleus_id(z, a) for z, a in nuclei]
+            rxn = ReactionData(
+                user_id=user.id,
+                target_mat_id=material.id,
+                rxn_symbol=f"{rxnName}/{targetName}",
+                latex_rxn_symbol=f"{rxnName}/{targetName}".replace("_", " "),
+                target_nuc_id=ids[0],
+                projectile_nuc_id=ids[1],
+                ejectile_nuc_id=ids[2],
+                residual_nuc_id=ids[3]
+            )
+            db.session.add(rxn)
+            db.session.flush()
+            db.session.add_all([Level(user_id=user.id, reaction_id=rxn.id, excitation=ex) for ex in levels])
+    db.session.commit()
+    return user.id
+
+#Add one user level (at LEVEL_EX_MAX/2) to the first reaction of a user, as the add level page does
+def add_fixture_level(userId: int) -> None:
+    rxn = db.session.execute(select(ReactionData).where(ReactionData.user_id == userId).order_by(ReactionData.id)).scalars().first()
+    db.session.add(Level(user_id=userId, reaction_id=rxn.id, excitation=0.5 * LEVEL_EX_MAX))
+    db.session.commit()
@@ -0,0 +1,92 @@
+import json
+import platform
+import subprocess
+import time
+import numpy as np
+import pycatima
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+REPO_DIR: Path = Path(__file__).resolve().parent.parent
+
+#Counts calls to pycatima.dedx. The websps physics modules look catima.dedx up at call time, so patching the module
+#attribute is enough to see every call
+class CatimaCounter:
+    def __init__(self):
+        self.calls = 0
+
+@contextmanager
+def count_catima_calls() -> Iterator[CatimaCounter]:
+    counter = CatimaCounter()
+    dedx = pycatima.dedx
+    def counted_dedx(*args, **kwargs):
+        counter.calls += 1
+        return dedx(*args, **kwargs)
+    pycatima.dedx = counted_dedx
+    try:
+        yield counter
+    finally:
+        pycatima.dedx = dedx
+
+#Time fn over repeat runs (after setup, which is not timed) and count its catima calls
+def run_stage(name: str, fn: Callable[[], Any], repeat: int = 5, setup: Optional[Callable[[], Any]] = None, **params: Any) -> Dict[str, Any]:
+    times = []
+    calls = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with count_catima_calls() as counter:
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        calls.append(counter.calls)
+    return {
+        "name": name,
+        "params": params,
+        "repeat": repeat,
+        "best": min(times),
+        "mean": float(np.mean(times)),
+        "std": float(np.std(times)),
+        "catima_calls": int(np.median(calls))
+    }
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_environment() -> Dict[str, Any]:
+    return {
+        "date": datetime.now().isoformat(),
+        "revision": get_git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pycatima": getattr(pycatima, "__version__", "unknown")
+    }
+
+def get_stage_key(stage: Dict[str, Any]) -> str:
+    return stage["name"] + json.dumps(stage["params"], sort_keys=True)
+
+def save_results(path: Path, stages: List[Dict[str, Any]]) -> None:
+    with open(path, "w") as output:
+        json.dump({"environment": get_environment(), "stages": stages}, output, indent=2)
+
+def print_results(stages: List[Dict[str, Any]]) -> None:
+    for stage in stages:
+        params = " ".join(f"{key}={value}" for key, value in stage["params"].items())
+        print(f"{stage['name']:<40} {params:<60} best {stage['best']*1.0e3:10.3f} ms  mean {stage['mean']*1.0e3:10.3f} ms  catima {stage['catima_calls']:>9}")
+
+#Print the ratio of the best times to a previous results file; stages missing from either side are skipped
+def print_comparison(baselinePath: Path, stages: List[Dict[str, Any]]) -> None:
+    with open(baselinePath, "r") as baselineFile:
+        baseline = {get_stage_key(stage): stage for stage in json.load(baselineFile)["stages"]}
+    for stage in stages:
+        old = baseline.get(get_stage_key(stage))
+        if old is None:
+            continue
+        params = " ".join(f"{key}={value}" for key, value in stage["params"].items())
+        print(f"{stage['name']:<40} {params:<60} {stage['best'] / old['best']:8.3f}x  catima {old['catima_calls']} -> {stage['catima_calls']}")
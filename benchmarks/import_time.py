@@ -0,0 +1,62 @@
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .fixtures import make_app, add_fixture_user
+from .harness import REPO_DIR
+
+#Startup cost of a fresh worker process: importing websps, create_app (with and without WARMUP), and the first plot
+#request, each measured in a new interpreter started with -c (importing this package already imports websps). Also
+#lists which heavy dependencies are loaded after the import
+#Run from the top level of the repository: python -m benchmarks.import_time [--repeat 5]
+
+HEAVY_MODULES: List[str] = ["matplotlib", "pycatima", "lxml", "requests"]
+PLOT_FORM: Dict[str, str] = {"beam_energy": "16", "sps_angle": "20", "b_field": "8", "rho_min": "50", "rho_max": "90", "buttons": "E"}
+
+#Run in the fresh interpreter, formatted with the database uri, WARMUP, the heavy modules and the plot form
+CHILD_SCRIPT: str = """
+import json, sys, time
+start = time.perf_counter()
+import websps
+imported = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+app = websps.create_app({{"TESTING": True, "WTF_CSRF_ENABLED": False, "SQLALCHEMY_DATABASE_URI": {uri!r}, "WARMUP": {warmup!r}, "PROCESS_POOL_SIZE": 0, "NNDC_FETCH_ASYNC": False}})
+created = time.perf_counter()
+client = app.test_client()
+with client.session_transaction() as session:
+    session["user_id"] = {userID!r}
+response = client.post("/spsplot/", data={form!r})
+plotted = time.perf_counter()
+if response.status_code != 200:
+    raise RuntimeError(f"Plot request failed with {{response.status_code}}")
+print(json.dumps({{"import": imported - start, "create_app": created - imported, "first_plot": plotted - created, "total": plotted - start, "heavy_modules": heavy}}))
+"""
+
+def run_child(uri: str, userID: int, warmup: bool) -> Dict[str, Any]:
+    script = CHILD_SCRIPT.format(heavy=HEAVY_MODULES, uri=uri, warmup=warmup, userID=userID, form=PLOT_FORM)
+    output = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure WebSPS worker startup: import, create_app and first plot")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per configuration")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        uri = f"sqlite+pysqlite:///{Path(directory) / 'websps.sqlite'}"
+        app = make_app({"SQLALCHEMY_DATABASE_URI": uri})
+        with app.app_context():
+            userID = add_fixture_user(10)
+        print(f"{'warmup':<8} {'import ms':>10} {'create_app ms':>14} {'first plot ms':>14} {'total ms':>10}  heavy modules after import")
+        for warmup in (False, True):
+            runs = [run_child(uri, userID, warmup) for _ in range(args.repeat)]
+            median = {key: float(np.median([run[key] for run in runs])) * 1000.0 for key in ("import", "create_app", "first_plot", "total")}
+            print(f"{str(warmup):<8} {median['import']:>10.0f} {median['create_app']:>14.0f} {median['first_plot']:>14.0f} {median['total']:>10.0f}  {', '.join(runs[0]['heavy_modules']) or 'none'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import sys
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import Flask
+from flask.testing import FlaskClient
+
+from websps.jobs import shutdown_scheduler
+from websps.spsplot import get_plot_cache
+
+from .fixtures import make_app, add_fixture_user, BEAM_ENERGIES, SPS_ANGLE, MAGNETIC_FIELDS
+
+#Responsiveness of fast requests while heavy plots run, with the plots computed inside their requests (as the plot page
+#does) or submitted as background jobs. Requests are handled by a fixed pool of threads, like the threads of a mod_wsgi
+#daemon process: inline plots hold a request thread until they are done, so fast requests queue behind them, while job
+#submissions return at once. Latency is measured from when a request is queued to the server until it is answered
+#Each heavy plot belongs to its own user, so the per-user job limits do not serialize them
+#Exits with status 1 if job submission is not fast or fast requests are not more responsive with jobs than inline
+#Run from the top level of the repository: python -m benchmarks.job_responsiveness [--heavy 4] [--levels 200] [--threads 4]
+
+FAST_URL: str = "/spsplot/jobs"
+FAST_INTERVAL: float = 0.05 #s between fast requests
+HEAVY_START_DELAY: float = 0.2 #s from the heavy requests to the first fast request
+SUBMIT_MAX_SECONDS: float = 0.5
+POLL_INTERVAL: float = 0.1 #s
+
+def get_plot_args() -> Dict[str, Any]:
+    return {
+        "beam_energy": BEAM_ENERGIES["light_ejectile"],
+        "sps_angle": SPS_ANGLE,
+        "b_field": MAGNETIC_FIELDS["light_ejectile"],
+        "rho_min": 0.0,
+        "rho_max": 100.0,
+        "buttons": "E",
+        "plot_type": "E"
+    }
+
+def make_client(app: Flask, userId: int) -> FlaskClient:
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = userId
+    return client
+
+def request(app: Flask, userId: int, method: str, url: str, data: Optional[Dict[str, Any]] = None) -> Tuple[int, Any]:
+    response = make_client(app, userId).open(url, method=method, data=data)
+    return (response.status_code, response.get_json(silent=True))
+
+#Latency of each request from when it was queued to the server (the thread pool) until it was answered
+def timed_request(server: ThreadPoolExecutor, app: Flask, userId: int, method: str, url: str, data: Optional[Dict[str, Any]] = None) -> "Future[Tuple[float, int, Any]]":
+    queued = time.perf_counter()
+    def run() -> Tuple[float, int, Any]:
+        status, body = request(app, userId, method, url, data)
+        return (time.perf_counter() - queued, status, body)
+    return server.submit(run)
+
+def wait_for_jobs(app: Flask, jobs: List[Tuple[int, Dict[str, Any]]]) -> None:
+    for userId, job in jobs:
+        while True:
+            _, status = request(app, userId, "GET", job["status_url"])
+            if status["status"] not in ("queued", "running"):
+                if status["status"] != "done":
+                    raise RuntimeError(f"Job {job['id']} {status['status']}: {status['error']}")
+                break
+            time.sleep(POLL_INTERVAL)
+
+#Returns the fast request latencies, the heavy request latencies (submission only for jobs) and the total time until
+#every heavy plot was done
+def run_scenario(app: Flask, mode: str, heavyUsers: List[int], fastUser: int, threads: int, nFast: int) -> Dict[str, Any]:
+    with app.app_context():
+        get_plot_cache().clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as server:
+        heavy = []
+        if mode == "inline":
+            heavy = [timed_request(server, app, userId, "POST", "/spsplot/", get_plot_args()) for userId in heavyUsers]
+        elif mode == "jobs":
+            heavy = [timed_request(server, app, userId, "POST", "/spsplot/jobs/plot", get_plot_args()) for userId in heavyUsers]
+        time.sleep(HEAVY_START_DELAY if len(heavy) != 0 else 0.0)
+        fast = []
+        for _ in range(nFast):
+            fast.append(timed_request(server, app, fastUser, "GET", FAST_URL))
+            time.sleep(FAST_INTERVAL)
+        fastLatencies = [future.result()[0] for future in fast]
+        heavyResults = [future.result() for future in heavy]
+    for _, status, _ in heavyResults:
+        if status not in (200, 202):
+            raise RuntimeError(f"Heavy {mode} request failed with status {status}")
+    if mode == "jobs":
+        wait_for_jobs(app, [(userId, body) for userId, (_, _, body) in zip(heavyUsers, heavyResults)])
+    return {"fast": np.array(fastLatencies), "heavy": np.array([result[0] for result in heavyResults]), "total": time.perf_counter() - start}
+
+def print_latencies(name: str, latencies: np.ndarray) -> None:
+    if len(latencies) == 0:
+        return
+    print(f"    {name:<28} median {1.0e3 * np.median(latencies):9.1f} ms  p95 {1.0e3 * np.percentile(latencies, 95):9.1f} ms  max {1.0e3 * latencies.max():9.1f} ms")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure fast request latency while heavy plots run inline or as background jobs")
+    parser.add_argument("--heavy", type=int, default=4, help="number of heavy plots, one per user")
+    parser.add_argument("--levels", type=int, default=200, help="levels per reaction of the heavy plots")
+    parser.add_argument("--threads", type=int, default=4, help="request threads of the simulated server")
+    parser.add_argument("--fast", type=int, default=40, help="number of fast requests")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        #Jobs run on their own threads, so the database must be a file shared by every connection
+        app = make_app({"SQLALCHEMY_DATABASE_URI": f"sqlite+pysqlite:///{Path(directory) / 'bench.sqlite'}", "JOB_WORKERS": 2})
+        with app.app_context():
+            heavyUsers = [add_fixture_user(args.levels, username=f"heavy{i}") for i in range(args.heavy)]
+            fastUser = add_fixture_user(1, username="fast")
+        #Load matplotlib and warm the caches before timing anything
+        request(app, fastUser, "POST", "/spsplot/", get_plot_args())
+
+        results = {mode: run_scenario(app, mode, heavyUsers, fastUser, args.threads, args.fast) for mode in ("idle", "inline", "jobs")}
+        shutdown_scheduler()
+
+    print(f"{args.heavy} heavy plots ({args.levels} levels per reaction), {args.fast} fast requests to {FAST_URL}, {args.threads} request threads")
+    for mode, result in results.items():
+        print(f"  {mode}: every request done in {result['total']:.2f} s")
+        print_latencies("fast requests", result["fast"])
+        print_latencies("heavy plot requests" if mode == "inline" else "heavy job submissions", result["heavy"])
+
+    failed = False
+    if results["jobs"]["heavy"].max() > SUBMIT_MAX_SECONDS:
+        print(f"Job submission took {results['jobs']['heavy'].max():.2f} s, more than {SUBMIT_MAX_SECONDS} s")
+        failed = True
+    if np.percentile(results["jobs"]["fast"], 95) >= np.percentile(results["inline"]["fast"], 95):
+        print("Fast requests were not more responsive with background jobs than with inline plots")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import sys
+from typing import Callable, Dict, List, Tuple
+from flask.testing import FlaskClient
+
+from websps.db import db, select, User
+from websps.queries import count_statements
+
+from .fixtures import make_app, add_fixture_user
+
+#Checks that the spsplot and admin views run the same number of SQL statements however much data a user has
+#Run from the top level of the repository: python -m benchmarks.query_counts
+
+PLOT_FORM: Dict[str, str] = {"beam_energy": "16", "sps_angle": "20", "b_field": "8", "rho_min": "50", "rho_max": "90", "buttons": "E"}
+
+def get_views(client: FlaskClient, userId: int) -> List[Tuple[str, Callable]]:
+    return [
+        ("spsplot.index", lambda: client.get("/spsplot/")),
+        ("spsplot.index (plot)", lambda: client.post("/spsplot/", data=PLOT_FORM)),
+        ("spsplot.plot_data", lambda: client.get("/spsplot/data", query_string={"beam_energy": 15.0, "sps_angle": 20.0, "b_field": 8.0})),
+        ("spsplot.add_rxn", lambda: client.get("/spsplot/rxn/add")),
+        ("spsplot.add_level", lambda: client.get("/spsplot/level/add")),
+        ("admin.inspect_user", lambda: client.get(f"/admin/user/{userId}/inspect"))
+    ]
+
+#Statement count of each view for a user with copies x (targets, reactions) and nLevels levels per reaction
+def measure(copies: int, nLevels: int) -> Dict[str, int]:
+    app = make_app()
+    client = app.test_client()
+    with app.app_context():
+        userId = add_fixture_user(nLevels, copies=copies)
+        adminId = db.session.execute(select(User.id).where(User.username == app.config["ADMIN_USERNAME"])).scalar()
+    counts = {}
+    for name, view in get_views(client, userId):
+        with client.session_transaction() as session:
+            session["user_id"] = adminId if name.startswith("admin") else userId
+        with app.app_context():
+            with count_statements() as counter:
+                response = view()
+        if response.status_code != 200:
+            raise RuntimeError(f"{name} returned {response.status_code}")
+        counts[name] = counter.count
+    return counts
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that WebSPS views run a constant number of SQL statements")
+    parser.add_argument("--copies", type=int, nargs=2, default=[1, 10], help="small and large number of target/reaction sets")
+    parser.add_argument("--levels", type=int, nargs=2, default=[1, 20], help="small and large number of levels per reaction")
+    args = parser.parse_args()
+
+    small = measure(args.copies[0], args.levels[0])
+    large = measure(args.copies[1], args.levels[1])
+    failed = False
+    for name in small:
+        status = "ok" if small[name] == large[name] else "GROWS"
+        failed = failed or small[name] != large[name]
+        print(f"{name:<25} {small[name]:>4} {large[name]:>4}  {status}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
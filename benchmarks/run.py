@@ -0,0 +1,195 @@
+import argparse
+import pycatima as catima
+import numpy as np
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+from flask import g
+
+from websps.db import db, get_nucleus_id, User
+from websps.EnergyLossTable import clear_range_tables
+from websps.NucleusData import get_nuclear_data
+from websps.SPSReaction import Reaction, RxnParameters
+from websps.SPSResolution import ResolutionParameters, estimate_resolution
+from websps.SPSOverlap import find_overlaps
+from websps.SPSTarget import SPSTarget, TargetLayer, ELOSS_MODE_STEP, ELOSS_MODE_ADAPTIVE, ELOSS_MODE_TABLE, get_energyloss, get_reverse_energyloss, get_energyloss_rk45, get_reverse_energyloss_rk45
+from websps import spsplot
+from websps.workers import shutdown_process_pool
+
+from .fixtures import TARGETS, REACTIONS, LEVEL_COUNTS, BEAM_ENERGIES, SPS_ANGLE, MAGNETIC_FIELDS, BENCH_USERNAME, make_app, make_levels, add_fixture_user, add_fixture_level
+from .harness import run_stage, save_results, print_results, print_comparison
+
+#Benchmarks of the kinematics, energy loss and plotting hot paths
+#Run from the top level of the repository: python -m benchmarks.run --output results.json [--compare baseline.json]
+
+ELOSS_MODES: Tuple[str, ...] = (ELOSS_MODE_STEP, ELOSS_MODE_ADAPTIVE, ELOSS_MODE_TABLE)
+
+def make_target(targetName: str, mode: str) -> SPSTarget:
+    layers, thicknesses = TARGETS[targetName]
+    return SPSTarget([TargetLayer([[get_nucleus_id(z, a), 1]], thickness) for (z, a), thickness in zip(layers, thicknesses)], targetName, mode)
+
+def make_reaction(rxnName: str, target: SPSTarget) -> Reaction:
+    ids = [get_nucleus_id(z, a) for z, a in REACTIONS[rxnName]]
+    return Reaction(RxnParameters(ids[0], ids[1], ids[2], ids[3], BEAM_ENERGIES[rxnName], MAGNETIC_FIELDS[rxnName], SPS_ANGLE), target)
+
+#Largest relative difference between two integrators over the layers
+def get_integrator_difference(reference: Callable, other: Callable, ejectile: Any, energy: float, materials: List[catima.Material]) -> float:
+    difference = 0.0
+    for material in materials:
+        expected = reference(catima.Projectile(ejectile.mass, ejectile.Z, T=energy), material)
+        value = other(catima.Projectile(ejectile.mass, ejectile.Z, T=energy), material)
+        if expected != 0.0:
+            difference = max(difference, abs(value - expected) / abs(expected))
+    return float(f"{difference:.2e}")
+
+#Module level integrators, step and adaptive, for the ejectile running through each full layer of the target
+#The adaptive stages also record their relative difference from the step integrators, as a cross-check
+def bench_integrators(repeat: int) -> List[Dict[str, Any]]:
+    stages = []
+    for rxnName in REACTIONS:
+        for targetName in TARGETS:
+            target = make_target(targetName, ELOSS_MODE_STEP)
+            ejectile = get_nuclear_data(get_nucleus_id(*REACTIONS[rxnName][2]))
+            energy = BEAM_ENERGIES[rxnName] / ejectile.A #MeV/u
+            materials = [target.get_layer_material(idx) for idx in range(len(target.layer_details))]
+            for material, layer in zip(materials, target.layer_details):
+                material.thickness(layer.thickness * SPSTarget.UG2G)
+            for forward, reverse in ((get_energyloss, get_reverse_energyloss), (get_energyloss_rk45, get_reverse_energyloss_rk45)):
+                params = {"reaction": rxnName, "target": targetName}
+                if forward is get_energyloss_rk45:
+                    params["difference"] = max(get_integrator_difference(get_energyloss, forward, ejectile, energy, materials), get_integrator_difference(get_reverse_energyloss, reverse, ejectile, energy, materials))
+                stages.append(run_stage(forward.__name__, lambda: [forward(catima.Projectile(ejectile.mass, ejectile.Z, T=energy), material) for material in materials], repeat, **params))
+                stages.append(run_stage(reverse.__name__, lambda: [reverse(catima.Projectile(ejectile.mass, ejectile.Z, T=energy), material) for material in materials], repeat, **params))
+    return stages
+
+def bench_target(repeat: int) -> List[Dict[str, Any]]:
+    stages = []
+    for rxnName in REACTIONS:
+        for targetName in TARGETS:
+            for mode in ELOSS_MODES:
+                target = make_target(targetName, mode)
+                reaction = make_reaction(rxnName, target)
+                beam = reaction.projectileNuc
+                ejectile = reaction.ejectileNuc
+                energy = BEAM_ENERGIES[rxnName]
+                params = {"reaction": rxnName, "target": targetName, "mode": mode}
+                if mode == ELOSS_MODE_TABLE:
+                    def build_tables():
+                        target.get_incoming_energyloss(beam.Z, beam.mass, energy, reaction.rxnLayer, 0.0)
+                        target.get_outgoing_energyloss(ejectile.Z, ejectile.mass, energy, reaction.rxnLayer, reaction.spsAngle)
+                        target.get_outgoing_reverse_energyloss(ejectile.Z, ejectile.mass, energy, reaction.rxnLayer, reaction.spsAngle)
+                    stages.append(run_stage("EnergyLossTable.build", build_tables, repeat, setup=clear_range_tables, **params))
+                stages.append(run_stage("SPSTarget.get_incoming_energyloss", lambda: target.get_incoming_energyloss(beam.Z, beam.mass, energy, reaction.rxnLayer, 0.0), repeat, **params))
+                stages.append(run_stage("SPSTarget.get_outgoing_energyloss", lambda: target.get_outgoing_energyloss(ejectile.Z, ejectile.mass, energy, reaction.rxnLayer, reaction.spsAngle), repeat, **params))
+                stages.append(run_stage("SPSTarget.get_outgoing_reverse_energyloss", lambda: target.get_outgoing_reverse_energyloss(ejectile.Z, ejectile.mass, energy, reaction.rxnLayer, reaction.spsAngle), repeat, **params))
+    return stages
+
+def bench_kinematics(repeat: int, levelCounts: Tuple[int, ...]) -> List[Dict[str, Any]]:
+    stages = []
+    for rxnName in REACTIONS:
+        for targetName in TARGETS:
+            for mode in ELOSS_MODES:
+                reaction = make_reaction(rxnName, make_target(targetName, mode))
+                for nLevels in levelCounts:
+                    levels = make_levels(nLevels)
+                    params = {"reaction": rxnName, "target": targetName, "mode": mode, "levels": nLevels}
+                    stages.append(run_stage("Reaction.calculate_ejectile_KE", lambda: [reaction.calculate_ejectile_KE(ex) for ex in levels], repeat, setup=reaction.invalidate_rxn_point_state, **params))
+                    stages.append(run_stage("Reaction.calculate_ejectile_batch", lambda: reaction.calculate_ejectile_batch(levels), repeat, setup=reaction.invalidate_rxn_point_state, **params))
+    return stages
+
+#Monte Carlo peak widths, RESOLUTION_BENCH_EVENTS events per level, with and without the width of each source alone
+RESOLUTION_BENCH_EVENTS: int = 100_000
+RESOLUTION_BENCH_LEVELS: int = 10
+
+def bench_resolution(repeat: int) -> List[Dict[str, Any]]:
+    stages = []
+    levels = make_levels(RESOLUTION_BENCH_LEVELS)
+    for rxnName in REACTIONS:
+        for targetName in TARGETS:
+            reaction = make_reaction(rxnName, make_target(targetName, ELOSS_MODE_TABLE))
+            reaction.calculate_ejectile_batch(levels) #build the range tables
+            for contributions in (False, True):
+                params = ResolutionParameters(events=RESOLUTION_BENCH_EVENTS, contributions=contributions, seed=0)
+                stages.append(run_stage("SPSResolution.estimate_resolution", lambda: estimate_resolution(reaction, levels, params), repeat,
+                                        reaction=rxnName, target=targetName, levels=RESOLUTION_BENCH_LEVELS, events=RESOLUTION_BENCH_EVENTS, contributions=contributions))
+    return stages
+
+#Overlap sweep over random focal plane points of OVERLAP_BENCH_REACTIONS reactions, with a fixed window and with widths
+OVERLAP_BENCH_POINTS: Tuple[int, ...] = (10_000, 100_000)
+OVERLAP_BENCH_REACTIONS: int = 10
+OVERLAP_BENCH_WINDOW: float = 0.01 #cm
+
+def bench_overlaps(repeat: int) -> List[Dict[str, Any]]:
+    stages = []
+    rng = np.random.default_rng(0)
+    for nPoints in OVERLAP_BENCH_POINTS:
+        rxns = rng.integers(1, OVERLAP_BENCH_REACTIONS + 1, nPoints)
+        rhos = rng.uniform(50.0, 90.0, nPoints)
+        widths = rng.uniform(0.0, 2.0 * OVERLAP_BENCH_WINDOW, nPoints)
+        stages.append(run_stage("SPSOverlap.find_overlaps", lambda: find_overlaps(rxns, rhos, OVERLAP_BENCH_WINDOW), repeat, points=nPoints, widths=False))
+        stages.append(run_stage("SPSOverlap.find_overlaps", lambda: find_overlaps(rxns, rhos, OVERLAP_BENCH_WINDOW, widths), repeat, points=nPoints, widths=True))
+    return stages
+
+#End to end plot of every fixture reaction, cold (computed) and warm (served from the plot cache), and the plot data
+#when nothing is cached and after adding one level (only that level is computed)
+#With poolSize > 0 the plot data are also computed on the process pool, in chunks of chunkSize levels
+def bench_plot(repeat: int, levelCounts: Tuple[int, ...], poolSize: int = 0, chunkSize: int = 1000) -> List[Dict[str, Any]]:
+    stages = []
+    app = make_app({"PROCESS_POOL_SIZE": poolSize})
+    with app.app_context():
+        userIds = {nLevels: add_fixture_user(nLevels, f"{BENCH_USERNAME}{nLevels}") for nLevels in levelCounts}
+        for nLevels, userId in userIds.items():
+            with app.test_request_context():
+                g.user = db.session.get(User, userId)
+                plot = lambda: spsplot.generate_plot(16.0, SPS_ANGLE, 8.0, 50.0, 90.0, spsplot.PLOT_EX)
+                stages.append(run_stage("spsplot.generate_plot", plot, repeat, setup=spsplot.get_plot_cache().clear, cache="cold", levels=nLevels))
+                stages.append(run_stage("spsplot.generate_plot", plot, repeat, cache="warm", levels=nLevels))
+                #the reactions are loaded in the (untimed) setup, after the change, so these stages time only the plot data
+                state: Dict[str, Any] = {}
+                def prepare(change: Callable[[], None]) -> Callable[[], None]:
+                    def setup() -> None:
+                        change()
+                        state["reactions"] = spsplot.get_user_reactions()
+                    return setup
+                data = lambda: spsplot.get_plot_data(state["reactions"], 16.0, SPS_ANGLE, 8.0)
+                stages.append(run_stage("spsplot.get_plot_data", data, repeat, setup=prepare(spsplot.get_plot_cache().clear), cache="cold", levels=nLevels))
+                stages.append(run_stage("spsplot.get_plot_data", data, repeat, setup=prepare(lambda: add_fixture_level(g.user.id)), cache="add_level", levels=nLevels))
+                if poolSize > 0:
+                    serialConfig = {name: app.config[name] for name in ("PLOT_PARALLEL_MIN_LEVELS", "PLOT_PARALLEL_CHUNK_SIZE")}
+                    app.config.update(PLOT_PARALLEL_MIN_LEVELS=0, PLOT_PARALLEL_CHUNK_SIZE=chunkSize)
+                    prepare(spsplot.get_plot_cache().clear)()
+                    data() #start the workers and build their range tables
+                    stages.append(run_stage("spsplot.get_plot_data", data, repeat, setup=prepare(spsplot.get_plot_cache().clear), cache="cold", levels=nLevels, pool=poolSize, chunk=chunkSize))
+                    app.config.update(serialConfig)
+        shutdown_process_pool()
+    return stages
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the WebSPS kinematics, energy loss and plotting")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs per stage")
+    parser.add_argument("--levels", type=int, nargs="+", default=list(LEVEL_COUNTS), help="level counts to benchmark")
+    parser.add_argument("--pool", type=int, default=0, help="also compute the plot data on a process pool of this size")
+    parser.add_argument("--chunk", type=int, default=1000, help="levels per work unit when using the process pool")
+    parser.add_argument("--skip-plot", action="store_true", help="skip the (slow) end to end plot stages")
+    parser.add_argument("--output", type=Path, default=None, help="save the results to this JSON file")
+    parser.add_argument("--compare", type=Path, default=None, help="compare against a previously saved JSON file")
+    args = parser.parse_args()
+
+    levelCounts = tuple(args.levels)
+    app = make_app()
+    with app.app_context():
+        stages = bench_integrators(args.repeat)
+        stages += bench_target(args.repeat)
+        stages += bench_kinematics(args.repeat, levelCounts)
+        stages += bench_resolution(args.repeat)
+    stages += bench_overlaps(args.repeat)
+    if not args.skip_plot:
+        stages += bench_plot(args.repeat, levelCounts, args.pool, args.chunk)
+
+    print_results(stages)
+    if args.output is not None:
+        save_results(args.output, stages)
+    if args.compare is not None:
+        print_comparison(args.compare, stages)
+
+if __name__ == "__main__":
+    main()
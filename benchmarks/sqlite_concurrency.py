@@ -0,0 +1,115 @@
+import argparse
+import multiprocessing
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from websps import create_app, queries
+from websps.db import db, Level
+
+from .fixtures import make_app, add_fixture_user
+
+#Read throughput of the plot view queries while writers keep adding levels (as add_level does), for each SQLite profile
+#Readers and writers are separate processes sharing one database file, like mod_wsgi daemon processes. The writers run at
+#a fixed rate so that every profile does the same amount of writing
+#Run from the top level of the repository: python -m benchmarks.sqlite_concurrency [--duration 5] [--readers 4] [--writers 2]
+
+PROFILES: List[str] = ["default", "production"]
+
+def get_config(uri: str, profile: str) -> Dict[str, Any]:
+    return {"TESTING": True, "SQLALCHEMY_DATABASE_URI": uri, "SQLITE_PROFILE": profile, "NNDC_FETCH_ASYNC": False, "PROCESS_POOL_SIZE": 0}
+
+def reader(uri: str, profile: str, userId: int, start: float, stop: float, results: multiprocessing.Queue) -> None:
+    app = create_app(get_config(uri, profile))
+    latencies = []
+    errors = 0
+    with app.app_context():
+        while time.time() < start:
+            time.sleep(0.001)
+        while time.time() < stop:
+            begin = time.perf_counter()
+            try:
+                sum(len(rxn.user_levels) for rxn in queries.get_user_reactions(userId))
+            except Exception:
+                errors += 1
+            db.session.rollback()
+            latencies.append(time.perf_counter() - begin)
+    results.put(("read", latencies, errors))
+
+def writer(uri: str, profile: str, userId: int, reactionIds: List[int], batch: int, rate: float, seed: int, start: float, stop: float, results: multiprocessing.Queue) -> None:
+    app = create_app(get_config(uri, profile))
+    rng = np.random.default_rng(seed)
+    writes = 0
+    errors = 0
+    with app.app_context():
+        while time.time() < start:
+            time.sleep(0.001)
+        nextWrite = start
+        while time.time() < stop:
+            time.sleep(max(0.0, nextWrite - time.time()))
+            nextWrite += 1.0 / rate
+            try:
+                for _ in range(batch):
+                    db.session.add(Level(user_id=userId, reaction_id=int(rng.choice(reactionIds)), excitation=float(rng.uniform(0.0, 8.0))))
+                    db.session.flush()
+                db.session.commit()
+                writes += batch
+            except Exception:
+                db.session.rollback()
+                errors += 1
+    results.put(("write", writes, errors))
+
+def run_profile(profile: str, duration: float, nReaders: int, nWriters: int, nLevels: int, batch: int, rate: float) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        uri = f"sqlite+pysqlite:///{Path(directory) / 'websps.sqlite'}"
+        app = make_app(get_config(uri, profile))
+        with app.app_context():
+            userId = add_fixture_user(nLevels)
+            reactionIds = [rxn.id for rxn in queries.get_user_reactions(userId)]
+            journalMode = db.session.execute(db.text("PRAGMA journal_mode")).scalar()
+            db.session.remove()
+            db.engine.dispose()
+
+        results: multiprocessing.Queue = multiprocessing.Queue()
+        start = time.time() + 2.0 #let every process finish importing and connecting
+        stop = start + duration
+        processes = [multiprocessing.Process(target=reader, args=(uri, profile, userId, start, stop, results)) for _ in range(nReaders)]
+        processes += [multiprocessing.Process(target=writer, args=(uri, profile, userId, reactionIds, batch, rate, idx, start, stop, results)) for idx in range(nWriters)]
+        for process in processes:
+            process.start()
+        outputs: List[Tuple[str, Any, int]] = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    latencies = np.array([value for kind, values, _ in outputs if kind == "read" for value in values])
+    return {
+        "profile": profile,
+        "journal_mode": journalMode,
+        "reads_per_s": len(latencies) / duration,
+        "writes_per_s": sum(writes for kind, writes, _ in outputs if kind == "write") / duration,
+        "read_p50_ms": float(np.percentile(latencies, 50)) * 1000.0 if len(latencies) != 0 else float("nan"),
+        "read_p99_ms": float(np.percentile(latencies, 99)) * 1000.0 if len(latencies) != 0 else float("nan"),
+        "errors": sum(errors for _, _, errors in outputs)
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure WebSPS read throughput under concurrent writes for each SQLite profile")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per profile")
+    parser.add_argument("--readers", type=int, default=4, help="reader processes")
+    parser.add_argument("--writers", type=int, default=2, help="writer processes")
+    parser.add_argument("--levels", type=int, default=10, help="initial levels per reaction")
+    parser.add_argument("--batch", type=int, default=5, help="levels added per write transaction")
+    parser.add_argument("--rate", type=float, default=20.0, help="write transactions per second per writer, the same for every profile")
+    args = parser.parse_args()
+
+    results = [run_profile(profile, args.duration, args.readers, args.writers, args.levels, args.batch, args.rate) for profile in PROFILES]
+    print(f"{'profile':<12} {'journal':<8} {'reads/s':>9} {'writes/s':>9} {'read p50 ms':>12} {'read p99 ms':>12} {'errors':>7}")
+    for result in results:
+        print(f"{result['profile']:<12} {result['journal_mode']:<8} {result['reads_per_s']:>9.1f} {result['writes_per_s']:>9.1f} {result['read_p50_ms']:>12.2f} {result['read_p99_ms']:>12.2f} {result['errors']:>7}")
+    if results[0]["reads_per_s"] != 0.0:
+        print(f"read throughput ratio (production/default): {results[1]['reads_per_s'] / results[0]['reads_per_s']:.2f}")
+
+if __name__ == "__main__":
+    main()
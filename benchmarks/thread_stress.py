@@ -0,0 +1,77 @@
+import argparse
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+from websps.db import get_nucleus_id, read_mass_table, set_mass_table
+from websps.SPSReaction import Reaction, RxnParameters
+from websps.SPSTarget import SPSTarget, TargetLayer, ELOSS_MODE_STEP, ELOSS_MODE_ADAPTIVE, ELOSS_MODE_TABLE, calculate_layer_energyloss, calculate_layer_reverse_energyloss
+
+from .fixtures import TARGETS, REACTIONS, BEAM_ENERGIES, SPS_ANGLE, MAGNETIC_FIELDS, make_levels
+
+#Concurrency check of the energy loss and kinematics code: many threads evaluate Reactions that share their SPSTargets
+#(as the plots of concurrent requests share the cached targets in spsplot) and call the stateless layer energy loss
+#functions with differing thicknesses. Every result must be identical to the serial result
+#No app or database is used: the mass table is read straight from the mass file
+#Run from the top level of the repository: python -m benchmarks.thread_stress [--threads 16] [--rounds 200]
+
+STRESS_MODES: Tuple[str, ...] = (ELOSS_MODE_STEP, ELOSS_MODE_ADAPTIVE, ELOSS_MODE_TABLE)
+STRESS_LEVELS: int = 20
+STRESS_THICKNESSES: np.ndarray = np.array([10.0, 50.0, 200.0, 1000.0]) * SPSTarget.UG2G #g/cm^2
+STRESS_PROTON_MASS: float = 938.272 #MeV
+STRESS_ENERGY: float = 10.0 #MeV/u
+STRESS_SWITCH_INTERVAL: float = 1.0e-6 #s, switch threads as often as possible to expose races
+
+def make_target(targetName: str, mode: str) -> SPSTarget:
+    layers, thicknesses = TARGETS[targetName]
+    return SPSTarget([TargetLayer([(get_nucleus_id(z, a), 1)], thickness) for (z, a), thickness in zip(layers, thicknesses)], targetName, mode)
+
+#Work units as (name, fn). Targets are shared between the units of a mode
+def make_tasks(mode: str) -> List[Tuple[str, Callable[[], Any]]]:
+    tasks = []
+    levels = make_levels(STRESS_LEVELS)
+    for targetName in TARGETS:
+        target = make_target(targetName, mode)
+        for rxnName, nuclei in REACTIONS.items():
+            params = RxnParameters(*[get_nucleus_id(z, a) for z, a in nuclei], BEAM_ENERGIES[rxnName], MAGNETIC_FIELDS[rxnName], SPS_ANGLE)
+            tasks.append((f"Reaction {rxnName} {targetName} {mode}", lambda params=params, target=target: Reaction(params, target).calculate_ejectile_batch(levels).rhos))
+        elements = target.get_layer_elements(0)
+        for thickness in STRESS_THICKNESSES:
+            tasks.append((f"SPSTarget layer energy loss {targetName} {thickness:.0e} {mode}", lambda target=target, thickness=thickness: (
+                target.get_layer_energyloss(1, STRESS_PROTON_MASS, STRESS_ENERGY, 0, thickness),
+                target.get_layer_reverse_energyloss(1, STRESS_PROTON_MASS, STRESS_ENERGY, 0, thickness)
+            )))
+            tasks.append((f"stateless layer energy loss {targetName} {thickness:.0e} {mode}", lambda elements=elements, thickness=thickness: (
+                calculate_layer_energyloss(1, STRESS_PROTON_MASS, STRESS_ENERGY, elements, thickness, mode),
+                calculate_layer_reverse_energyloss(1, STRESS_PROTON_MASS, STRESS_ENERGY, elements, thickness, mode)
+            )))
+    return tasks
+
+def run_stress(threads: int, rounds: int) -> Dict[str, Any]:
+    tasks = [task for mode in STRESS_MODES for task in make_tasks(mode)]
+    expected = [fn() for _, fn in tasks]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [(i, executor.submit(tasks[i][1])) for _ in range(rounds) for i in range(len(tasks))]
+        mismatches = [tasks[i][0] for i, future in futures if not np.array_equal(future.result(), expected[i])]
+    return {"calls": len(futures), "seconds": time.perf_counter() - start, "mismatches": mismatches}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the WebSPS energy loss and kinematics from many threads at once and check the results")
+    parser.add_argument("--threads", type=int, default=16, help="number of threads")
+    parser.add_argument("--rounds", type=int, default=200, help="times each work unit is run")
+    args = parser.parse_args()
+
+    set_mass_table(read_mass_table())
+    sys.setswitchinterval(STRESS_SWITCH_INTERVAL)
+    result = run_stress(args.threads, args.rounds)
+    print(f"{result['calls']} calls on {args.threads} threads in {result['seconds']:.2f} s, {len(result['mismatches'])} results differ from the serial results")
+    for name in sorted(set(result["mismatches"])):
+        print(f"  differs: {name} ({result['mismatches'].count(name)} times)")
+    if len(result["mismatches"]) != 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
-from .db import db, Nucleus
+from .db import get_mass_table
+from .metrics import timed
 from dataclasses import dataclass
 import numpy as np
-import requests as req
-import lxml.html as xhtml
+from .lazy import lazy_import
 from typing import Optional, List, Tuple
 
+req = lazy_import("requests")
+xhtml = lazy_import("lxml.html")
+
+NNDC_URL: str = "https://www.nndc.bnl.gov/nudat2/getdatasetClassic.jsp"
+NNDC_TIMEOUT: float = 30.0 #seconds
+
 @dataclass
 class NucleusData:
     mass: float = 0.0
@@ -14,22 +20,24 @@ class NucleusData:
     A: int = 0
 
 def get_nuclear_data(id: np.uint32) -> Optional[NucleusData]:
-    nuc: Optional[Nucleus] = db.session.get(Nucleus, id)
-    if nuc is None:
+    table = get_mass_table()
+    if not table.contains(id):
         return None
-    return NucleusData(nuc.mass, nuc.element, nuc.isotope, nuc.z, nuc.a)
+    element = str(table.element[id])
+    return NucleusData(float(table.mass[id]), element, f"<sup>{table.a[id]}</sup>{element}", int(table.z[id]), int(table.a[id]))
 
 def construct_catima_layer_element(id: np.uint32, s: int) -> Optional[Tuple[float, int, float]]:
-    nuc: Optional[Nucleus] = db.session.get(Nucleus, id)
-    if nuc is None:
+    table = get_mass_table()
+    if not table.contains(id):
         return None
-    return (nuc.mass, nuc.z, float(s))
+    return (float(table.mass[id]), int(table.z[id]), float(s))
 
-def get_excitations(id: np.uint32) -> List[float]:
+@timed("NucleusData.get_excitations")
+def get_excitations(id: np.uint32, url: str = NNDC_URL) -> List[float]:
     levels = []
     text = ''
     symbol = get_nuclear_data(id).isotopicSymbol.replace("<sup>", '').replace("</sup>", '')
-    site = req.get(f"https://www.nndc.bnl.gov/nudat2/getdatasetClassic.jsp?nucleus={symbol}&unc=nds")
+    site = req.get(f"{url}?nucleus={symbol}&unc=nds", timeout=NNDC_TIMEOUT)
     contents = xhtml.fromstring(site.content)
     tables = contents.xpath("//table")
     rows = tables[2].xpath("./tr")
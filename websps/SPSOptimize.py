@@ -0,0 +1,88 @@
+from .SPSReaction import Reaction
+from dataclasses import dataclass
+from typing import List, Optional
+import numpy as np
+
+GOLDEN_RATIO_INV: float = (np.sqrt(5.0) - 1.0) / 2.0
+ANGLE_TOLERANCE: float = 0.01 #deg
+
+#Levels of a reaction which should be placed on the focal plane (or the edges of an excitation window)
+@dataclass
+class FocusLevels:
+    reaction: Reaction
+    excitations: np.ndarray #MeV
+
+@dataclass
+class FieldSolution:
+    magneticField: float #kG
+    spsAngle: float #deg
+    rhos: List[np.ndarray] #cm, for each FocusLevels at the solution; NaN for kinematically forbidden levels
+    fits: bool #all levels fall within [rhoMin, rhoMax]
+    evaluations: int #number of kinematics evaluations used
+
+#Rhos of the levels at a field of 1 kG for the given angle (deg)
+#Rho scales exactly as 1/B (the ejectile KE does not depend on B), so these determine the field in closed form
+def get_unit_field_rhos(targets: List[FocusLevels], angle: float) -> List[np.ndarray]:
+    rhos = []
+    for target in targets:
+        target.reaction.spsAngle = angle * Reaction.DEG2RAD
+        target.reaction.magneticField = 1.0
+        batch = target.reaction.calculate_ejectile_batch(target.excitations)
+        rhos.append(np.where(batch.valid, batch.rhos, np.nan))
+    return rhos
+
+def get_rho_extent(rhos: List[np.ndarray]) -> Optional[np.ndarray]:
+    allRhos = np.concatenate(rhos) if len(rhos) != 0 else np.zeros(0)
+    allRhos = allRhos[np.isfinite(allRhos)]
+    if len(allRhos) == 0:
+        return None
+    return np.array([allRhos.min(), allRhos.max()])
+
+#Fractional spread of the levels on the focal plane, independent of the field
+def get_relative_spread(rhos: List[np.ndarray]) -> float:
+    extent = get_rho_extent(rhos)
+    if extent is None:
+        return np.inf
+    return (extent[1] - extent[0]) / (extent[1] + extent[0])
+
+def make_solution(unitRhos: List[np.ndarray], angle: float, rhoMin: float, rhoMax: float, evaluations: int) -> Optional[FieldSolution]:
+    extent = get_rho_extent(unitRhos)
+    if extent is None:
+        return None
+    #center the levels: (rho_low + rho_high) / 2B = (rhoMin + rhoMax) / 2
+    field = (extent[0] + extent[1]) / (rhoMin + rhoMax)
+    rhos = [levelRhos / field for levelRhos in unitRhos]
+    fits = extent[0] / field >= rhoMin and extent[1] / field <= rhoMax
+    return FieldSolution(field, angle, rhos, fits, evaluations)
+
+#Field which centers the levels between rhoMin and rhoMax at a fixed angle (deg). Returns None if no level is allowed
+def optimize_field(targets: List[FocusLevels], angle: float, rhoMin: float, rhoMax: float) -> Optional[FieldSolution]:
+    return make_solution(get_unit_field_rhos(targets, angle), angle, rhoMin, rhoMax, 1)
+
+#Angle (deg, within [angleMin, angleMax]) which minimizes the spread of the levels on the focal plane, and the field
+#which then centers them. Uses a golden section search, so the kinematics are evaluated O(log(range/ANGLE_TOLERANCE)) times
+def optimize_field_and_angle(targets: List[FocusLevels], angleMin: float, angleMax: float, rhoMin: float, rhoMax: float) -> Optional[FieldSolution]:
+    low = angleMin
+    high = angleMax
+    a = high - GOLDEN_RATIO_INV * (high - low)
+    b = low + GOLDEN_RATIO_INV * (high - low)
+    spreadA = get_relative_spread(get_unit_field_rhos(targets, a))
+    spreadB = get_relative_spread(get_unit_field_rhos(targets, b))
+    evaluations = 2
+    while (high - low) > ANGLE_TOLERANCE:
+        if spreadA <= spreadB:
+            high = b
+            b = a
+            spreadB = spreadA
+            a = high - GOLDEN_RATIO_INV * (high - low)
+            spreadA = get_relative_spread(get_unit_field_rhos(targets, a))
+        else:
+            low = a
+            a = b
+            spreadA = spreadB
+            b = low + GOLDEN_RATIO_INV * (high - low)
+            spreadB = get_relative_spread(get_unit_field_rhos(targets, b))
+        evaluations += 1
+
+    angle = 0.5 * (low + high)
+    return make_solution(get_unit_field_rhos(targets, angle), angle, rhoMin, rhoMax, evaluations + 1)
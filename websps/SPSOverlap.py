@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+
+#Pairs of focal plane points from different reactions which lie within a resolution window of each other, i.e. lines
+#that would not be resolved, such as a state of interest and a contaminant from the target backing. Indices refer to
+#the points as given (e.g. the points of a PlotData), and pairs are ordered along the focal plane
+@dataclass
+class OverlapResult:
+    first: np.ndarray #point index, the point with the smaller rho
+    second: np.ndarray #point index
+    separations: np.ndarray #cm, rho of second - rho of first
+
+class TooManyOverlapsError(Exception):
+    pass
+
+#Points i and j of different reactions overlap when rho_j - rho_i <= window (cm) or, if peak widths (cm FWHM) are given,
+#when it is <= max(window, (width_i + width_j)/2). The points are sorted by rho and each one is swept against the points
+#after it, up to the largest window any pair could have, so the cost is O(n log n + candidate pairs) rather than O(n^2)
+#Raises TooManyOverlapsError if there would be more than maxCandidates candidate pairs
+def find_overlaps(rxns: np.ndarray, rhos: np.ndarray, window: float, widths: Optional[np.ndarray] = None, maxCandidates: Optional[int] = None) -> OverlapResult:
+    points = np.flatnonzero(np.isfinite(rhos))
+    order = points[np.argsort(rhos[points], kind="stable")]
+    sortedRhos = rhos[order]
+    sortedRxns = rxns[order]
+    halfWidths = None
+    reach = window
+    if widths is not None:
+        halfWidths = 0.5 * np.nan_to_num(widths[order])
+        if len(halfWidths) != 0:
+            reach = max(window, 2.0 * halfWidths.max())
+
+    ends = np.searchsorted(sortedRhos, sortedRhos + reach, side="right")
+    counts = ends - np.arange(len(order)) - 1
+    nCandidates = int(counts.sum())
+    if maxCandidates is not None and nCandidates > maxCandidates:
+        raise TooManyOverlapsError(f"{nCandidates} candidate pairs within {reach:.3f} cm, more than the limit of {maxCandidates}")
+    first = np.repeat(np.arange(len(order)), counts)
+    second = first + 1 + np.arange(nCandidates) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    separations = sortedRhos[second] - sortedRhos[first]
+    keep = sortedRxns[first] != sortedRxns[second]
+    if halfWidths is not None:
+        keep &= separations <= np.maximum(window, halfWidths[first] + halfWidths[second])
+    return OverlapResult(order[first[keep]], order[second[keep]], separations[keep])
@@ -1,8 +1,9 @@
-from .SPSTarget import SPSTarget
+from .SPSTarget import SPSTarget, TargetLayer
 from .NucleusData import get_nuclear_data
 from dataclasses import dataclass
 from numpy import sqrt, cos, pi, sin
-from typing import List
+import numpy as np
+from typing import List, Optional
 
 INVALID_KINETIC_ENERGY: float = -1000.0
 
@@ -16,6 +17,25 @@ class RxnParameters:
     magneticField: float = 0.0 #kG
     spsAngle: float = 0.0 #deg
 
+#Beam kinematics at the reaction point (halfway through the rxn layer). These only depend on the beam, the target and the
+#reaction layer, so they are computed once and shared by every excitation
+@dataclass
+class RxnPointState:
+    beamEnergy: float #MeV, before the target
+    rxnLayer: int
+    target: SPSTarget
+    beamRxnEnergy: float #MeV, at the reaction point
+    beamRxnP: float #MeV/c, at the reaction point
+
+#Results of a batch kinematics calculation; entries where valid is False are kinematically forbidden and are zeroed
+@dataclass
+class EjectileBatch:
+    excitations: np.ndarray #MeV
+    energies: np.ndarray #MeV
+    rhos: np.ndarray #cm
+    offsets: np.ndarray #cm
+    valid: np.ndarray #bool
+
 class Reaction:
     DEG2RAD: float = pi/180.0 #degrees -> radians
     C = 299792458 #speed of light m/s
@@ -35,11 +55,26 @@ class Reaction:
 
         self.rxnLayer = self.targetMaterial.get_rxn_layer(self.targetNuc.Z, self.targetNuc.A)
         self.Qvalue = self.targetNuc.mass + self.projectileNuc.mass - self.ejectileNuc.mass - self.residualNuc.mass
+        self.rxnPointState: Optional[RxnPointState] = None
+
+    #Get the reaction point kinematics, recomputing them only if the beam energy, target or reaction layer changed
+    def get_rxn_point_state(self) -> RxnPointState:
+        state = self.rxnPointState
+        if state is None or state.beamEnergy != self.beamEnergy or state.rxnLayer != self.rxnLayer or state.target is not self.targetMaterial:
+            beamRxnEnergy = self.beamEnergy - self.targetMaterial.get_incoming_energyloss(self.projectileNuc.Z, self.projectileNuc.mass, self.beamEnergy, self.rxnLayer, 0.0)
+            beamRxnP = sqrt(beamRxnEnergy * (beamRxnEnergy + 2.0 * self.projectileNuc.mass))
+            state = RxnPointState(self.beamEnergy, self.rxnLayer, self.targetMaterial, beamRxnEnergy, beamRxnP)
+            self.rxnPointState = state
+        return state
+
+    #Force the reaction point kinematics to be recomputed (i.e. the target layers were modified in place)
+    def invalidate_rxn_point_state(self) -> None:
+        self.rxnPointState = None
 
     #MeV
     def calculate_ejectile_KE(self, excitation: float) -> float:
         rxnQ = self.Qvalue - excitation
-        beamRxnEnergy = self.beamEnergy - self.targetMaterial.get_incoming_energyloss(self.projectileNuc.Z, self.projectileNuc.mass, self.beamEnergy, self.rxnLayer, 0.0)
+        beamRxnEnergy = self.get_rxn_point_state().beamRxnEnergy
         threshold = -rxnQ*(self.ejectileNuc.mass+self.residualNuc.mass)/(self.ejectileNuc.mass + self.residualNuc.mass - self.projectileNuc.mass)
         if beamRxnEnergy < threshold:
             return INVALID_KINETIC_ENERGY
@@ -74,14 +109,29 @@ class Reaction:
         ejectileEnergy  = sqrt(ejectileP**2.0 + self.ejectileNuc.mass**2.0) - self.ejectileNuc.mass
         ejectileRxnEnergy = ejectileEnergy +  self.targetMaterial.get_outgoing_reverse_energyloss(self.ejectileNuc.Z, self.ejectileNuc.mass, ejectileEnergy, self.rxnLayer, self.spsAngle)
         ejectileRxnP = sqrt(ejectileRxnEnergy * (ejectileRxnEnergy + 2.0 * self.ejectileNuc.mass))
-        beamRxnEnergy = self.beamEnergy - self.targetMaterial.get_incoming_energyloss(self.projectileNuc.Z, self.projectileNuc.mass, self.beamEnergy, self.rxnLayer, 0.0)
-        beamRxnP = sqrt(beamRxnEnergy * (beamRxnEnergy + 2.0 * self.projectileNuc.mass))
+        rxnPoint = self.get_rxn_point_state()
+        beamRxnEnergy = rxnPoint.beamRxnEnergy
+        beamRxnP = rxnPoint.beamRxnP
 
 
         residRxnEnergy = beamRxnEnergy + self.projectileNuc.mass + self.targetNuc.mass - ejectileRxnEnergy - self.ejectileNuc.mass
         residRxnP2 = beamRxnP**2.0 + ejectileRxnP**2.0 - 2.0 * ejectileRxnP * beamRxnP * cos(self.spsAngle)
         return sqrt(residRxnEnergy**2.0 - residRxnP2) - self.residualNuc.mass
 
+    #Vectorized calculate_excitation for an array of rhos. Unphysical rhos give NaN
+    def calculate_excitations(self, rhos: np.ndarray) -> np.ndarray:
+        rhos = np.asarray(rhos, dtype=float)
+        ejectileP = rhos * float(self.ejectileNuc.Z) * self.magneticField * self.QBRHO2P
+        ejectileEnergy = sqrt(ejectileP**2.0 + self.ejectileNuc.mass**2.0) - self.ejectileNuc.mass
+        ejectileRxnEnergy = ejectileEnergy + self.targetMaterial.get_outgoing_reverse_energyloss(self.ejectileNuc.Z, self.ejectileNuc.mass, ejectileEnergy, self.rxnLayer, self.spsAngle)
+        ejectileRxnP = sqrt(ejectileRxnEnergy * (ejectileRxnEnergy + 2.0 * self.ejectileNuc.mass))
+        rxnPoint = self.get_rxn_point_state()
+
+        residRxnEnergy = rxnPoint.beamRxnEnergy + self.projectileNuc.mass + self.targetNuc.mass - ejectileRxnEnergy - self.ejectileNuc.mass
+        residRxnP2 = rxnPoint.beamRxnP**2.0 + ejectileRxnP**2.0 - 2.0 * ejectileRxnP * rxnPoint.beamRxnP * cos(self.spsAngle)
+        invariantMass2 = residRxnEnergy**2.0 - residRxnP2
+        return np.sqrt(np.where(invariantMass2 >= 0.0, invariantMass2, np.nan)) - self.residualNuc.mass
+
     def calculate_focal_plane_offset(self, ejectileEnergy: float) -> float:
         if ejectileEnergy == INVALID_KINETIC_ENERGY:
             return 0.0
@@ -90,11 +140,68 @@ class Reaction:
         k /= self.ejectileNuc.mass + self.residualNuc.mass - sqrt(self.projectileNuc.mass * self.ejectileNuc.mass * self.beamEnergy/ejectileEnergy) * cos(self.spsAngle)
         return -1.0*k*ejectileRho*self.FP_DISPERSION*self.FP_MAGNIFICATION
 
+    #Vectorized kinematics for an array of excitations. Returns ejectile KE, rho and focal plane offset in one pass
+    def calculate_ejectile_batch(self, excitations: np.ndarray) -> EjectileBatch:
+        excitations = np.asarray(excitations, dtype=float)
+        energies = np.zeros(excitations.shape)
+        rhos = np.zeros(excitations.shape)
+        offsets = np.zeros(excitations.shape)
+
+        rxnQ = self.Qvalue - excitations
+        beamRxnEnergy = self.get_rxn_point_state().beamRxnEnergy
+        threshold = -rxnQ*(self.ejectileNuc.mass+self.residualNuc.mass)/(self.ejectileNuc.mass + self.residualNuc.mass - self.projectileNuc.mass)
+        term1 = sqrt(self.projectileNuc.mass * self.ejectileNuc.mass * beamRxnEnergy) / (self.ejectileNuc.mass + self.residualNuc.mass) * cos(self.spsAngle)
+        term2 = (beamRxnEnergy * (self.residualNuc.mass - self.projectileNuc.mass) + self.residualNuc.mass * rxnQ) / (self.ejectileNuc.mass + self.residualNuc.mass)
+        valid = (beamRxnEnergy >= threshold) & ((term1**2.0 + term2) >= 0.0)
+
+        ejectileEnergy = (term1 + sqrt(term1**2.0 + term2[valid]))**2.0
+        ejectileEnergy -= self.targetMaterial.get_outgoing_energyloss(self.ejectileNuc.Z, self.ejectileNuc.mass, ejectileEnergy, self.rxnLayer, self.spsAngle)
+        energies[valid] = ejectileEnergy
+        rhos[valid] = self.convert_ejectile_KE_2_rho_array(ejectileEnergy)
+        offsets[valid] = self.calculate_focal_plane_offset_array(ejectileEnergy)
+        return EjectileBatch(excitations, energies, rhos, offsets, valid)
+
+    #Ejectile KE (MeV) at the reaction point for arrays of beam energies at the reaction point (MeV) and reaction angles
+    #(rad), for one excitation. Unlike calculate_ejectile_batch no target energy loss is applied. Forbidden events give NaN
+    def calculate_ejectile_rxn_energies(self, beamRxnEnergies: np.ndarray, excitation: float, angles: np.ndarray) -> np.ndarray:
+        rxnQ = self.Qvalue - excitation
+        threshold = -rxnQ*(self.ejectileNuc.mass+self.residualNuc.mass)/(self.ejectileNuc.mass + self.residualNuc.mass - self.projectileNuc.mass)
+        term1 = sqrt(self.projectileNuc.mass * self.ejectileNuc.mass * np.maximum(beamRxnEnergies, 0.0)) / (self.ejectileNuc.mass + self.residualNuc.mass) * cos(angles)
+        term2 = (beamRxnEnergies * (self.residualNuc.mass - self.projectileNuc.mass) + self.residualNuc.mass * rxnQ) / (self.ejectileNuc.mass + self.residualNuc.mass)
+        discriminant = term1**2.0 + term2
+        valid = (beamRxnEnergies >= threshold) & (discriminant >= 0.0)
+        return np.where(valid, (term1 + sqrt(np.where(valid, discriminant, 0.0)))**2.0, np.nan)
+
+    #Vectorized convert_ejectile_KE_2_rho, for valid ejectile energies only
+    def convert_ejectile_KE_2_rho_array(self, ejectileEnergies: np.ndarray) -> np.ndarray:
+        p = sqrt(ejectileEnergies * (ejectileEnergies + 2.0 * self.ejectileNuc.mass))
+        return p / self.QBRHO2P / (float(self.ejectileNuc.Z) * self.magneticField)
+
+    #Vectorized calculate_focal_plane_offset, for valid ejectile energies only
+    def calculate_focal_plane_offset_array(self, ejectileEnergies: np.ndarray) -> np.ndarray:
+        ejectileRhos = self.convert_ejectile_KE_2_rho_array(ejectileEnergies)
+        kinFactor = sqrt(self.projectileNuc.mass * self.ejectileNuc.mass * self.beamEnergy / ejectileEnergies)
+        k = kinFactor * sin(self.spsAngle) / (self.ejectileNuc.mass + self.residualNuc.mass - kinFactor * cos(self.spsAngle))
+        return -1.0*k*ejectileRhos*self.FP_DISPERSION*self.FP_MAGNIFICATION
+
     def calculate_ejectile_energies(self, excitations: List[float]) -> List[float]:
-        return [self.calculate_ejectile_KE(ex) for ex in excitations]
+        batch = self.calculate_ejectile_batch(np.array(excitations, dtype=float))
+        return np.where(batch.valid, batch.energies, INVALID_KINETIC_ENERGY).tolist()
     
     def calculate_ejectile_rhos(self, ejectEnergies: List[float]) -> List[float]:
-        return [self.convert_ejectile_KE_2_rho(ke) for ke in ejectEnergies]
+        energies = np.array(ejectEnergies, dtype=float)
+        valid = energies != INVALID_KINETIC_ENERGY
+        rhos = np.zeros(energies.shape)
+        rhos[valid] = self.convert_ejectile_KE_2_rho_array(energies[valid])
+        return rhos.tolist()
 
     def calculate_ejectile_offsets(self, ejectEnergies: List[float]) -> List[float]:
-        return [self.calculate_focal_plane_offset(ke) for ke in ejectEnergies]
+        energies = np.array(ejectEnergies, dtype=float)
+        valid = energies != INVALID_KINETIC_ENERGY
+        offsets = np.zeros(energies.shape)
+        offsets[valid] = self.calculate_focal_plane_offset_array(energies[valid])
+        return offsets.tolist()
+
+#Batch kinematics for a chunk of levels built from plain (picklable) inputs, so that it can run in a worker process
+def calculate_ejectile_chunk(params: RxnParameters, layers: List[TargetLayer], excitations: np.ndarray) -> EjectileBatch:
+    return Reaction(params, SPSTarget(layers)).calculate_ejectile_batch(excitations)
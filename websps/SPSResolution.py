@@ -0,0 +1,140 @@
+from .SPSReaction import Reaction
+from .SPSTarget import SPSTarget
+from .NucleusData import get_nuclear_data
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+FWHM_PER_SIGMA: float = 2.0*np.sqrt(2.0*np.log(2.0))
+AVOGADRO: float = 6.02214076e23 #1/mol
+E2: float = 1.439964e-13 #e^2/(4 pi epsilon_0), MeV cm
+
+#Sources of focal plane peak width
+RESOLUTION_BEAM: str = "beam" #beam energy spread
+RESOLUTION_STRAGGLING: str = "straggling" #energy loss straggling in the target, incoming and outgoing
+RESOLUTION_DEPTH: str = "depth" #position of the reaction within the reaction layer
+RESOLUTION_ACCEPTANCE: str = "acceptance" #reaction angle across the spectrograph acceptance
+RESOLUTION_SOURCES: Tuple[str, ...] = (RESOLUTION_BEAM, RESOLUTION_STRAGGLING, RESOLUTION_DEPTH, RESOLUTION_ACCEPTANCE)
+
+@dataclass
+class ResolutionParameters:
+    beamSpread: float = 1.0e-3 #beam energy spread, FWHM relative to the beam energy
+    acceptance: float = 2.0 #deg, full horizontal acceptance, sampled uniformly about the SPS angle
+    events: int = 100_000 #per level
+    kinematicCorrection: bool = True #remove the rho-angle correlation, as placing the detector at the offset Z does
+    contributions: bool = False #also estimate the width from each source alone
+    seed: Optional[int] = None
+
+#Focal plane peak widths of a set of levels. Widths are Gaussian equivalent FWHM (2.355 sigma) of the sampled rho
+#distributions; kinematically forbidden levels (or levels where every event stops in the target) are NaN
+@dataclass
+class ResolutionResult:
+    excitations: np.ndarray #MeV
+    rhos: np.ndarray #cm, mean of the sampled rhos
+    widths: np.ndarray #cm, all sources
+    contributions: Dict[str, np.ndarray] = field(default_factory=dict) #cm, by source
+
+#Beam events at the reaction point, shared by every level of a reaction
+@dataclass
+class BeamSample:
+    depths: np.ndarray #fraction of the reaction layer before the reaction point
+    angles: np.ndarray #rad, reaction angle
+    energies: np.ndarray #MeV, beam energy at the reaction point
+
+#Monte Carlo estimate of the focal plane peak widths of a Reaction. Events are sampled in NumPy arrays, one level at a
+#time. The target is traversed layer by layer in the same way as SPSTarget.get_incoming_energyloss and
+#get_outgoing_energyloss (which are the case of every sampled reaction at half the rxn layer), so the mean rhos agree
+#with Reaction.calculate_ejectile_batch. Straggling is Bohr's, sampled as a Gaussian after each layer
+class ResolutionEstimator:
+    def __init__(self, reaction: Reaction, params: ResolutionParameters):
+        self.reaction = reaction
+        self.target: SPSTarget = reaction.targetMaterial
+        self.params = params
+        self.rng = np.random.default_rng(params.seed)
+        self.beamSamples: Dict[Tuple[str, ...], BeamSample] = {}
+        self.stragglingFactors: Dict[int, float] = {}
+
+    #Bohr straggling variance per unit thickness and per projectile charge squared for the layer idx, MeV^2/(g/cm^2)
+    def get_straggling_factor(self, idx: int) -> float:
+        factor = self.stragglingFactors.get(idx)
+        if factor is None:
+            compound = [(get_nuclear_data(id), s) for (id, s) in self.target.layer_details[idx].compound_list]
+            grams = sum(s * nucleus.A for (nucleus, s) in compound)
+            electrons = sum(s * nucleus.Z for (nucleus, s) in compound)
+            factor = 4.0 * np.pi * E2**2.0 * AVOGADRO * electrons / grams if grams > 0.0 else 0.0
+            self.stragglingFactors[idx] = factor
+        return factor
+
+    #Run particles with energies (MeV) through the segments [(layer idx, thickness g/cm^2 per event)]
+    def transport(self, zp: int, ap: float, energies: np.ndarray, segments: List[Tuple[int, np.ndarray]], straggling: bool) -> np.ndarray:
+        e_current = energies/ap
+        for (idx, thickness) in segments:
+            e_current = e_current - self.target.get_layer_energyloss(zp, ap, e_current, idx, thickness)
+            if straggling:
+                sigma = np.sqrt(self.get_straggling_factor(idx) * float(zp)**2.0 * thickness)
+                e_current = e_current + self.rng.normal(0.0, 1.0, len(e_current)) * sigma / ap
+        return e_current*ap
+
+    def get_beam_sample(self, sources: Tuple[str, ...]) -> BeamSample:
+        sample = self.beamSamples.get(sources)
+        if sample is not None:
+            return sample
+        nEvents = self.params.events
+        reaction = self.reaction
+        energies = np.full(nEvents, reaction.beamEnergy)
+        if RESOLUTION_BEAM in sources:
+            energies *= 1.0 + self.rng.normal(0.0, self.params.beamSpread/FWHM_PER_SIGMA, nEvents)
+        depths = self.rng.uniform(0.0, 1.0, nEvents) if RESOLUTION_DEPTH in sources else np.full(nEvents, 0.5)
+        angles = np.full(nEvents, reaction.spsAngle)
+        if RESOLUTION_ACCEPTANCE in sources:
+            angles += self.rng.uniform(-0.5, 0.5, nEvents) * self.params.acceptance * Reaction.DEG2RAD
+
+        #the beam enters along the target normal
+        segments = [(idx, np.full(nEvents, layer.thickness * SPSTarget.UG2G)) for idx, layer in enumerate(self.target.layer_details[:reaction.rxnLayer])]
+        segments.append((reaction.rxnLayer, depths * self.target.layer_details[reaction.rxnLayer].thickness * SPSTarget.UG2G))
+        energies = self.transport(reaction.projectileNuc.Z, reaction.projectileNuc.mass, energies, segments, RESOLUTION_STRAGGLING in sources)
+        sample = BeamSample(depths, angles, energies)
+        self.beamSamples[sources] = sample
+        return sample
+
+    #Sampled rhos (cm) of the ejectile for one level, with only the given sources of width
+    def sample_rhos(self, excitation: float, sources: Tuple[str, ...]) -> np.ndarray:
+        reaction = self.reaction
+        beam = self.get_beam_sample(sources)
+        energies = reaction.calculate_ejectile_rxn_energies(beam.energies, excitation, beam.angles)
+        allowed = np.isfinite(energies)
+        energies = energies[allowed]
+        angles = beam.angles[allowed]
+        pathFactor = 1.0 / np.abs(np.cos(angles))
+        segments = [(reaction.rxnLayer, (1.0 - beam.depths[allowed]) * self.target.layer_details[reaction.rxnLayer].thickness * SPSTarget.UG2G * pathFactor)]
+        segments += [(idx, layer.thickness * SPSTarget.UG2G * pathFactor) for idx, layer in enumerate(self.target.layer_details[reaction.rxnLayer+1:], start=reaction.rxnLayer+1)]
+        energies = self.transport(reaction.ejectileNuc.Z, reaction.ejectileNuc.mass, energies, segments, RESOLUTION_STRAGGLING in sources)
+        escaped = energies > 0.0
+        rhos = reaction.convert_ejectile_KE_2_rho_array(energies[escaped])
+        if self.params.kinematicCorrection and RESOLUTION_ACCEPTANCE in sources and len(rhos) > 1:
+            dAngles = angles[escaped] - angles[escaped].mean()
+            variance = np.dot(dAngles, dAngles)
+            if variance > 0.0:
+                rhos = rhos - np.dot(dAngles, rhos - rhos.mean()) / variance * dAngles
+        return rhos
+
+    def estimate(self, excitations: np.ndarray) -> ResolutionResult:
+        excitations = np.asarray(excitations, dtype=float)
+        sourceSets = [RESOLUTION_SOURCES]
+        if self.params.contributions:
+            sourceSets += [(source,) for source in RESOLUTION_SOURCES]
+        widths = {sources: np.full(len(excitations), np.nan) for sources in sourceSets}
+        means = np.full(len(excitations), np.nan)
+        for i, excitation in enumerate(excitations):
+            for sources in sourceSets:
+                rhos = self.sample_rhos(excitation, sources)
+                if len(rhos) < 2:
+                    continue
+                widths[sources][i] = FWHM_PER_SIGMA * rhos.std()
+                if sources == RESOLUTION_SOURCES:
+                    means[i] = rhos.mean()
+        contributions = {sources[0]: widths[sources] for sources in sourceSets[1:]}
+        return ResolutionResult(excitations, means, widths[RESOLUTION_SOURCES], contributions)
+
+def estimate_resolution(reaction: Reaction, excitations: np.ndarray, params: ResolutionParameters) -> ResolutionResult:
+    return ResolutionEstimator(reaction, params).estimate(excitations)
@@ -0,0 +1,87 @@
+from .SPSReaction import Reaction, RxnParameters
+from .SPSTarget import SPSTarget, TargetLayer
+from dataclasses import dataclass, replace
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+
+#Plain description of a reaction and its levels for the setting scanner. Contains no ORM objects, so that it can be
+#sent to worker processes
+@dataclass
+class ScanReaction:
+    params: RxnParameters
+    layers: List[TargetLayer]
+    excitations: np.ndarray #MeV
+    label: str = ""
+
+#Result of a setting scan over beam energy, SPS angle and B field for every level of every reaction
+#Levels are flattened across reactions; levelRxns gives the reaction index of each level
+@dataclass
+class ScanResult:
+    beamEnergies: np.ndarray #MeV
+    angles: np.ndarray #deg
+    fields: np.ndarray #kG
+    labels: List[str] #reaction labels, by reaction index
+    levelRxns: np.ndarray
+    levelExcitations: np.ndarray #MeV
+    energies: np.ndarray #ejectile KE (MeV), shape (beam energy, angle, level)
+    valid: np.ndarray #shape (beam energy, angle, level)
+    rhos: np.ndarray #cm, shape (beam energy, angle, field, level); zero for invalid levels
+    offsets: np.ndarray #cm, shape (beam energy, angle, field, level); zero for invalid levels
+
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.beamEnergies, self.angles, self.fields, self.levelRxns, self.levelExcitations, self.energies, self.valid, self.rhos, self.offsets))
+
+#Ejectile energies, validity, and rhos and offsets at a 1 kG field, for one beam energy and all angles
+#The reaction point kinematics (incoming energy loss) depend only on the beam energy, so each Reaction is built once
+#and only its angle is changed. Rho and the focal plane offset both scale as 1/B, so fields are applied afterwards
+def scan_beam_energy(reactions: List[ScanReaction], beamEnergy: float, angles: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    nLevels = sum(len(rxn.excitations) for rxn in reactions)
+    energies = np.zeros((len(angles), nLevels))
+    valid = np.zeros((len(angles), nLevels), dtype=bool)
+    rhos = np.zeros((len(angles), nLevels))
+    offsets = np.zeros((len(angles), nLevels))
+    start = 0
+    for rxn in reactions:
+        stop = start + len(rxn.excitations)
+        reaction = Reaction(replace(rxn.params, beamEnergy=beamEnergy, magneticField=1.0, spsAngle=0.0), SPSTarget(rxn.layers))
+        for ia, angle in enumerate(angles):
+            reaction.spsAngle = angle * Reaction.DEG2RAD
+            batch = reaction.calculate_ejectile_batch(rxn.excitations)
+            energies[ia, start:stop] = batch.energies
+            valid[ia, start:stop] = batch.valid
+            rhos[ia, start:stop] = batch.rhos
+            offsets[ia, start:stop] = batch.offsets
+        start = stop
+    return (energies, valid, rhos, offsets)
+
+#Run a scan over the grid of beam energies x angles x fields. Beam energies are distributed over the executor if given
+#progress, if given, is called with the fraction of beam energies done after each one; an exception raised by it stops
+#the scan (pending beam energies on the executor are cancelled)
+def run_scan(reactions: List[ScanReaction], beamEnergies: np.ndarray, angles: np.ndarray, fields: np.ndarray, executor: Optional[Executor] = None,
+             progress: Optional[Callable[[float], None]] = None) -> ScanResult:
+    points = []
+    if executor is None or len(beamEnergies) < 2:
+        for energy in beamEnergies:
+            points.append(scan_beam_energy(reactions, energy, angles))
+            if progress is not None:
+                progress(len(points) / len(beamEnergies))
+    else:
+        futures = [executor.submit(scan_beam_energy, reactions, energy, angles) for energy in beamEnergies]
+        try:
+            for future in futures:
+                points.append(future.result())
+                if progress is not None:
+                    progress(len(points) / len(beamEnergies))
+        finally:
+            for future in futures:
+                future.cancel()
+
+    energies = np.stack([point[0] for point in points])
+    valid = np.stack([point[1] for point in points])
+    inverseFields = (1.0 / fields)[np.newaxis, np.newaxis, :, np.newaxis]
+    rhos = np.stack([point[2] for point in points])[:, :, np.newaxis, :] * inverseFields
+    offsets = np.stack([point[3] for point in points])[:, :, np.newaxis, :] * inverseFields
+    levelRxns = np.concatenate([np.full(len(rxn.excitations), ir) for ir, rxn in enumerate(reactions)] + [np.zeros(0, dtype=int)]).astype(int)
+    levelExcitations = np.concatenate([rxn.excitations for rxn in reactions] + [np.zeros(0)])
+    return ScanResult(beamEnergies, angles, fields, [rxn.label for rxn in reactions], levelRxns, levelExcitations, energies, valid, rhos, offsets)
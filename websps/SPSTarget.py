@@ -1,14 +1,32 @@
-import pycatima as catima
 from dataclasses import dataclass, field
-from numpy import pi, cos, uint32
+from numpy import pi, cos, uint32, ndim, broadcast_arrays, array
 from .NucleusData import construct_catima_layer_element
+from .EnergyLossTable import get_range_table
 from .db import get_nucleus_id
-from typing import List, Tuple
+from .metrics import timed
+from .lazy import lazy_import
+from typing import List, Tuple, Dict, Optional
+
+catima = lazy_import("pycatima")
 
 INVALID_RXN_LAYER: int = -1
 ADAPTIVE_DEPTH_MAX: int = 100
 ENERGY_PERCENT_STEP_MIN: float = 0.001
 
+#Adaptive Runge-Kutta (Dormand-Prince 5(4)) integration of dT/dx = -(dE/dx)/A
+RK45_TOLERANCE: float = 1.0e-8 #allowed local error, relative to the current energy
+RK45_SAFETY: float = 0.9
+RK45_GROWTH_MAX: float = 5.0
+RK45_SHRINK_MIN: float = 0.2
+RK45_STEPS_MAX: int = 1000
+RK45_ENERGY_MIN: float = 1.0e-6 #MeV/u, below this the particle is considered stopped
+
+#Energy loss calculation modes; step integrates dE/dx through each layer, adaptive integrates it with error control,
+#table uses the precomputed range tables
+ELOSS_MODE_STEP: str = "step"
+ELOSS_MODE_ADAPTIVE: str = "adaptive"
+ELOSS_MODE_TABLE: str = "table"
+
 @dataclass
 class TargetLayer:
     compound_list: List[Tuple[uint32 , int]] = field(default_factory=list) #nucleus id, Stoichiometry
@@ -17,13 +35,14 @@ class TargetLayer:
 #integrate energy loss starting from the final energy and running backwards to initial energy
 #catima does not natively provide this type of method
 #returns the total energy loss (really in this case energy gain) through the material
-def get_reverse_energyloss(projectile: catima.Projectile, material: catima.Material) -> float:
+def get_reverse_energyloss(projectile: "catima.Projectile", material: "catima.Material") -> float:
     depth = 0
+    dedx = catima.dedx #looked up once per call, as catima is a lazily imported module
     e_out = projectile.T() #MeV/u
     e_initial = e_out
     x_step = 0.25*material.thickness() #g/cm^2
     x_traversed = 0.0
-    e_step = catima.dedx(projectile, material)*x_step
+    e_step = dedx(projectile, material)*x_step
     A_recip = 1.0/projectile.A()
 
     if material.thickness() <= 0.0:
@@ -35,11 +54,11 @@ def get_reverse_energyloss(projectile: catima.Projectile, material: catima.Mater
         if e_step/e_initial > ENERGY_PERCENT_STEP_MIN and depth < ADAPTIVE_DEPTH_MAX:
             depth += 1
             x_step *= 0.5
-            e_step = catima.dedx(projectile, material)*x_step*A_recip
+            e_step = dedx(projectile, material)*x_step*A_recip
 
         elif (x_step + x_traversed) >= material.thickness():
             x_step = material.thickness() -  x_traversed
-            e_step = catima.dedx(projectile, material)*x_step
+            e_step = dedx(projectile, material)*x_step
             e_initial += e_step*A_recip
             projectile.T(e_initial)
             return (e_initial - e_out)*projectile.A()
@@ -47,7 +66,7 @@ def get_reverse_energyloss(projectile: catima.Projectile, material: catima.Mater
         elif depth == ADAPTIVE_DEPTH_MAX:
             return e_out*projectile.A()
         else:
-            e_step = catima.dedx(projectile, material)*x_step
+            e_step = dedx(projectile, material)*x_step
             e_initial += e_step*A_recip
             projectile.T(e_initial)
             x_traversed += x_step
@@ -55,13 +74,14 @@ def get_reverse_energyloss(projectile: catima.Projectile, material: catima.Mater
 #integrate energy loss starting from the initial energy to final energy
 #catima does not natively provide this type of method, only a calculate function which does a whole bunch of other stuff too
 #returns the total energy loss through the material
-def get_energyloss(projectile: catima.Projectile, material: catima.Material) -> float:
+def get_energyloss(projectile: "catima.Projectile", material: "catima.Material") -> float:
     depth = 0
+    dedx = catima.dedx #looked up once per call, as catima is a lazily imported module
     e_in = projectile.T() # MeV/u
     e_final = e_in
     x_step = 0.25*material.thickness() #g/cm^2
     x_traversed = 0.0
-    e_step = catima.dedx(projectile, material)*x_step
+    e_step = dedx(projectile, material)*x_step
     A_recip = 1.0/projectile.A()
 
     if material.thickness() <= 0.0:
@@ -72,11 +92,11 @@ def get_energyloss(projectile: catima.Projectile, material: catima.Material) ->
         if e_step/e_final > ENERGY_PERCENT_STEP_MIN and depth < ADAPTIVE_DEPTH_MAX:
             depth += 1
             x_step *= 0.5
-            e_step = catima.dedx(projectile, material)*x_step*A_recip
+            e_step = dedx(projectile, material)*x_step*A_recip
         
         elif (x_step + x_traversed) >= material.thickness():
             x_step = material.thickness() - x_traversed
-            e_step = catima.dedx(projectile, material)*x_step*A_recip
+            e_step = dedx(projectile, material)*x_step*A_recip
             e_final -= e_step
             projectile.T(e_final)
             return (e_in - e_final)*projectile.A()
@@ -85,16 +105,133 @@ def get_energyloss(projectile: catima.Projectile, material: catima.Material) ->
             return e_in*projectile.A()
         
         else:
-            e_step = catima.dedx(projectile, material)*x_step*A_recip
+            e_step = dedx(projectile, material)*x_step*A_recip
             e_final -= e_step
             projectile.T(e_final)
             x_traversed += x_step
         
+#Dormand-Prince 5(4) tableau: stage coefficients, fifth order weights and the error weights (fifth - fourth order)
+#including the FSAL stage evaluated at the new energy
+DP_STAGES: Tuple[Tuple[float, ...], ...] = (
+    (1.0/5.0,),
+    (3.0/40.0, 9.0/40.0),
+    (44.0/45.0, -56.0/15.0, 32.0/9.0),
+    (19372.0/6561.0, -25360.0/2187.0, 64448.0/6561.0, -212.0/729.0),
+    (9017.0/3168.0, -355.0/33.0, 46732.0/5247.0, 49.0/176.0, -5103.0/18656.0)
+)
+DP_WEIGHTS: Tuple[float, ...] = (35.0/384.0, 0.0, 500.0/1113.0, 125.0/192.0, -2187.0/6784.0, 11.0/84.0)
+DP_ERROR: Tuple[float, ...] = (71.0/57600.0, 0.0, -71.0/16695.0, 71.0/1920.0, -17253.0/339200.0, 22.0/525.0, -1.0/40.0)
+
+#Integrate the energy of the projectile through thickness (g/cm^2) of the material with the Dormand-Prince pair.
+#The step grows as well as shrinks with the error estimate, and the last stage of an accepted step is the first of the
+#next (FSAL), so an accepted step costs 6 catima.dedx calls. direction is -1.0 running forward (losing energy) and
+#+1.0 running backward (gaining energy). Returns the final energy in MeV/u, or None if the particle stopped or the
+#step limit was reached. The projectile is left at the final energy
+def integrate_energy_rk45(projectile: "catima.Projectile", material: "catima.Material", thickness: float, direction: float) -> Optional[float]:
+    scale = direction/projectile.A()
+    dedx = catima.dedx
+    def slope(e: float) -> float:
+        projectile.T(e)
+        return dedx(projectile, material)*scale
+
+    e = projectile.T() #MeV/u
+    x_traversed = 0.0
+    x_step = thickness
+    k1 = slope(e)
+    for _ in range(RK45_STEPS_MAX):
+        x_step = min(x_step, thickness - x_traversed)
+        k = [k1]
+        for coefficients in DP_STAGES:
+            e_stage = e + x_step*sum(c*ki for c, ki in zip(coefficients, k))
+            if e_stage <= RK45_ENERGY_MIN:
+                break
+            k.append(slope(e_stage))
+        e_next = e + x_step*sum(w*ki for w, ki in zip(DP_WEIGHTS, k)) if len(k) == len(DP_WEIGHTS) else 0.0
+        if e_next <= RK45_ENERGY_MIN:
+            #the step ran past the end of the range; retry with a shorter one, unless the particle is stopping here
+            if x_step < thickness*RK45_TOLERANCE:
+                return None
+            x_step *= RK45_SHRINK_MIN
+            continue
+
+        k.append(slope(e_next))
+        error = abs(x_step*sum(w*ki for w, ki in zip(DP_ERROR, k)))
+        tolerance = RK45_TOLERANCE*max(e, e_next)
+        if error <= tolerance:
+            x_traversed += x_step
+            e = e_next
+            k1 = k[-1]
+            if x_traversed >= thickness:
+                projectile.T(e)
+                return e
+        x_step *= RK45_GROWTH_MAX if error == 0.0 else min(RK45_GROWTH_MAX, max(RK45_SHRINK_MIN, RK45_SAFETY*(tolerance/error)**0.2))
+    return None
+
+#Adaptive equivalent of get_energyloss; returns the total energy loss through the material, or all of the energy if
+#the particle stops in it
+def get_energyloss_rk45(projectile: "catima.Projectile", material: "catima.Material") -> float:
+    thickness = material.thickness() #g/cm^2
+    e_in = projectile.T() #MeV/u
+    if thickness <= 0.0:
+        return 0.0
+    e_final = integrate_energy_rk45(projectile, material, thickness, -1.0)
+    if e_final is None:
+        return e_in*projectile.A()
+    return (e_in - e_final)*projectile.A()
+
+#Adaptive equivalent of get_reverse_energyloss; returns the total energy gained running backwards through the material
+def get_reverse_energyloss_rk45(projectile: "catima.Projectile", material: "catima.Material") -> float:
+    thickness = material.thickness() #g/cm^2
+    e_out = projectile.T() #MeV/u
+    if thickness <= 0.0:
+        return 0.0
+    e_initial = integrate_energy_rk45(projectile, material, thickness, 1.0)
+    if e_initial is None:
+        return e_out*projectile.A()
+    return (e_initial - e_out)*projectile.A()
+
+#Stateless energy loss of a particle (zp, ap mass) with energy e_current (MeV/u) through thickness (g/cm^2) of a layer
+#given by its catima compound elements [(mass, Z, stoichiometry)]. Only plain numbers go in: the catima projectile and
+#material are made for each call and the range tables are read-only once built, so these functions are safe to call
+#from any number of threads, and need no app or database. e_current and thickness may also be ndarrays
+def calculate_layer_energyloss(zp: int, ap: float, e_current: float, elements: List[Tuple[float, int, float]], thickness: float, mode: str = ELOSS_MODE_TABLE) -> float:
+    if mode == ELOSS_MODE_TABLE:
+        return get_range_table(zp, ap, elements).get_energyloss(e_current, thickness)
+    elif ndim(e_current) != 0 or ndim(thickness) != 0:
+        e_array, thick_array = broadcast_arrays(e_current, thickness)
+        return array([calculate_layer_energyloss(zp, ap, float(e), elements, float(t), mode) for (e, t) in zip(e_array.flat, thick_array.flat)]).reshape(e_array.shape)
+
+    projectile = catima.Projectile(ap, zp)
+    projectile.T(e_current) #catima wants MeV/u
+    material = catima.Material(elements)
+    material.thickness(thickness)
+    if mode == ELOSS_MODE_ADAPTIVE:
+        return get_energyloss_rk45(projectile, material)
+    return get_energyloss(projectile, material)
+
+#Stateless reverse energy loss (energy gain) of a particle with final energy e_current (MeV/u), as calculate_layer_energyloss
+def calculate_layer_reverse_energyloss(zp: int, ap: float, e_current: float, elements: List[Tuple[float, int, float]], thickness: float, mode: str = ELOSS_MODE_TABLE) -> float:
+    if mode == ELOSS_MODE_TABLE:
+        return get_range_table(zp, ap, elements).get_reverse_energyloss(e_current, thickness)
+    elif ndim(e_current) != 0 or ndim(thickness) != 0:
+        e_array, thick_array = broadcast_arrays(e_current, thickness)
+        return array([calculate_layer_reverse_energyloss(zp, ap, float(e), elements, float(t), mode) for (e, t) in zip(e_array.flat, thick_array.flat)]).reshape(e_array.shape)
+
+    projectile = catima.Projectile(ap, zp)
+    projectile.T(e_current) #catima wants MeV/u
+    material = catima.Material(elements)
+    material.thickness(thickness)
+    if mode == ELOSS_MODE_ADAPTIVE:
+        return get_reverse_energyloss_rk45(projectile, material)
+    return get_reverse_energyloss(projectile, material)
+
 class SPSTarget:
     UG2G: float = 1.0e-6 #convert ug to g
-    def __init__(self, layers: List[TargetLayer], name: str = "default"):
+    def __init__(self, layers: List[TargetLayer], name: str = "default", eloss_mode: str = ELOSS_MODE_TABLE):
         self.layer_details = layers
         self.name = name
+        self.eloss_mode = eloss_mode
+        self.layer_elements: Dict[int, List[Tuple[float, int, float]]] = {}
 
     def __str__(self):
         return self.name
@@ -107,62 +244,78 @@ class SPSTarget:
                     return idx
         return INVALID_RXN_LAYER
 
+    #catima compound description of a layer, built once per layer. The elements are never modified, so the SPSTarget
+    #can be shared between threads
+    def get_layer_elements(self, idx: int) -> List[Tuple[float, int, float]]:
+        elements = self.layer_elements.get(idx)
+        if elements is None:
+            elements = [construct_catima_layer_element(id, s) for (id, s) in self.layer_details[idx].compound_list]
+            self.layer_elements[idx] = elements
+        return elements
+
+    #A new catima material for a layer. Materials carry their thickness, so they are not shared
+    def get_layer_material(self, idx: int) -> "catima.Material":
+        return catima.Material(self.get_layer_elements(idx))
+
+    #Energy loss of a particle with energy e_current (MeV/u) through thickness (g/cm^2) of the layer idx
+    #e_current and thickness may also be ndarrays, in which case an ndarray of energy losses is returned
+    def get_layer_energyloss(self, zp: int, ap: float, e_current: float, idx: int, thickness: float) -> float:
+        return calculate_layer_energyloss(zp, ap, e_current, self.get_layer_elements(idx), thickness, self.eloss_mode)
+
+    #Reverse energy loss (energy gain) of a particle with final energy e_current (MeV/u) through thickness (g/cm^2) of the layer idx
+    #e_current and thickness may also be ndarrays, in which case an ndarray of energy gains is returned
+    def get_layer_reverse_energyloss(self, zp: int, ap: float, e_current: float, idx: int, thickness: float) -> float:
+        return calculate_layer_reverse_energyloss(zp, ap, e_current, self.get_layer_elements(idx), thickness, self.eloss_mode)
+
     #Calculate energy loss for a particle coming into the target, up to rxn layer (halfway through rxn layer)
+    @timed("SPSTarget.get_incoming_energyloss")
     def get_incoming_energyloss(self, zp: int, ap: float, e_initial: float, rxn_layer: int, angle: float) -> float:
         if angle == pi*0.5:
             return e_initial
 
-        projectile = catima.Projectile(ap, zp)
         e_current = e_initial/ap
 
         for (idx, layer) in enumerate(self.layer_details):
-            material = catima.Material([construct_catima_layer_element(id, s) for (id, s) in layer.compound_list])
-            projectile.T(e_current) #catima wants MeV/u
             if idx == rxn_layer:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle))))
-                e_current -= get_energyloss(projectile, material)
+                thickness = self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle)))
+                e_current -= self.get_layer_energyloss(zp, ap, e_current, idx, thickness)
                 return e_initial - e_current*ap
             else:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / abs(cos(angle)))
-                e_current -= get_energyloss(projectile, material)
+                thickness = self.layer_details[idx].thickness * self.UG2G / abs(cos(angle))
+                e_current -= self.get_layer_energyloss(zp, ap, e_current, idx, thickness)
 
         return e_initial - e_current*ap
 
     #Calculate energy loss for a particle leaving the target, from rxn layer (halfway through rxn layer) to end
+    @timed("SPSTarget.get_outgoing_energyloss")
     def get_outgoing_energyloss(self, zp: int, ap: float, e_initial: float, rxn_layer: int, angle: float) -> float:
         if angle == pi*0.5:
             return e_initial
 
-        projectile = catima.Projectile(ap, zp)
         e_current = e_initial/ap
 
         for (idx, layer) in enumerate(self.layer_details[rxn_layer:], start=rxn_layer):
-            material = catima.Material([construct_catima_layer_element(id, s) for (id, s) in layer.compound_list])
-            projectile.T(e_current) #catima wants MeV/u
             if idx == rxn_layer:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle))))
+                thickness = self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle)))
             else:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / abs(cos(angle)))
-            e_current -= get_energyloss(projectile, material)
+                thickness = self.layer_details[idx].thickness * self.UG2G / abs(cos(angle))
+            e_current -= self.get_layer_energyloss(zp, ap, e_current, idx, thickness)
 
         return e_initial - e_current*ap
 
     #Calculate reverse energy loss (energy gain) for a particle that left the target after a reaction (end -> rxn_layer)
+    @timed("SPSTarget.get_outgoing_reverse_energyloss")
     def get_outgoing_reverse_energyloss(self, zp: int, ap: float, e_final: float, rxn_layer: int, angle: float) -> float:
         if angle == pi*0.5:
             return 0.0
 
-        projectile = catima.Projectile(ap, zp)
         e_current = e_final/ap
-        sublist = self.layer_details[rxn_layer:] #only care about rxn_layer -> exit
-        reveresedRxnLayer = len(sublist) -1 #when reversed rxn_layer is the last layer
-        for (idx, layer) in reversed(list(enumerate(sublist))):
-            material = catima.Material([construct_catima_layer_element(id, s) for (id, s) in layer.compound_list])
-            projectile.T(e_current) #catima wants MeV/u
-            if idx == reveresedRxnLayer:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle))))
+        #Mirror of get_outgoing_energyloss: exit -> rxn_layer, with half of the rxn_layer
+        for (idx, layer) in reversed(list(enumerate(self.layer_details[rxn_layer:], start=rxn_layer))):
+            if idx == rxn_layer:
+                thickness = self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle)))
             else:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / abs(cos(angle)))
-            e_current += get_reverse_energyloss(projectile, material)
+                thickness = self.layer_details[idx].thickness * self.UG2G / abs(cos(angle))
+            e_current += self.get_layer_reverse_energyloss(zp, ap, e_current, idx, thickness)
 
         return e_current*ap - e_final
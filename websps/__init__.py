@@ -6,6 +6,9 @@ from . import auth
 from . import home
 from . import spsplot
 from . import admin
+from . import metrics
+from . import queries
+from . import warmup
 from pathlib import Path
 
 def create_app(test_config: Optional[Mapping[str, Any]]=None) -> Flask:
@@ -15,7 +18,40 @@ def create_app(test_config: Optional[Mapping[str, Any]]=None) -> Flask:
         SECRET_KEY='dev',
         SQLALCHEMY_DATABASE_URI=f"sqlite+pysqlite:///{Path(app.instance_path) / 'websps.sqlite'}",
         ADMIN_USERNAME="admin",
-        ADMIN_PASSWORD="testing1"
+        ADMIN_PASSWORD="testing1",
+        PLOT_CACHE_MAX_ENTRIES=1024, #one entry per reaction and set of plot inputs
+        PLOT_CACHE_TTL=3600.0, #seconds
+        PLOT_CACHE_MAX_BYTES=64 * 1024 * 1024,
+        NNDC_URL="https://www.nndc.bnl.gov/nudat2/getdatasetClassic.jsp",
+        NNDC_FETCH_ASYNC=True,
+        NNDC_FETCH_WORKERS=2,
+        PROCESS_POOL_SIZE=None, #None uses one process per core, 0 disables the pool
+        PROCESS_POOL_START_METHOD="spawn",
+        PLOT_PARALLEL_MIN_LEVELS=200_000,
+        PLOT_PARALLEL_CHUNK_SIZE=50_000,
+        RESOLUTION_EVENTS=10_000, #Monte Carlo events per level for peak widths
+        RESOLUTION_MAX_EVENTS=100_000, #largest number of events per level a request may ask for
+        RESOLUTION_EVENT_BUDGET=20_000_000, #events per request; beyond this the events per level are reduced
+        OVERLAP_MAX_CANDIDATES=1_000_000, #candidate point pairs considered by the overlap detector
+        SCAN_MAX_POINTS=10_000_000,
+        SCAN_PARALLEL_MIN_POINTS=100_000,
+        SCAN_CACHE_MAX_ENTRIES=16,
+        SCAN_CACHE_TTL=3600.0, #seconds
+        SCAN_CACHE_MAX_BYTES=256 * 1024 * 1024,
+        JOB_WORKERS=2, #threads running background plot and scan jobs, for all users
+        JOB_MAX_RUNNING_PER_USER=1, #further jobs of a user wait in the user's queue
+        JOB_MAX_ACTIVE_PER_USER=4, #queued or running jobs per user; more submissions are refused
+        JOB_RESULT_TTL=3600.0, #seconds a finished job and its result are kept
+        METRICS_ENABLED=False,
+        SQL_STATEMENT_LIMIT=None, #set in tests to assert a maximum number of SQL statements per request
+        WARMUP=False, #load heavy dependencies and the mass table in create_app, i.e. before a preforking server forks
+        SQLITE_PROFILE="production", #"default" leaves SQLite and the connection pool at their default settings
+        SQLITE_SYNCHRONOUS="NORMAL",
+        SQLITE_CACHE_SIZE=32 * 1024 * 1024, #bytes, per connection
+        SQLITE_MMAP_SIZE=128 * 1024 * 1024, #bytes
+        SQLITE_BUSY_TIMEOUT=10.0, #seconds
+        SQLITE_POOL_SIZE=5, #per process
+        SQLITE_POOL_MAX_OVERFLOW=10
     )
 
     if test_config is None:
@@ -33,11 +69,17 @@ def create_app(test_config: Optional[Mapping[str, Any]]=None) -> Flask:
 
     # initialize database with app
     db.init_app(app)
+    db.configure_sqlite_engine(app)
     db.db.init_app(app)
+    db.install_sqlite_pragmas(app)
+    metrics.init_app(app)
+    queries.init_app(app)
 
     app.register_blueprint(admin.bp)
     app.register_blueprint(home.bp)
     app.register_blueprint(auth.bp)
     app.register_blueprint(spsplot.bp)
 
+    warmup.init_app(app)
+
     return app
@@ -1,9 +1,11 @@
-from flask import Blueprint, redirect, render_template, url_for, Response
+from flask import Blueprint, redirect, render_template, url_for, Response, jsonify
 from werkzeug.exceptions import abort
 from sqlalchemy import select, delete
 
 from .auth import admin_required
-from .db import db, User, ReactionData, TargetMaterial, Level
+from .db import db, User, ReactionData, TargetMaterial, TargetMaterialLayer, LayerComponent, Level
+from .metrics import registry
+from . import queries
 
 from typing import Optional
 
@@ -25,13 +27,18 @@ def get_user(id: int) -> User:
 @bp.route("/user/<int:id>/inspect", methods=("GET", "POST"))
 @admin_required
 def inspect_user(id: int) -> str:
-    user = get_user(id)
+    user = queries.get_user_overview(id)
+    if user is None:
+        abort(404, f"Requested user {id} does not exist")
     return render_template("admin/inspect_user.html", user=user)
 
 @bp.route("/user/<int:id>/clear", methods=("GET", "POST"))
 @admin_required
 def clear_user_data(id: int) -> Response:
     user = get_user(id)
+    layers = select(TargetMaterialLayer.id).join(TargetMaterial).where(TargetMaterial.user_id == id)
+    db.session.execute(delete(LayerComponent).where(LayerComponent.layer_id.in_(layers)))
+    db.session.execute(delete(TargetMaterialLayer).where(TargetMaterialLayer.target_mat_id.in_(select(TargetMaterial.id).where(TargetMaterial.user_id == id))))
     db.session.execute(delete(TargetMaterial).where(TargetMaterial.user_id == id))
     db.session.execute(delete(ReactionData).where(ReactionData.user_id == id))
     db.session.execute(delete(Level).where(Level.user_id == id))
@@ -45,3 +52,15 @@ def delete_user(id: int) -> Response:
     db.session.delete(user)
     db.session.commit()
     return redirect(url_for("admin.index"))
+
+#Aggregated instrumentation (see metrics.py); empty unless METRICS_ENABLED is set
+@bp.route("/metrics", methods=["GET"])
+@admin_required
+def metrics() -> Response:
+    return jsonify(registry.snapshot())
+
+@bp.route("/metrics/reset", methods=["POST"])
+@admin_required
+def reset_metrics() -> Response:
+    registry.reset()
+    return jsonify(registry.snapshot())
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+#Small in-process LRU cache with a time-to-live and a memory cap, used to memoize expensive computed results
+#The size of each entry is given by the caller (in bytes) when it is stored
+class ResultCache:
+    def __init__(self, max_entries: int = 128, ttl: float = 3600.0, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl #seconds
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict() #key -> (expiration time, size, value)
+        self.lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, value: Any, size: int = 0) -> None:
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (monotonic() + self.ttl, size, value)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    #Remove every entry whose key matches
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry[1]
@@ -1,12 +1,17 @@
 import click
+import json
+import os
 from flask import current_app, Flask
 import numpy as np
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index, select, insert, delete, inspect, text, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash
 from datetime import datetime
-from typing import List
+from threading import Lock
+from typing import List, Optional, Dict, Any, Iterator, Iterable, Tuple, IO
 
 U2MEV: float = 931.4940954
 ELECTRON_MASS: float = 0.000548579909
@@ -22,38 +27,57 @@ class Nucleus(db.Model):
     element: str = Column(String, nullable=False)
     isotope: str = Column(String, nullable=False)
 
+#One nucleus of a target layer compound
+class LayerComponent(db.Model):
+    __tablename__ = "layer_component"
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    layer_id: int = Column(Integer, ForeignKey("target_layer.id"), nullable=False, index=True)
+    position: int = Column(Integer, nullable=False)
+    nucleus_id: int = Column(Integer, ForeignKey("nucleus.id"), nullable=False)
+    stoichiometry: int = Column(Integer, nullable=False)
+
+#One layer of a target material. Position is the layer slot of the target form (0 = upstream)
+class TargetMaterialLayer(db.Model):
+    __tablename__ = "target_layer"
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    target_mat_id: int = Column(Integer, ForeignKey("target_material.id"), nullable=False, index=True)
+    position: int = Column(Integer, nullable=False)
+    thickness: float = Column(Float, nullable=False) #ug/cm^2
+    symbol: str = Column(String, nullable=False)
+
+    components: List[LayerComponent] = relationship("LayerComponent", order_by=LayerComponent.position, cascade="all, delete-orphan", lazy="selectin")
+
 class TargetMaterial(db.Model):
     __tablename__ = "target_material"
     id: int = Column(Integer, primary_key=True, autoincrement=True)
-    user_id: int = Column(Integer, ForeignKey("user.id"))
+    user_id: int = Column(Integer, ForeignKey("user.id"), index=True)
     mat_name: str = Column(String, nullable=False)
-    mat_symbol: str = Column(String, nullable=False)
-    compounds: str = Column(String, nullable=False)
-    thicknesses: str = Column(String, nullable=False)
     reactions = relationship("ReactionData", back_populates="target_material", cascade="save-update, merge, delete")
+    layers: List[TargetMaterialLayer] = relationship("TargetMaterialLayer", order_by=TargetMaterialLayer.position, cascade="all, delete-orphan", lazy="selectin")
 
 class Level(db.Model):
     __tablename__ = "level"
 
     id: int = Column(Integer, primary_key=True, autoincrement=True)
-    user_id: int = Column(Integer, ForeignKey("user.id"))
-    reaction_id: int = Column(Integer, ForeignKey("reaction.id"))
+    user_id: int = Column(Integer, ForeignKey("user.id"), index=True)
+    reaction_id: int = Column(Integer, ForeignKey("reaction.id")) #indexed by ix_level_reaction_excitation
     excitation: float = Column(Float)
 
     reaction = relationship("ReactionData", back_populates="user_levels")
 
+    __table_args__ = (Index("ix_level_reaction_excitation", "reaction_id", "excitation"),)
+
 class ReactionData(db.Model):
     __tablename__ = "reaction"
     id: int = Column(Integer, primary_key=True, autoincrement=True)
-    user_id: int = Column(Integer, ForeignKey("user.id"))
-    target_mat_id: int = Column(Integer, ForeignKey("target_material.id"))
+    user_id: int = Column(Integer, ForeignKey("user.id"), index=True)
+    target_mat_id: int = Column(Integer, ForeignKey("target_material.id"), index=True)
     rxn_symbol: str = Column(String, nullable=False)
     latex_rxn_symbol: str = Column(String, nullable=False)
     target_nuc_id: int = Column(Integer, ForeignKey("nucleus.id"))
     projectile_nuc_id: int = Column(Integer, ForeignKey("nucleus.id"))
     ejectile_nuc_id: int = Column(Integer, ForeignKey("nucleus.id"))
     residual_nuc_id: int = Column(Integer, ForeignKey("nucleus.id"))
-    nndc_levels: str = Column(String)
 
     target_material: TargetMaterial = relationship("TargetMaterial", back_populates="reactions")
     target_nucleus: Nucleus = relationship("Nucleus", foreign_keys=[target_nuc_id])
@@ -61,6 +85,27 @@ class ReactionData(db.Model):
     ejectile_nucleus: Nucleus = relationship("Nucleus", foreign_keys=[ejectile_nuc_id])
     residual_nucleus: Nucleus = relationship("Nucleus", foreign_keys=[residual_nuc_id])
     user_levels: List[Level] = relationship("Level", back_populates="reaction", cascade="save-update, merge, delete")
+    level_scheme: Optional["LevelScheme"] = relationship("LevelScheme", primaryjoin="foreign(ReactionData.residual_nuc_id) == LevelScheme.nucleus_id", viewonly=True, uselist=False)
+
+LEVEL_SCHEME_PENDING: str = "pending"
+LEVEL_SCHEME_READY: str = "ready"
+LEVEL_SCHEME_FAILED: str = "failed"
+
+#NNDC level schemes, shared by every reaction (of any user) with the same residual nucleus
+class LevelScheme(db.Model):
+    __tablename__ = "level_scheme"
+    nucleus_id: int = Column(Integer, ForeignKey("nucleus.id"), primary_key=True)
+    status: str = Column(String, nullable=False)
+    date_fetched: datetime = Column(DateTime)
+
+#The levels of a level scheme, one row per level so that they can be selected by excitation in SQL
+class NNDCLevel(db.Model):
+    __tablename__ = "nndc_level"
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    nucleus_id: int = Column(Integer, ForeignKey("level_scheme.nucleus_id"), nullable=False)
+    excitation: float = Column(Float, nullable=False) #MeV
+
+    __table_args__ = (Index("ix_nndc_level_nucleus_excitation", "nucleus_id", "excitation"),)
 
 class User(db.Model):
     __tablename__ = "user"
@@ -77,26 +122,218 @@ class User(db.Model):
 def get_nucleus_id(z: np.uint32, a: np.uint32) -> np.uint32:
     return z*z + z + a if z > a else a*a + z
 
+#Read-only, process-wide copy of the nucleus table stored in compact arrays indexed by nucleus id (see get_nucleus_id)
+#Nuclear data never changes while the app is running, so it is loaded once and shared instead of querying the database
+class MassTable:
+    def __init__(self, ids: np.ndarray, z: np.ndarray, a: np.ndarray, mass: np.ndarray, element: np.ndarray):
+        size = int(ids.max()) + 1 if len(ids) != 0 else 0
+        self.valid = np.zeros(size, dtype=bool)
+        self.z = np.zeros(size, dtype=np.int32)
+        self.a = np.zeros(size, dtype=np.int32)
+        self.mass = np.zeros(size, dtype=np.float64) #MeV
+        self.element = np.zeros(size, dtype=element.dtype)
+        self.valid[ids] = True
+        self.z[ids] = z
+        self.a[ids] = a
+        self.mass[ids] = mass
+        self.element[ids] = element
+
+    def contains(self, id: np.uint32) -> bool:
+        return 0 <= id < len(self.valid) and bool(self.valid[id])
+
+def load_mass_table() -> MassTable:
+    rows = db.session.execute(select(Nucleus.id, Nucleus.z, Nucleus.a, Nucleus.mass, Nucleus.element)).all()
+    return MassTable(
+        np.array([row[0] for row in rows], dtype=np.int64),
+        np.array([row[1] for row in rows], dtype=np.int32),
+        np.array([row[2] for row in rows], dtype=np.int32),
+        np.array([row[3] for row in rows], dtype=np.float64),
+        np.array([row[4] for row in rows], dtype=str)
+    )
+
+_mass_table: Optional[MassTable] = None
+_mass_table_lock = Lock()
+
+#Get the process-wide mass table, loading it from the database on first use
+def get_mass_table() -> MassTable:
+    global _mass_table
+    table = _mass_table
+    if table is None:
+        with _mass_table_lock:
+            if _mass_table is None:
+                _mass_table = load_mass_table()
+            table = _mass_table
+    return table
+
+#Install a mass table as the process-wide table (i.e. in worker processes without a database)
+def set_mass_table(table: MassTable) -> None:
+    global _mass_table
+    with _mass_table_lock:
+        _mass_table = table
+
+#Drop the process-wide mass table, so that it will be reloaded (i.e. after the nucleus table was rewritten)
+def clear_mass_table() -> None:
+    global _mass_table
+    with _mass_table_lock:
+        _mass_table = None
+
+MASS_BATCH_SIZE: int = 500
+
+#Parse the AME mass file, yielding one nucleus table row per nuclide
+def read_mass_file(massfile: IO[bytes]) -> Iterator[Dict[str, Any]]:
+    massfile.readline()
+    massfile.readline()
+    for line in massfile:
+        entries = line.split()
+        z = int(entries[1])
+        a = int(entries[2])
+        element = entries[3].decode("utf-8")
+        yield {
+            "id": get_nucleus_id(z, a),
+            "z": z,
+            "a": a,
+            "mass": (float(entries[4])  + 1.0e-6 * float(entries[5]) - float(z) * ELECTRON_MASS) * U2MEV,
+            "element": element,
+            "isotope": f"<sup>{a}</sup>{element}"
+        }
+
+#Group rows into lists of at most MASS_BATCH_SIZE
+def batched(rows: Iterable[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == MASS_BATCH_SIZE:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+MASS_FILE: str = os.path.join(os.path.dirname(__file__), "data", "mass.txt") #the app resource data/mass.txt
+
+#Build a MassTable straight from the AME mass file, without a database or app (i.e. for CLI batch jobs and scripts,
+#with set_mass_table). Gives the same table as loading the nucleus table written by init_db
+def read_mass_table(path: str = MASS_FILE) -> MassTable:
+    with open(path, "rb") as massfile:
+        rows = list(read_mass_file(massfile))
+    return MassTable(
+        np.array([row["id"] for row in rows], dtype=np.int64),
+        np.array([row["z"] for row in rows], dtype=np.int32),
+        np.array([row["a"] for row in rows], dtype=np.int32),
+        np.array([row["mass"] for row in rows], dtype=np.float64),
+        np.array([row["element"] for row in rows], dtype=str)
+    )
+
 def init_db() -> None:
+    clear_mass_table()
     db.drop_all()
     db.create_all()
     admin = User(username=current_app.config.get("ADMIN_USERNAME"), password=generate_password_hash(current_app.config.get("ADMIN_PASSWORD")), date_created=datetime.now(), date_last_login=datetime.now())
     db.session.add(admin)
+    with current_app.open_resource("data/mass.txt") as massfile:
+        for batch in batched(read_mass_file(massfile)):
+            db.session.execute(insert(Nucleus), batch)
     db.session.commit()
+    clear_mass_table()
+
+#Update the nucleus table from data/mass.txt in place, without touching any other data
+#Returns the number of (inserted, updated) rows
+def refresh_masses() -> Tuple[int, int]:
+    existing = {row.id: row for row in db.session.execute(select(Nucleus.id, Nucleus.z, Nucleus.a, Nucleus.mass, Nucleus.element, Nucleus.isotope))}
+    inserts = []
+    updates = []
     with current_app.open_resource("data/mass.txt") as massfile:
-        massfile.readline()
-        massfile.readline()
-        for line in massfile:
-            nuc = Nucleus()
-            entries = line.split()
-            nuc.z = int(entries[1])
-            nuc.a = int(entries[2])
-            nuc.id = get_nucleus_id(nuc.z, nuc.a)
-            nuc.mass = (float(entries[4])  + 1.0e-6 * float(entries[5]) - float(nuc.z) * ELECTRON_MASS) * U2MEV
-            nuc.element = entries[3].decode("utf-8")
-            nuc.isotope = f"<sup>{nuc.a}</sup>{nuc.element}"
-            db.session.add(nuc)
-            db.session.commit()
+        for row in read_mass_file(massfile):
+            old = existing.get(row["id"])
+            if old is None:
+                inserts.append(row)
+            elif (old.z, old.a, old.mass, old.element, old.isotope) != (row["z"], row["a"], row["mass"], row["element"], row["isotope"]):
+                updates.append(row)
+    for batch in batched(inserts):
+        db.session.execute(insert(Nucleus), batch)
+    for batch in batched(updates):
+        db.session.bulk_update_mappings(Nucleus, batch)
+    db.session.commit()
+    clear_mass_table()
+    return (len(inserts), len(updates))
+
+#Layer rows for a target material built from the per layer symbols, compounds [[(nucleus id, stoichiometry), ...], ...]
+#and thicknesses (ug/cm^2). Layers with no compound are skipped; each layer keeps its index as its position
+def make_target_layers(symbols: List[str], compounds: List[List[Tuple[int, int]]], thicknesses: List[float]) -> List[TargetMaterialLayer]:
+    return [
+        TargetMaterialLayer(
+            position=i,
+            thickness=thicknesses[i],
+            symbol=symbols[i],
+            components=[LayerComponent(position=j, nucleus_id=int(nucleus), stoichiometry=int(s)) for j, (nucleus, s) in enumerate(compound)]
+        )
+        for i, compound in enumerate(compounds) if len(compound) != 0
+    ]
+
+def get_table_columns(table: str) -> List[str]:
+    return [column["name"] for column in inspect(db.engine).get_columns(table)]
+
+#Older databases stored target layers, NNDC levels and the levels of each reaction as JSON strings. Move that data
+#into the structured tables and drop the old columns. Returns the number of (targets, level schemes) migrated
+def migrate_legacy_columns() -> Tuple[int, int]:
+    nTargets = 0
+    nSchemes = 0
+    if "compounds" in get_table_columns("target_material"):
+        rows = db.session.execute(text("SELECT id, mat_symbol, compounds, thicknesses FROM target_material")).all()
+        migrated = set(db.session.execute(select(TargetMaterialLayer.target_mat_id)).scalars())
+        for row in rows:
+            if row.id in migrated:
+                continue
+            compounds = json.loads(row.compounds)
+            thicknesses = json.loads(row.thicknesses)
+            #symbols were only stored for the non-empty layers, in order
+            symbolIter = iter(json.loads(row.mat_symbol))
+            symbols = [next(symbolIter, "") if len(compound) != 0 else "" for compound in compounds]
+            for layer in make_target_layers(symbols, compounds, [float(t) for t in thicknesses] + [0.0] * (len(compounds) - len(thicknesses))):
+                layer.target_mat_id = row.id
+                db.session.add(layer)
+            nTargets += 1
+        db.session.flush()
+
+    if "levels" in get_table_columns("level_scheme"):
+        rows = db.session.execute(text("SELECT nucleus_id, levels FROM level_scheme WHERE levels IS NOT NULL")).all()
+        for row in rows:
+            db.session.execute(delete(NNDCLevel).where(NNDCLevel.nucleus_id == row.nucleus_id))
+            levels = json.loads(row.levels)
+            if len(levels) != 0:
+                db.session.execute(insert(NNDCLevel), [{"nucleus_id": row.nucleus_id, "excitation": ex} for ex in levels])
+            nSchemes += 1
+
+    #Reactions from before the level scheme store carried their own copy of the levels
+    if "nndc_levels" in get_table_columns("reaction"):
+        rows = db.session.execute(text("SELECT residual_nuc_id, nndc_levels FROM reaction WHERE nndc_levels IS NOT NULL")).all()
+        schemes = set(db.session.execute(select(LevelScheme.nucleus_id)).scalars())
+        for row in rows:
+            if row.residual_nuc_id in schemes:
+                continue
+            db.session.add(LevelScheme(nucleus_id=row.residual_nuc_id, status=LEVEL_SCHEME_READY, date_fetched=datetime.now()))
+            db.session.flush()
+            levels = json.loads(row.nndc_levels)
+            if len(levels) != 0:
+                db.session.execute(insert(NNDCLevel), [{"nucleus_id": row.residual_nuc_id, "excitation": ex} for ex in levels])
+            schemes.add(row.residual_nuc_id)
+            nSchemes += 1
+    db.session.commit()
+
+    for table, columns in (("target_material", ("mat_symbol", "compounds", "thicknesses")), ("level_scheme", ("levels",)), ("reaction", ("nndc_levels",))):
+        existing = get_table_columns(table)
+        for column in columns:
+            if column in existing:
+                db.session.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+    db.session.commit()
+    return (nTargets, nSchemes)
+
+#Bring an existing database up to date: create missing tables and indexes, then migrate any legacy columns
+def upgrade_db() -> Tuple[int, int]:
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    return migrate_legacy_columns()
 
 @click.command("init-db")
 def init_db_command() -> None:
@@ -105,5 +342,68 @@ def init_db_command() -> None:
     init_db()
     click.echo("Done.")
 
+@click.command("refresh-masses")
+def refresh_masses_command() -> None:
+    #Update the nuclear mass table from data/mass.txt, keeping all user data
+    click.echo("Refreshing nuclear masses...")
+    inserted, updated = refresh_masses()
+    click.echo(f"Done. Inserted {inserted} and updated {updated} nuclei.")
+
+@click.command("upgrade-db")
+def upgrade_db_command() -> None:
+    #Create any tables and indexes missing from an existing database and migrate old data, keeping all user data
+    click.echo("Upgrading the database...")
+    targets, schemes = upgrade_db()
+    click.echo(f"Done. Migrated {targets} target materials and {schemes} level schemes.")
+
+#SQLite production profile (SQLITE_PROFILE = "production"), for several mod_wsgi processes and threads sharing one file:
+#WAL journaling so that readers are not blocked by a writer, synchronous=NORMAL (durable with WAL up to the last
+#checkpoint), a larger page cache and memory map, and a pool of connections which are kept open between requests
+def is_sqlite_file(uri: str) -> bool:
+    url = make_url(uri)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+def uses_sqlite_profile(app: Flask) -> bool:
+    return app.config.get("SQLITE_PROFILE") == "production" and is_sqlite_file(app.config["SQLALCHEMY_DATABASE_URI"])
+
+#Must be called before the engine is created (i.e. before db.init_app)
+def configure_sqlite_engine(app: Flask) -> None:
+    if not uses_sqlite_profile(app):
+        return
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    options.setdefault("poolclass", QueuePool)
+    options.setdefault("pool_size", app.config["SQLITE_POOL_SIZE"])
+    options.setdefault("max_overflow", app.config["SQLITE_POOL_MAX_OVERFLOW"])
+    options.setdefault("pool_timeout", app.config["SQLITE_BUSY_TIMEOUT"])
+    connectArgs = dict(options.get("connect_args", {}))
+    connectArgs.setdefault("check_same_thread", False) #pooled connections move between the threads of a process
+    connectArgs.setdefault("timeout", app.config["SQLITE_BUSY_TIMEOUT"]) #wait this long for a competing writer
+    options["connect_args"] = connectArgs
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+def get_sqlite_pragmas(app: Flask) -> List[str]:
+    return [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA cache_size={-int(app.config['SQLITE_CACHE_SIZE'] // 1024)}", #negative is in KiB
+        f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}",
+        "PRAGMA temp_store=MEMORY"
+    ]
+
+#Must be called after db.init_app. The pragmas are applied to every new connection, before it is used
+def install_sqlite_pragmas(app: Flask) -> None:
+    if not uses_sqlite_profile(app):
+        return
+    pragmas = get_sqlite_pragmas(app)
+    def set_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    with app.app_context():
+        event.listen(db.engine, "connect", set_pragmas)
+
 def init_app(app: Flask) -> None:
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(refresh_masses_command)
\ No newline at end of file
@@ -1,12 +1,16 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, DecimalField, IntegerField, SelectField, RadioField, FormField, FieldList
-from wtforms.validators import InputRequired, Optional, Length, ValidationError
+from wtforms import StringField, PasswordField, DecimalField, IntegerField, SelectField, RadioField, FormField, FieldList, BooleanField
+from wtforms.validators import InputRequired, Optional, Length, ValidationError, NumberRange
 from flask import Markup
 
 def bot_field_validator(form, field):
     if len(field.data) != 0:
         raise ValidationError("You're a bot!")
 
+def positive_validator(form, field):
+    if field.data is not None and field.data <= 0:
+        raise ValidationError("Must be greater than zero")
+
 class LoginForm(FlaskForm):
     username = StringField("Username", validators=[InputRequired(), Length(1, 50)])
     password = PasswordField("Password", validators=[InputRequired(), Length(8, 50)])
@@ -38,11 +42,43 @@ class ReactionForm(FlaskForm):
 class PlotForm(FlaskForm):
     beam_energy = DecimalField("Beam Energy (MeV)", validators=[InputRequired()])
     sps_angle = DecimalField("SPS Angle (deg)", validators=[InputRequired()])
-    b_field = DecimalField("B-Field (kG)", validators=[InputRequired()])
+    b_field = DecimalField("B-Field (kG)", validators=[InputRequired(), positive_validator])
     rho_min = DecimalField(Markup("&rho; Min (cm)"), validators=[InputRequired()])
     rho_max = DecimalField(Markup("&rho; Max (cm)"), validators=[InputRequired()])
+    ex_min = DecimalField("Ex Min (MeV)", validators=[Optional()])
+    ex_max = DecimalField("Ex Max (MeV)", validators=[Optional()])
+    show_widths = BooleanField("Show Peak Widths")
+    beam_spread = DecimalField("Beam Spread (FWHM %)", validators=[Optional(), NumberRange(0, 100)])
+    acceptance = DecimalField("Acceptance (deg)", validators=[Optional(), NumberRange(0, 90)])
+    overlap_window = DecimalField("Overlap Window (cm)", validators=[Optional(), NumberRange(0, 10)])
     buttons = RadioField(choices=[("E", "Show Excitation (MeV)"), ("K", "Show Ejectile KE (MeV)"), ("Z", "Show Z-Offset (cm)")], validators=[InputRequired()])
 
 class LevelForm(FlaskForm):
     rxn_id = SelectField("Reaction", coerce=int, validators=[InputRequired()])
-    excitation = DecimalField("Excitation", validators=[InputRequired()])
\ No newline at end of file
+    excitation = DecimalField("Excitation", validators=[InputRequired()])
+
+class ScanForm(FlaskForm):
+    beam_energy_min = DecimalField("Beam Energy Min (MeV)", validators=[InputRequired()])
+    beam_energy_max = DecimalField("Beam Energy Max (MeV)", validators=[InputRequired()])
+    beam_energy_steps = IntegerField("Beam Energy Steps", validators=[InputRequired(), NumberRange(1, 100)], default=1)
+    sps_angle_min = DecimalField("SPS Angle Min (deg)", validators=[InputRequired()])
+    sps_angle_max = DecimalField("SPS Angle Max (deg)", validators=[InputRequired()])
+    sps_angle_steps = IntegerField("SPS Angle Steps", validators=[InputRequired(), NumberRange(1, 100)], default=1)
+    b_field_min = DecimalField("B-Field Min (kG)", validators=[InputRequired(), positive_validator])
+    b_field_max = DecimalField("B-Field Max (kG)", validators=[InputRequired(), positive_validator])
+    b_field_steps = IntegerField("B-Field Steps", validators=[InputRequired(), NumberRange(1, 1000)], default=1)
+
+class LevelWindowForm(FlaskForm):
+    rxn_id = SelectField("Reaction", coerce=int, validators=[Optional()])
+    ex_min = DecimalField("Ex Min (MeV)", validators=[Optional()])
+    ex_max = DecimalField("Ex Max (MeV)", validators=[Optional()])
+
+class OptimizeForm(FlaskForm):
+    beam_energy = DecimalField("Beam Energy (MeV)", validators=[InputRequired()])
+    sps_angle = DecimalField("SPS Angle (deg)", validators=[InputRequired()])
+    rho_min = DecimalField(Markup("&rho; Min (cm)"), validators=[InputRequired()])
+    rho_max = DecimalField(Markup("&rho; Max (cm)"), validators=[InputRequired()])
+    optimize_angle = BooleanField("Optimize Angle")
+    angle_min = DecimalField("Angle Min (deg)", validators=[Optional()])
+    angle_max = DecimalField("Angle Max (deg)", validators=[Optional()])
+    windows = FieldList(FormField(LevelWindowForm), min_entries=3, max_entries=3)
\ No newline at end of file
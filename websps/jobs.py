@@ -0,0 +1,185 @@
+from flask import Flask, current_app
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from time import monotonic
+from typing import Any, Callable, Deque, Dict, List, Optional
+import uuid
+
+#Local background job queue for heavy computations (large plots, setting scans), so that they do not hold a web server
+#worker, or run into its timeout, for their whole run. Submitting returns at once; the job runs on a small thread pool
+#in the app process with its own app context, and reports its progress for polling. Heavy numerical work in a job can
+#still be handed on to the process pool (workers.py).
+#Each user may have JOB_MAX_RUNNING_PER_USER jobs running at once (the others wait in the user's queue) and at most
+#JOB_MAX_ACTIVE_PER_USER queued or running. Jobs live in memory and are dropped JOB_RESULT_TTL after they finish, so a
+#server with several processes must send all of a user's requests to the same process
+
+JOB_QUEUED: str = "queued"
+JOB_RUNNING: str = "running"
+JOB_DONE: str = "done"
+JOB_FAILED: str = "failed"
+JOB_CANCELLED: str = "cancelled"
+
+#Raised by Job.report in a job that was cancelled, to stop it at the next progress report
+class JobCancelled(Exception):
+    pass
+
+#The user already has JOB_MAX_ACTIVE_PER_USER jobs queued or running
+class JobLimitError(Exception):
+    pass
+
+@dataclass
+class Job:
+    id: str
+    userID: int
+    kind: str #i.e. "plot", "scan"
+    fn: Callable[["Job"], Any] #run with the job as its argument, inside an app context; returns the result
+    app: Flask
+    status: str = JOB_QUEUED
+    progress: float = 0.0 #fraction of the work done
+    message: str = ""
+    submitted: float = field(default_factory=monotonic)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    result: Any = None
+    error: Optional[str] = None
+    cancelEvent: Event = field(default_factory=Event)
+
+    #Report progress from inside the job; raises JobCancelled if the job was cancelled
+    def report(self, progress: float, message: str = "") -> None:
+        if self.cancelEvent.is_set():
+            raise JobCancelled()
+        self.progress = progress
+        self.message = message
+
+    def is_finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        now = monotonic()
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "error": self.error,
+            "queued_seconds": (self.started if self.started is not None else (self.finished if self.finished is not None else now)) - self.submitted,
+            "run_seconds": None if self.started is None else (self.finished if self.finished is not None else now) - self.started
+        }
+
+class JobScheduler:
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.jobs: Dict[str, Job] = {}
+        self.pending: Dict[int, Deque[Job]] = {} #user id -> jobs waiting for one of the user's running slots
+        self.running: Dict[int, int] = {} #user id -> jobs started (or handed to the executor)
+        self.lock = Lock()
+
+    #Queue fn(job) for the user. Must be called inside an app context; the job runs in a context of the same app
+    def submit(self, userID: int, kind: str, fn: Callable[[Job], Any]) -> Job:
+        app: Flask = current_app._get_current_object()
+        with self.lock:
+            self.expire(app.config.get("JOB_RESULT_TTL", 3600.0))
+            active = len(self.pending.get(userID, ())) + self.running.get(userID, 0)
+            limit = app.config.get("JOB_MAX_ACTIVE_PER_USER", 4)
+            if active >= limit:
+                raise JobLimitError(f"There are already {active} jobs queued or running, the most allowed is {limit}")
+            job = Job(uuid.uuid4().hex, userID, kind, fn, app)
+            self.jobs[job.id] = job
+            self.pending.setdefault(userID, deque()).append(job)
+            self.dispatch(userID)
+        return job
+
+    def get(self, id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(id)
+
+    def get_user_jobs(self, userID: int) -> List[Job]:
+        with self.lock:
+            return sorted((job for job in self.jobs.values() if job.userID == userID), key=lambda job: job.submitted)
+
+    #Queued jobs are cancelled at once; running jobs stop at their next progress report
+    def cancel(self, id: str) -> Optional[Job]:
+        with self.lock:
+            job = self.jobs.get(id)
+            if job is None or job.is_finished():
+                return job
+            job.cancelEvent.set()
+            queue = self.pending.get(job.userID)
+            if queue is not None and job in queue:
+                queue.remove(job)
+                self.finish(job, JOB_CANCELLED)
+            return job
+
+    #Start the user's queued jobs while they have free running slots. Must be called with the lock held
+    def dispatch(self, userID: int) -> None:
+        queue = self.pending.get(userID)
+        while queue and self.running.get(userID, 0) < queue[0].app.config.get("JOB_MAX_RUNNING_PER_USER", 1):
+            job = queue.popleft()
+            self.running[userID] = self.running.get(userID, 0) + 1
+            self.executor.submit(self.run, job)
+        if queue is not None and len(queue) == 0:
+            del self.pending[userID]
+
+    def run(self, job: Job) -> None:
+        status = JOB_CANCELLED
+        try:
+            if not job.cancelEvent.is_set():
+                job.status = JOB_RUNNING
+                job.started = monotonic()
+                with job.app.app_context():
+                    job.result = job.fn(job)
+                status = JOB_DONE
+        except JobCancelled:
+            status = JOB_CANCELLED
+        except Exception as error:
+            job.app.logger.exception(f"Job {job.id} ({job.kind}) failed")
+            job.error = str(error)
+            status = JOB_FAILED
+        finally:
+            with self.lock:
+                self.running[job.userID] -= 1
+                if self.running[job.userID] == 0:
+                    del self.running[job.userID]
+                self.finish(job, status)
+                self.dispatch(job.userID)
+
+    def finish(self, job: Job, status: str) -> None:
+        job.status = status
+        job.finished = monotonic()
+        if status == JOB_DONE:
+            job.progress = 1.0
+        else:
+            job.result = None
+
+    #Drop jobs that finished more than ttl seconds ago. Must be called with the lock held
+    def expire(self, ttl: float) -> None:
+        now = monotonic()
+        for id in [id for id, job in self.jobs.items() if job.finished is not None and now - job.finished > ttl]:
+            del self.jobs[id]
+
+    def shutdown(self) -> None:
+        with self.lock:
+            for job in self.jobs.values():
+                job.cancelEvent.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+_scheduler: Optional[JobScheduler] = None
+_scheduler_lock = Lock()
+
+#Get the process-wide job scheduler, started on first use with JOB_WORKERS threads
+def get_scheduler() -> JobScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(current_app.config.get("JOB_WORKERS", 2))
+        return _scheduler
+
+def shutdown_scheduler() -> None:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.shutdown()
+            _scheduler = None
@@ -0,0 +1,22 @@
+import importlib
+from types import ModuleType
+from typing import Any, Optional
+
+#Module proxy which imports the real module on first attribute access, so that heavy dependencies (pycatima, requests,
+#lxml) are only loaded by the requests which use them. Attributes are looked up on the real module on every access,
+#so patches made to the real module (see metrics.install_dedx_counter) are seen through the proxy
+class LazyModule(ModuleType):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module: Optional[ModuleType] = None
+
+    def load(self) -> ModuleType:
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.load(), name)
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
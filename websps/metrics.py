@@ -0,0 +1,197 @@
+import functools
+import time
+import threading
+import sys
+import numpy as np
+from flask import Flask, g, request
+from sqlalchemy import event
+from typing import Any, Callable, Dict, Optional
+
+#Lightweight in-process instrumentation: timing spans, counters and histograms, aggregated over all requests
+#Everything is a no-op unless the app is created with METRICS_ENABLED, and the disabled cost is a single flag check
+#Note that work done in the process pool (workers.py) is not seen by these metrics
+
+SPAN_BUCKETS: np.ndarray = np.logspace(-5, 2, 15) #s, upper bucket edges (10 us -> 100 s)
+COUNT_BUCKETS: np.ndarray = np.logspace(0, 7, 8) #upper bucket edges (1 -> 1e7)
+
+_enabled: bool = False
+
+class Histogram:
+    def __init__(self, buckets: np.ndarray):
+        self.buckets = buckets
+        self.counts = np.zeros(len(buckets) + 1, dtype=np.int64) #last entry is the overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count != 0 else 0.0,
+            "max": self.max,
+            "buckets": [{"le": float(edge), "count": int(count)} for edge, count in zip(self.buckets, self.counts)] + [{"le": "inf", "count": int(self.counts[-1])}]
+        }
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = {}
+        self.spans: Dict[str, Histogram] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_span(self, name: str, duration: float) -> None:
+        with self.lock:
+            histogram = self.spans.get(name)
+            if histogram is None:
+                histogram = Histogram(SPAN_BUCKETS)
+                self.spans[name] = histogram
+            histogram.record(duration)
+
+    def record_value(self, name: str, value: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(COUNT_BUCKETS)
+                self.histograms[name] = histogram
+            histogram.record(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "enabled": _enabled,
+                "counters": dict(self.counters),
+                "spans": {name: histogram.to_dict() for name, histogram in self.spans.items()},
+                "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+            }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.spans.clear()
+            self.histograms.clear()
+
+registry = MetricsRegistry()
+
+#Per thread (i.e. per request) counts, folded into the registry at the end of each request
+_local = threading.local()
+
+def is_enabled() -> bool:
+    return _enabled
+
+def increment(name: str, amount: int = 1) -> None:
+    if _enabled:
+        registry.increment(name, amount)
+
+class Span:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> bool:
+        registry.record_span(self.name, time.perf_counter() - self.start)
+        return False
+
+class NullSpan:
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, *args: Any) -> bool:
+        return False
+
+_null_span = NullSpan()
+
+#Time a block: with span("name"): ...
+def span(name: str):
+    if not _enabled:
+        return _null_span
+    return Span(name)
+
+#Time every call of the decorated function
+def timed(name: str) -> Callable:
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                registry.record_span(name, time.perf_counter() - start)
+        return wrapped
+    return decorator
+
+#Count catima.dedx calls by wrapping the module function; the physics modules look it up on every call
+def install_dedx_counter() -> None:
+    import pycatima
+    if getattr(pycatima.dedx, "websps_counted", False):
+        return
+    dedx = pycatima.dedx
+    def counted_dedx(*args, **kwargs):
+        _local.dedx_calls = getattr(_local, "dedx_calls", 0) + 1
+        return dedx(*args, **kwargs)
+    counted_dedx.websps_counted = True
+    counted_dedx.wrapped = dedx
+    pycatima.dedx = counted_dedx
+
+def uninstall_dedx_counter() -> None:
+    pycatima = sys.modules.get("pycatima") #nothing to undo if catima was never imported
+    if pycatima is None:
+        return
+    wrapped = getattr(pycatima.dedx, "wrapped", None)
+    if wrapped is not None:
+        pycatima.dedx = wrapped
+
+def before_request() -> None:
+    _local.dedx_calls = 0
+    _local.sql_statements = 0
+    g.metrics_start = time.perf_counter()
+
+def after_request(response: Any) -> Any:
+    start: Optional[float] = g.pop("metrics_start", None)
+    if start is not None:
+        registry.record_span(f"request.{request.endpoint}", time.perf_counter() - start)
+        dedxCalls = getattr(_local, "dedx_calls", 0)
+        sqlStatements = getattr(_local, "sql_statements", 0)
+        registry.increment("catima.dedx", dedxCalls)
+        registry.increment("sqlalchemy.statements", sqlStatements)
+        registry.increment("requests")
+        registry.record_value("request.catima.dedx", dedxCalls)
+        registry.record_value("request.sqlalchemy.statements", sqlStatements)
+    return response
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    context.metrics_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    _local.sql_statements = getattr(_local, "sql_statements", 0) + 1
+    registry.record_span("sqlalchemy.execute", time.perf_counter() - context.metrics_start)
+
+def init_app(app: Flask) -> None:
+    global _enabled
+    _enabled = bool(app.config.get("METRICS_ENABLED", False))
+    if not _enabled:
+        uninstall_dedx_counter()
+        return
+    install_dedx_counter()
+    app.before_request(before_request)
+    app.after_request(after_request)
+    from .db import db
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
@@ -0,0 +1,93 @@
+from flask import Flask, current_app
+from sqlalchemy import select, insert, delete
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from datetime import datetime
+from typing import Optional, List, Set, Dict, Iterable
+import numpy as np
+
+from .db import db, LevelScheme, NNDCLevel, LEVEL_SCHEME_PENDING, LEVEL_SCHEME_READY, LEVEL_SCHEME_FAILED
+from .NucleusData import get_excitations, NNDC_URL
+
+#NNDC level schemes are fetched once per residual nucleus and shared by all users through the level_scheme and
+#nndc_level tables. Fetches run on a background thread pool so that saving a reaction never waits on the NNDC.
+#Reactions find their levels through their residual nucleus, so they pick up the levels as soon as the fetch completes
+
+_executor: Optional[ThreadPoolExecutor] = None
+_in_flight: Set[int] = set()
+_lock = Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config.get("NNDC_FETCH_WORKERS", 2), thread_name_prefix="nndc")
+        return _executor
+
+#Fetch a level scheme from the NNDC and publish it to the store
+def fetch_level_scheme(id: int) -> None:
+    scheme: Optional[LevelScheme] = db.session.get(LevelScheme, id)
+    if scheme is None:
+        scheme = LevelScheme(nucleus_id=id, status=LEVEL_SCHEME_PENDING)
+        db.session.add(scheme)
+        db.session.flush()
+    try:
+        levels = get_excitations(id, current_app.config.get("NNDC_URL", NNDC_URL))
+    except Exception:
+        current_app.logger.exception(f"Failed to fetch NNDC levels for nucleus {id}")
+        scheme.status = LEVEL_SCHEME_FAILED
+        db.session.commit()
+        return
+    db.session.execute(delete(NNDCLevel).where(NNDCLevel.nucleus_id == id))
+    if len(levels) != 0:
+        db.session.execute(insert(NNDCLevel), [{"nucleus_id": id, "excitation": ex} for ex in levels])
+    scheme.status = LEVEL_SCHEME_READY
+    scheme.date_fetched = datetime.now()
+    db.session.commit()
+
+def _run_fetch(app: Flask, id: int) -> None:
+    try:
+        with app.app_context():
+            fetch_level_scheme(id)
+    finally:
+        with _lock:
+            _in_flight.discard(id)
+
+#Make sure the NNDC levels for a residual nucleus are in the store. Returns True if they are available, otherwise a
+#fetch is queued (or run inline if NNDC_FETCH_ASYNC is False) and the levels become available when it completes
+def request_level_scheme(id: int) -> bool:
+    scheme: Optional[LevelScheme] = db.session.get(LevelScheme, id)
+    if scheme is not None and scheme.status == LEVEL_SCHEME_READY:
+        return True
+
+    if scheme is None:
+        db.session.add(LevelScheme(nucleus_id=id, status=LEVEL_SCHEME_PENDING))
+    else:
+        scheme.status = LEVEL_SCHEME_PENDING
+    db.session.commit()
+
+    if not current_app.config.get("NNDC_FETCH_ASYNC", True):
+        fetch_level_scheme(id)
+        scheme = db.session.get(LevelScheme, id)
+        return scheme.status == LEVEL_SCHEME_READY
+
+    with _lock:
+        if id in _in_flight:
+            return False
+        _in_flight.add(id)
+    get_executor().submit(_run_fetch, current_app._get_current_object(), id)
+    return False
+
+#NNDC levels (MeV, sorted) of each of the given residual nuclei, optionally only those within [exMin, exMax]
+#Nuclei without a level scheme (i.e. still being fetched) have no levels
+def get_nndc_levels(ids: Iterable[int], exMin: Optional[float] = None, exMax: Optional[float] = None) -> Dict[int, np.ndarray]:
+    ids = set(ids)
+    query = select(NNDCLevel.nucleus_id, NNDCLevel.excitation).where(NNDCLevel.nucleus_id.in_(ids))
+    if exMin is not None:
+        query = query.where(NNDCLevel.excitation >= exMin)
+    if exMax is not None:
+        query = query.where(NNDCLevel.excitation <= exMax)
+    levels: Dict[int, List[float]] = {id: [] for id in ids}
+    for nucleus_id, excitation in db.session.execute(query.order_by(NNDCLevel.nucleus_id, NNDCLevel.excitation)):
+        levels[nucleus_id].append(excitation)
+    return {id: np.array(exs, dtype=float) for id, exs in levels.items()}
@@ -0,0 +1,99 @@
+from flask import Flask, current_app, g, request
+from sqlalchemy import select, event
+from sqlalchemy.orm import joinedload, selectinload
+from contextlib import contextmanager
+from threading import local
+from typing import List, Optional, Tuple, Iterator
+
+from .db import db, User, ReactionData, TargetMaterial
+
+#Loaders for the spsplot and admin views. Each one eager loads everything its view touches (joined for many-to-one,
+#selectin for collections), so that a view runs the same number of statements however many reactions, levels and
+#target materials a user has. Target layers and their components are always selectin loaded (see db.py)
+
+#Everything a reaction needs for plotting and for the reaction tables
+def get_reaction_options() -> Tuple:
+    return (joinedload(ReactionData.target_material), joinedload(ReactionData.level_scheme), selectinload(ReactionData.user_levels))
+
+def get_user_reactions(userID: int) -> List[ReactionData]:
+    query = select(ReactionData).options(*get_reaction_options()).where(ReactionData.user_id == userID).order_by(ReactionData.id)
+    return list(db.session.execute(query).unique().scalars())
+
+#A user with all of their target materials, reactions and levels, for the overview pages (spsplot index, admin inspect)
+def get_user_overview(userID: int) -> Optional[User]:
+    query = select(User).options(
+        selectinload(User.target_materials),
+        selectinload(User.reactions).options(joinedload(ReactionData.target_material), joinedload(ReactionData.level_scheme)),
+        selectinload(User.levels)
+    ).where(User.id == userID)
+    return db.session.execute(query).scalar()
+
+#A reaction with its four nuclei, for the reaction form
+def get_reaction_with_nuclei(id: int) -> Optional[ReactionData]:
+    return db.session.get(ReactionData, id, options=[
+        joinedload(ReactionData.target_nucleus),
+        joinedload(ReactionData.projectile_nucleus),
+        joinedload(ReactionData.ejectile_nucleus),
+        joinedload(ReactionData.residual_nucleus)
+    ])
+
+#(id, name) of the user's target materials, for select fields
+def get_target_material_choices(userID: int) -> List[Tuple[int, str]]:
+    return [tuple(row) for row in db.session.execute(select(TargetMaterial.id, TargetMaterial.mat_name).where(TargetMaterial.user_id == userID).order_by(TargetMaterial.id))]
+
+#(id, symbol) of the user's reactions, for select fields
+def get_reaction_choices(userID: int) -> List[Tuple[int, str]]:
+    return [tuple(row) for row in db.session.execute(select(ReactionData.id, ReactionData.rxn_symbol).where(ReactionData.user_id == userID).order_by(ReactionData.id))]
+
+#Statement counting. With SQL_STATEMENT_LIMIT set (i.e. in tests) every request asserts that it ran at most that many
+#statements, which catches lazy loads creeping back into the views
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+_local = local()
+
+def get_active_counters() -> List[StatementCounter]:
+    counters = getattr(_local, "counters", None)
+    if counters is None:
+        counters = []
+        _local.counters = counters
+    return counters
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    for counter in get_active_counters():
+        counter.count += 1
+
+#Count the statements run by this thread inside the block. Requires an app context
+@contextmanager
+def count_statements() -> Iterator[StatementCounter]:
+    if not event.contains(db.engine, "after_cursor_execute", after_cursor_execute):
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
+    counter = StatementCounter()
+    get_active_counters().append(counter)
+    try:
+        yield counter
+    finally:
+        get_active_counters().remove(counter)
+
+def before_request() -> None:
+    g.sql_statement_counter = StatementCounter()
+    get_active_counters().append(g.sql_statement_counter)
+
+def after_request(response):
+    counter: Optional[StatementCounter] = g.pop("sql_statement_counter", None)
+    if counter is None:
+        return response
+    get_active_counters().remove(counter)
+    limit = current_app.config.get("SQL_STATEMENT_LIMIT")
+    if counter.count > limit:
+        raise AssertionError(f"{request.endpoint} ran {counter.count} SQL statements, more than SQL_STATEMENT_LIMIT={limit}")
+    return response
+
+def init_app(app: Flask) -> None:
+    if app.config.get("SQL_STATEMENT_LIMIT") is None:
+        return
+    app.before_request(before_request)
+    app.after_request(after_request)
+    with app.app_context():
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
@@ -1,21 +1,35 @@
-from flask import g, Blueprint, flash, redirect, render_template, url_for, Response, request, Markup
+from flask import g, Blueprint, flash, redirect, render_template, url_for, Response, request, Markup, current_app, jsonify, send_file
 from sqlalchemy import select
-from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import abort
 
-from typing import Union, Optional, List, Tuple
+from typing import Union, Optional, List, Tuple, Dict, Any, Iterable, TextIO, Callable
+import click
+import csv
 import json
-from matplotlib.figure import Figure
-from io import BytesIO
+import hashlib
+import numpy as np
+from dataclasses import dataclass, replace
+from io import BytesIO, TextIOWrapper
+from concurrent.futures import Executor
+from threading import Lock
 import base64
 from decimal import Decimal
 
 from .auth import login_required
-from .db import db, get_nucleus_id, User, Nucleus, ReactionData, TargetMaterial, Level
-from .NucleusData import get_excitations
-from .SPSReaction import Reaction, RxnParameters
+from .cache import ResultCache
+from .db import db, get_nucleus_id, make_target_layers, User, Nucleus, ReactionData, TargetMaterial, Level
+from .nndc import request_level_scheme, get_nndc_levels
+from .jobs import Job, JobLimitError, JOB_DONE, get_scheduler
+from .SPSReaction import Reaction, RxnParameters, EjectileBatch, calculate_ejectile_chunk
 from .SPSTarget import SPSTarget, TargetLayer
-from .forms import PlotForm, ReactionForm, TargetForm, LevelForm
+from .SPSScan import ScanReaction, ScanResult, run_scan
+from .SPSResolution import ResolutionParameters, estimate_resolution
+from .SPSOverlap import OverlapResult, TooManyOverlapsError, find_overlaps
+from .SPSOptimize import FocusLevels, FieldSolution, optimize_field, optimize_field_and_angle
+from .workers import get_process_pool
+from .metrics import span, timed
+from . import queries
+from .forms import PlotForm, ReactionForm, TargetForm, LevelForm, ScanForm, OptimizeForm
 
 PLOT_EX: str = "E"
 PLOT_KE: str = "K"
@@ -23,58 +37,324 @@ PLOT_Z: str = "Z"
 
 bp = Blueprint("spsplot", __name__, url_prefix="/spsplot")
 
-def generate_plot(beamEnergy: float, spsAngle: float, magneticField: float, rhoMin: float, rhoMax: float, plotType: str) -> str:
+#SPSTargets (and with them their catima materials) are kept per TargetMaterial row and reused across plots
+#Entries are keyed on the row id and checked against the layer compounds and thicknesses
+_target_cache: Dict[int, Tuple[Tuple, SPSTarget]] = {}
 
-    data: User = db.session.execute(select(User).options(joinedload(User.reactions).subqueryload(ReactionData.target_material)).where(User.id == g.user.id)).scalar()
+def get_target_layers_key(mat: TargetMaterial) -> Tuple:
+    return tuple((layer.thickness, tuple((comp.nucleus_id, comp.stoichiometry) for comp in layer.components)) for layer in mat.layers)
 
-    rhos = []
-    exs = []
-    kes = []
-    zs = []
-    rxns = []
-    fig = Figure(figsize=(16,9))
-    axes = fig.subplots()
-    for ir, rxn in enumerate(data.reactions):
-        targetLayers = json.loads(rxn.target_material.compounds)
-        targetThicks = json.loads(rxn.target_material.thicknesses)
-        targetMat = SPSTarget([TargetLayer(layer, float(targetThicks[i])) for i, layer in enumerate(targetLayers) if len(layer) != 0])
-        reaction = Reaction(
-            RxnParameters(rxn.target_nuc_id, rxn.projectile_nuc_id, rxn.ejectile_nuc_id, rxn.residual_nuc_id, beamEnergy, magneticField, spsAngle), 
-            targetMat
-        )
-        nndc_excitations = json.loads(rxn.nndc_levels)
-        user_excitations = [level.excitation for level in rxn.user_levels]
-        excitations = nndc_excitations + user_excitations
-        for ex in excitations:
-            ke = reaction.calculate_ejectile_KE(ex)
-            rho = reaction.convert_ejectile_KE_2_rho(ke)
-            z = reaction.calculate_focal_plane_offset(ke)
-            exs.append(ex)
-            rxns.append(ir+1)
-            kes.append(ke)
-            rhos.append(rho)
-            zs.append(z)
-    axes.plot(rhos, rxns, marker="o", linestyle="None")
-
-    for i, y in enumerate(rxns):
-        x = rhos[i]
-        if plotType == PLOT_KE:
-            axes.annotate(f"{kes[i]:.2f}", (x,y), textcoords="offset points", xytext=(0,10), ha="center", rotation="vertical")
-        elif plotType == PLOT_Z:
-            axes.annotate(f"{zs[i]:.2f}", (x,y), textcoords="offset points", xytext=(0,10), ha="center", rotation="vertical")
+def get_target(mat: TargetMaterial) -> SPSTarget:
+    key = get_target_layers_key(mat)
+    entry = _target_cache.get(mat.id)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    targetMat = SPSTarget([TargetLayer([[nucleus, s] for nucleus, s in compound], thickness) for thickness, compound in key if len(compound) != 0], mat.mat_name)
+    _target_cache[mat.id] = (key, targetMat)
+    return targetMat
+
+def invalidate_target(id: int) -> None:
+    _target_cache.pop(id, None)
+
+#Computed kinematics for every (reaction, level) point of a plot
+@dataclass
+class PlotData:
+    rxns: np.ndarray #reaction index (1 based), used as the plot y-value
+    exs: np.ndarray #MeV
+    kes: np.ndarray #MeV
+    rhos: np.ndarray #cm
+    zs: np.ndarray #cm
+    labels: List[str] #latex reaction symbols, in reaction index order
+
+    def nbytes(self) -> int:
+        return self.rxns.nbytes + self.exs.nbytes + self.kes.nbytes + self.rhos.nbytes + self.zs.nbytes + sum(len(label) for label in self.labels)
+
+#Computed kinematics of a reaction are memoized per reaction on the physics inputs (see ReactionPoints), so re-plotting
+#with a new rho window or annotation is free, and changing one reaction, target or level only recomputes what changed
+_plot_cache: Optional[ResultCache] = None
+
+def get_plot_cache() -> ResultCache:
+    global _plot_cache
+    if _plot_cache is None:
+        _plot_cache = ResultCache(current_app.config.get("PLOT_CACHE_MAX_ENTRIES", 1024), current_app.config.get("PLOT_CACHE_TTL", 3600.0), current_app.config.get("PLOT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    return _plot_cache
+
+#NNDC levels only change when the level scheme is (re)fetched
+def get_level_scheme_version(rxn: ReactionData) -> Optional[str]:
+    scheme = rxn.level_scheme
+    if scheme is None or scheme.date_fetched is None:
+        return None
+    return scheme.date_fetched.isoformat()
+
+#Fingerprint of everything in a set of reactions that goes into the plot: nuclei, target materials and levels
+def get_reactions_fingerprint(reactions: List[ReactionData]) -> str:
+    hasher = hashlib.sha1()
+    for rxn in reactions:
+        hasher.update(json.dumps([
+            rxn.id, rxn.latex_rxn_symbol, rxn.target_nuc_id, rxn.projectile_nuc_id, rxn.ejectile_nuc_id, rxn.residual_nuc_id,
+            get_target_layers_key(rxn.target_material), get_level_scheme_version(rxn), [level.excitation for level in rxn.user_levels]
+        ]).encode("utf-8"))
+    return hasher.hexdigest()
+
+def build_reaction(rxn: ReactionData, beamEnergy: float, spsAngle: float, magneticField: float) -> Reaction:
+    return Reaction(
+        RxnParameters(rxn.target_nuc_id, rxn.projectile_nuc_id, rxn.ejectile_nuc_id, rxn.residual_nuc_id, beamEnergy, magneticField, spsAngle), 
+        get_target(rxn.target_material)
+    )
+
+#Hand (reaction, chunk of levels) work units to the executor. Workers receive only plain data (RxnParameters,
+#TargetLayers and excitations); the batches are returned per reaction, in level order
+def calculate_batches_parallel(reactions: List[ReactionData], excitationSets: List[np.ndarray], beamEnergy: float, spsAngle: float, magneticField: float, executor: Executor, chunkSize: int) -> List[List[EjectileBatch]]:
+    futures = []
+    for rxn, excitations in zip(reactions, excitationSets):
+        params = RxnParameters(rxn.target_nuc_id, rxn.projectile_nuc_id, rxn.ejectile_nuc_id, rxn.residual_nuc_id, beamEnergy, magneticField, spsAngle)
+        layers = get_target(rxn.target_material).layer_details
+        futures.append([executor.submit(calculate_ejectile_chunk, params, layers, excitations[i:i+chunkSize]) for i in range(0, len(excitations), chunkSize)])
+    return [[future.result() for future in rxnFutures] for rxnFutures in futures]
+
+#Large plots are spread over the process pool; below PLOT_PARALLEL_MIN_LEVELS the vectorized serial path is faster than
+#handing the work to other processes
+def get_plot_executor(excitationSets: List[np.ndarray]) -> Optional[Executor]:
+    nLevels = sum(len(excitations) for excitations in excitationSets)
+    if nLevels < current_app.config.get("PLOT_PARALLEL_MIN_LEVELS", 200_000):
+        return None
+    return get_process_pool()
+
+#Computed kinematics of one reaction for a plot. The NNDC levels are computed together; user levels are kept with their
+#level ids (ascending), so that when the user's levels change only the added or changed ones need to be computed
+@dataclass
+class ReactionPoints:
+    nndc: EjectileBatch
+    levelIDs: np.ndarray
+    levels: EjectileBatch
+
+    def nbytes(self) -> int:
+        return self.levelIDs.nbytes + sum(batch.excitations.nbytes + batch.energies.nbytes + batch.rhos.nbytes + batch.offsets.nbytes + batch.valid.nbytes for batch in (self.nndc, self.levels))
+
+#Everything but the user levels that goes into the kinematics of a reaction. The target is keyed on its layers, which
+#serve as its revision: editing a target gives its reactions new keys. The reaction and target ids come first so that
+#the entries of a reaction or target can be dropped when it is changed or deleted
+def get_reaction_points_key(rxn: ReactionData, beamEnergy: float, spsAngle: float, magneticField: float, exMin: Optional[float], exMax: Optional[float]) -> Tuple:
+    return ("rxn", rxn.id, rxn.target_mat_id, rxn.target_nuc_id, rxn.projectile_nuc_id, rxn.ejectile_nuc_id, rxn.residual_nuc_id,
+            get_target_layers_key(rxn.target_material), get_level_scheme_version(rxn), beamEnergy, spsAngle, magneticField, exMin, exMax)
+
+def invalidate_reaction_points(rxnID: Optional[int] = None, targetID: Optional[int] = None) -> None:
+    get_plot_cache().invalidate_where(lambda key: key[0] == "rxn" and (key[1] == rxnID or key[2] == targetID))
+
+BATCH_FIELDS: Tuple[str, ...] = ("excitations", "energies", "rhos", "offsets", "valid")
+
+def concatenate_batches(batches: List[EjectileBatch]) -> EjectileBatch:
+    if len(batches) == 1:
+        return batches[0]
+    return EjectileBatch(*(np.concatenate([getattr(batch, name) for batch in batches]) for name in BATCH_FIELDS))
+
+def slice_batch(batch: EjectileBatch, start: Optional[int], stop: Optional[int]) -> EjectileBatch:
+    return EjectileBatch(*(getattr(batch, name)[start:stop] for name in BATCH_FIELDS))
+
+#User levels (ids ascending, excitations) of a reaction within [exMin, exMax]
+def get_user_level_window(rxn: ReactionData, exMin: Optional[float], exMax: Optional[float]) -> Tuple[np.ndarray, np.ndarray]:
+    levels = sorted((level.id, level.excitation) for level in rxn.user_levels if (exMin is None or level.excitation >= exMin) and (exMax is None or level.excitation <= exMax))
+    return np.array([id for id, _ in levels], dtype=int), np.array([ex for _, ex in levels], dtype=float)
+
+#Bring the user levels of points up to date with (levelIDs, excitations): results of unchanged levels are reused, and
+#new or changed levels are computed as one batch. Returns points itself if nothing changed
+def update_reaction_points(points: ReactionPoints, rxn: ReactionData, levelIDs: np.ndarray, excitations: np.ndarray, beamEnergy: float, spsAngle: float, magneticField: float) -> ReactionPoints:
+    if len(points.levelIDs) == 0:
+        index = np.zeros(len(levelIDs), dtype=int)
+        known = np.zeros(len(levelIDs), dtype=bool)
+    else:
+        index = np.minimum(np.searchsorted(points.levelIDs, levelIDs), len(points.levelIDs) - 1)
+        known = (points.levelIDs[index] == levelIDs) & (points.levels.excitations[index] == excitations)
+    if np.all(known) and len(levelIDs) == len(points.levelIDs):
+        return points
+    if np.all(known):
+        computed = slice_batch(points.levels, 0, 0)
+    else:
+        computed = build_reaction(rxn, beamEnergy, spsAngle, magneticField).calculate_ejectile_batch(excitations[~known])
+    merged = []
+    for name in BATCH_FIELDS:
+        values = np.empty(len(levelIDs), dtype=getattr(points.levels, name).dtype)
+        values[known] = getattr(points.levels, name)[index[known]]
+        values[~known] = getattr(computed, name)
+        merged.append(values)
+    return ReactionPoints(points.nndc, levelIDs, EjectileBatch(*merged))
+
+def points_to_plot_data(points: List[ReactionPoints], reactions: List[ReactionData]) -> PlotData:
+    batches = [(ir, batch) for ir, rxnPoints in enumerate(points) for batch in (rxnPoints.nndc, rxnPoints.levels)]
+    labels = [rxn.latex_rxn_symbol for rxn in reactions]
+    if len(batches) == 0:
+        return PlotData(np.zeros(0, dtype=int), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), labels)
+    return PlotData(
+        np.concatenate([np.full(np.count_nonzero(batch.valid), ir+1) for ir, batch in batches]),
+        np.concatenate([batch.excitations[batch.valid] for _, batch in batches]),
+        np.concatenate([batch.energies[batch.valid] for _, batch in batches]),
+        np.concatenate([batch.rhos[batch.valid] for _, batch in batches]),
+        np.concatenate([batch.offsets[batch.valid] for _, batch in batches]),
+        labels
+    )
+
+#exMin and exMax (MeV) optionally restrict the plot to the levels in an excitation window
+#Reactions without cached points are computed in full (on the process pool if there are many levels); cached points
+#are reconciled with the reaction's current user levels, so adding a level costs one kinematics evaluation. Checking
+#the levels when plotting, rather than patching the cache in the level endpoints, keeps every worker process correct
+@timed("spsplot.get_plot_data")
+def get_plot_data(reactions: List[ReactionData], beamEnergy: float, spsAngle: float, magneticField: float, exMin: Optional[float] = None, exMax: Optional[float] = None) -> PlotData:
+    cache = get_plot_cache()
+    keys = [get_reaction_points_key(rxn, beamEnergy, spsAngle, magneticField, exMin, exMax) for rxn in reactions]
+    points: List[Optional[ReactionPoints]] = [cache.get(key) for key in keys]
+    levelWindows = [get_user_level_window(rxn, exMin, exMax) for rxn in reactions]
+
+    missing = [i for i, rxnPoints in enumerate(points) if rxnPoints is None]
+    if len(missing) != 0:
+        missingRxns = [reactions[i] for i in missing]
+        nndcLevels = get_nndc_levels([rxn.residual_nuc_id for rxn in missingRxns], exMin, exMax)
+        excitationSets = [np.concatenate((nndcLevels[rxn.residual_nuc_id], levelWindows[i][1])) for i, rxn in zip(missing, missingRxns)]
+        executor = get_plot_executor(excitationSets)
+        if executor is None:
+            batches = [build_reaction(rxn, beamEnergy, spsAngle, magneticField).calculate_ejectile_batch(excitations) for rxn, excitations in zip(missingRxns, excitationSets)]
         else:
-            axes.annotate(f"{exs[i]:.2f}", (x,y), textcoords="offset points", xytext=(0,10), ha="center", rotation="vertical")
+            batches = [concatenate_batches(rxnBatches) for rxnBatches in calculate_batches_parallel(missingRxns, excitationSets, beamEnergy, spsAngle, magneticField, executor, current_app.config.get("PLOT_PARALLEL_CHUNK_SIZE", 50_000))]
+        for i, rxn, batch in zip(missing, missingRxns, batches):
+            nNNDC = len(nndcLevels[rxn.residual_nuc_id])
+            points[i] = ReactionPoints(slice_batch(batch, None, nNNDC), levelWindows[i][0], slice_batch(batch, nNNDC, None))
+            cache.put(keys[i], points[i], points[i].nbytes())
+
+    computed = set(missing)
+    for i, rxn in enumerate(reactions):
+        if i in computed:
+            continue
+        updated = update_reaction_points(points[i], rxn, *levelWindows[i], beamEnergy, spsAngle, magneticField)
+        if updated is not points[i]:
+            points[i] = updated
+            cache.put(keys[i], updated, updated.nbytes())
+    return points_to_plot_data(points, reactions)
+
+#Resolution settings from the (optional) beam spread (FWHM %), acceptance (deg) and events per level of a request
+def get_resolution_parameters(beamSpread: Optional[float], acceptance: Optional[float], events: Optional[int]) -> ResolutionParameters:
+    config = current_app.config
+    params = ResolutionParameters(seed=0)
+    if beamSpread is not None:
+        params.beamSpread = beamSpread * 0.01
+    if acceptance is not None:
+        params.acceptance = acceptance
+    params.events = max(min(events if events is not None else config.get("RESOLUTION_EVENTS", 10_000), config.get("RESOLUTION_MAX_EVENTS", 100_000)), 100)
+    return params
+
+#Peak widths (cm FWHM) of every point of a PlotData, memoized with the plot data
+#The events per level are reduced so that at most RESOLUTION_EVENT_BUDGET events are sampled for the whole plot
+@timed("spsplot.get_plot_widths")
+def get_plot_widths(reactions: List[ReactionData], plotData: PlotData, beamEnergy: float, spsAngle: float, magneticField: float, params: ResolutionParameters,
+                    exMin: Optional[float] = None, exMax: Optional[float] = None) -> np.ndarray:
+    params = replace(params, events=max(min(params.events, current_app.config.get("RESOLUTION_EVENT_BUDGET", 20_000_000) // max(len(plotData.rhos), 1)), 100))
+    cache = get_plot_cache()
+    key = ("widths", beamEnergy, spsAngle, magneticField, exMin, exMax, params.beamSpread, params.acceptance, params.events, get_reactions_fingerprint(reactions))
+    widths = cache.get(key)
+    if widths is None:
+        widths = np.full(len(plotData.rhos), np.nan)
+        for ir, rxn in enumerate(reactions):
+            mask = plotData.rxns == ir+1
+            if np.any(mask):
+                widths[mask] = estimate_resolution(build_reaction(rxn, beamEnergy, spsAngle, magneticField), plotData.exs[mask], params).widths
+        cache.put(key, widths, widths.nbytes)
+    return widths
+
+@timed("spsplot.get_user_reactions")
+def get_user_reactions() -> List[ReactionData]:
+    return queries.get_user_reactions(g.user.id)
 
-    ylabels = [rxn.latex_rxn_symbol for rxn in data.reactions]
-    ylabels.append("Reactions")
-    axes.set_yticks(range(1,len(data.reactions)+2))
-    axes.set_yticklabels(ylabels)
-    axes.set_xlim(rhoMin, rhoMax)
-    axes.set_xlabel(r"$\rho$ (cm)")
-    fig.tight_layout()
+#Per-reaction arrays of a PlotData, in a JSON friendly layout. Peak widths are included if given (null where unknown)
+def plot_data_to_json(plotData: PlotData, reactions: List[ReactionData], widths: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+    result = []
+    for ir, rxn in enumerate(reactions):
+        mask = plotData.rxns == ir+1
+        entry = {
+            "id": rxn.id,
+            "symbol": rxn.rxn_symbol,
+            "label": rxn.latex_rxn_symbol,
+            "excitations": plotData.exs[mask].tolist(),
+            "energies": plotData.kes[mask].tolist(),
+            "rhos": plotData.rhos[mask].tolist(),
+            "offsets": plotData.zs[mask].tolist()
+        }
+        if widths is not None:
+            entry["widths"] = [None if np.isnan(width) else width for width in widths[mask].tolist()]
+        result.append(entry)
+    return result
+
+#Pairs of points from different reactions within window (cm) of each other on the focal plane, optionally only those
+#within [rhoMin, rhoMax]. With peak widths, points also overlap when they are closer than their average width
+@timed("spsplot.get_plot_overlaps")
+def get_plot_overlaps(plotData: PlotData, window: float, widths: Optional[np.ndarray] = None, rhoMin: Optional[float] = None, rhoMax: Optional[float] = None) -> OverlapResult:
+    rhos = plotData.rhos
+    if rhoMin is not None or rhoMax is not None:
+        rhos = np.where((rhos >= (rhoMin if rhoMin is not None else -np.inf)) & (rhos <= (rhoMax if rhoMax is not None else np.inf)), rhos, np.nan)
+    return find_overlaps(plotData.rxns, rhos, window, widths, current_app.config.get("OVERLAP_MAX_CANDIDATES", 1_000_000))
+
+#Overlapping pairs in a JSON friendly layout, shared by the overlap table and the overlaps endpoint
+def overlaps_to_json(overlaps: OverlapResult, plotData: PlotData, reactions: List[ReactionData], widths: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+    def point(i: int) -> Dict[str, Any]:
+        rxn = reactions[plotData.rxns[i]-1]
+        entry = {"reaction_id": rxn.id, "symbol": rxn.rxn_symbol, "excitation": float(plotData.exs[i]), "energy": float(plotData.kes[i]), "rho": float(plotData.rhos[i])}
+        if widths is not None:
+            entry["width"] = None if np.isnan(widths[i]) else float(widths[i])
+        return entry
+    return [{"first": point(i), "second": point(j), "separation": float(separation)} for i, j, separation in zip(overlaps.first, overlaps.second, overlaps.separations)]
+
+#matplotlib is not thread safe (i.e. its mathtext parser), so figures are drawn one at a time; the kinematics and peak
+#widths of concurrent plots are still calculated in parallel
+_figure_lock = Lock()
+
+@timed("spsplot.generate_plot")
+def generate_plot(beamEnergy: float, spsAngle: float, magneticField: float, rhoMin: float, rhoMax: float, plotType: str, exMin: Optional[float] = None, exMax: Optional[float] = None,
+                  resolution: Optional[ResolutionParameters] = None, progress: Optional[Callable[[float, str], None]] = None) -> str:
+
+    from matplotlib.figure import Figure #matplotlib is only loaded by the first plot (or by the warm-up, see warmup.py)
+
+    reactions = get_user_reactions()
+    plotData = get_plot_data(reactions, beamEnergy, spsAngle, magneticField, exMin, exMax)
+    if progress is not None:
+        progress(0.3, "Calculated kinematics")
+    rhos = plotData.rhos
+    exs = plotData.exs
+    kes = plotData.kes
+    zs = plotData.zs
+    rxns = plotData.rxns
+    widths = None
+    if resolution is not None:
+        widths = get_plot_widths(reactions, plotData, beamEnergy, spsAngle, magneticField, resolution, exMin, exMax)
+        if progress is not None:
+            progress(0.5, "Estimated peak widths")
 
     buffer = BytesIO()
-    fig.savefig(buffer, format="svg")
+    with _figure_lock:
+        fig = Figure(figsize=(16,9))
+        axes = fig.subplots()
+        if widths is None:
+            axes.plot(rhos, rxns, marker="o", linestyle="None")
+        else:
+            axes.errorbar(rhos, rxns, xerr=0.5*np.nan_to_num(widths), marker="o", linestyle="None", capsize=4)
+
+        for i, y in enumerate(rxns):
+            x = rhos[i]
+            if plotType == PLOT_KE:
+                axes.annotate(f"{kes[i]:.2f}", (x,y), textcoords="offset points", xytext=(0,10), ha="center", rotation="vertical")
+            elif plotType == PLOT_Z:
+                axes.annotate(f"{zs[i]:.2f}", (x,y), textcoords="offset points", xytext=(0,10), ha="center", rotation="vertical")
+            else:
+                axes.annotate(f"{exs[i]:.2f}", (x,y), textcoords="offset points", xytext=(0,10), ha="center", rotation="vertical")
+
+        ylabels = list(plotData.labels)
+        ylabels.append("Reactions")
+        axes.set_yticks(range(1,len(ylabels)+1))
+        axes.set_yticklabels(ylabels)
+        axes.set_xlim(rhoMin, rhoMax)
+        axes.set_xlabel(r"$\rho$ (cm)")
+        fig.tight_layout()
+        if progress is not None:
+            progress(0.7, "Drawing the plot")
+
+        with span("spsplot.savefig"):
+            fig.savefig(buffer, format="svg")
     data = base64.b64encode(buffer.getbuffer()).decode("utf-8")
     return data
     
@@ -83,14 +363,471 @@ def generate_plot(beamEnergy: float, spsAngle: float, magneticField: float, rhoM
 @login_required
 def index() -> str:
 
-    user: User = db.session.get(User, g.user.id)
+    user: User = queries.get_user_overview(g.user.id)
     form = PlotForm()
 
     if form.validate_on_submit():
-        return render_template("spsplot/index.html", reactions=user.reactions, target_mats=user.target_materials, levels=user.levels, form=form,
-            plot = generate_plot(float(form.beam_energy.data), float(form.sps_angle.data), float(form.b_field.data), float(form.rho_min.data), float(form.rho_max.data), form.buttons.data)
+        beamEnergy = float(form.beam_energy.data)
+        spsAngle = float(form.sps_angle.data)
+        magneticField = float(form.b_field.data)
+        rhoMin = float(form.rho_min.data)
+        rhoMax = float(form.rho_max.data)
+        exMin = get_optional_float(form.ex_min.data)
+        exMax = get_optional_float(form.ex_max.data)
+        resolution = None
+        if form.show_widths.data:
+            resolution = get_resolution_parameters(get_optional_float(form.beam_spread.data), get_optional_float(form.acceptance.data), None)
+        plot = generate_plot(beamEnergy, spsAngle, magneticField, rhoMin, rhoMax, form.buttons.data, exMin, exMax, resolution)
+
+        #The plot data (and widths) are served from the plot cache here
+        overlaps = None
+        if form.overlap_window.data is not None:
+            reactions = get_user_reactions()
+            plotData = get_plot_data(reactions, beamEnergy, spsAngle, magneticField, exMin, exMax)
+            widths = None if resolution is None else get_plot_widths(reactions, plotData, beamEnergy, spsAngle, magneticField, resolution, exMin, exMax)
+            try:
+                overlaps = overlaps_to_json(get_plot_overlaps(plotData, float(form.overlap_window.data), widths, rhoMin, rhoMax), plotData, reactions, widths)
+            except TooManyOverlapsError:
+                flash("Too many points overlap to list; use a smaller overlap window or excitation range", "error")
+        return render_template("spsplot/index.html", reactions=user.reactions, target_mats=user.target_materials, levels=user.levels, form=form, plot=plot, overlaps=overlaps)
+    return render_template("spsplot/index.html", reactions=user.reactions, target_mats=user.target_materials, levels=user.levels, form=form, plot=None, overlaps=None)
+
+def get_optional_float(value: Optional[Decimal]) -> Optional[float]:
+    return None if value is None else float(value)
+
+def get_float_arg(name: str) -> float:
+    value = request.values.get(name, type=float)
+    if value is None:
+        abort(400, f"Missing or invalid value for {name}")
+    return value
+
+#The B field must be positive: rho scales as 1/B, and a zero field would give infinite rhos (invalid in JSON)
+def get_field_arg(name: str = "b_field") -> float:
+    value = get_float_arg(name)
+    if value <= 0.0:
+        abort(400, f"{name} must be greater than zero")
+    return value
+
+#Read rho values (cm) from the first column of a CSV file; lines that are not numbers (headers, comments) are skipped
+def read_rho_csv(lines: Iterable[str]) -> np.ndarray:
+    rhos = []
+    for row in csv.reader(lines):
+        if len(row) == 0:
+            continue
+        try:
+            rhos.append(float(row[0]))
+        except ValueError:
+            continue
+    return np.array(rhos, dtype=float)
+
+#Convert measured focal plane rhos to excitation energies for one reaction and spectrograph setting
+def calibrate_rhos(rxn: ReactionData, beamEnergy: float, spsAngle: float, magneticField: float, rhos: np.ndarray) -> np.ndarray:
+    return build_reaction(rxn, beamEnergy, spsAngle, magneticField).calculate_excitations(rhos)
+
+#Computed plot data as JSON, for drawing the plot in the browser
+@bp.route("/data", methods=("GET", "POST"))
+@login_required
+def plot_data() -> Response:
+    beamEnergy = get_float_arg("beam_energy")
+    spsAngle = get_float_arg("sps_angle")
+    magneticField = get_field_arg()
+    exMin = request.values.get("ex_min", type=float)
+    exMax = request.values.get("ex_max", type=float)
+    reactions = get_user_reactions()
+    plotData = get_plot_data(reactions, beamEnergy, spsAngle, magneticField, exMin, exMax)
+    widths = None
+    if request.values.get("widths", default=0, type=int) != 0:
+        resolution = get_resolution_parameters(request.values.get("beam_spread", type=float), request.values.get("acceptance", type=float), request.values.get("events", type=int))
+        widths = get_plot_widths(reactions, plotData, beamEnergy, spsAngle, magneticField, resolution, exMin, exMax)
+    return jsonify({
+        "beam_energy": beamEnergy,
+        "sps_angle": spsAngle,
+        "b_field": magneticField,
+        "reactions": plot_data_to_json(plotData, reactions, widths)
+    })
+
+#Overlapping pairs of points from different reactions as JSON. Takes the plot data arguments, the window (cm) and
+#optionally rho_min and rho_max (cm) to only consider the focal plane, and the peak width arguments
+@bp.route("/overlaps", methods=("GET", "POST"))
+@login_required
+def plot_overlaps() -> Response:
+    beamEnergy = get_float_arg("beam_energy")
+    spsAngle = get_float_arg("sps_angle")
+    magneticField = get_field_arg()
+    window = get_float_arg("window")
+    if window < 0.0:
+        abort(400, "The overlap window must not be negative")
+    exMin = request.values.get("ex_min", type=float)
+    exMax = request.values.get("ex_max", type=float)
+    reactions = get_user_reactions()
+    plotData = get_plot_data(reactions, beamEnergy, spsAngle, magneticField, exMin, exMax)
+    widths = None
+    if request.values.get("widths", default=0, type=int) != 0:
+        resolution = get_resolution_parameters(request.values.get("beam_spread", type=float), request.values.get("acceptance", type=float), request.values.get("events", type=int))
+        widths = get_plot_widths(reactions, plotData, beamEnergy, spsAngle, magneticField, resolution, exMin, exMax)
+    try:
+        overlaps = get_plot_overlaps(plotData, window, widths, request.values.get("rho_min", type=float), request.values.get("rho_max", type=float))
+    except TooManyOverlapsError as error:
+        abort(400, str(error))
+    return jsonify({
+        "beam_energy": beamEnergy,
+        "sps_angle": spsAngle,
+        "b_field": magneticField,
+        "window": window,
+        "overlaps": overlaps_to_json(overlaps, plotData, reactions, widths)
+    })
+
+#NaN and infinity are not valid JSON, so non-finite values are given as null
+def finite_to_json(values: np.ndarray) -> List[Optional[float]]:
+    return [value if np.isfinite(value) else None for value in values.tolist()]
+
+#Bulk rho -> excitation conversion. Rhos are given as a JSON body {"beam_energy", "sps_angle", "b_field", "rhos": [...]}
+#or as form fields with an uploaded CSV file named rhos. Unphysical rhos give null excitations, and non-finite rhos are
+#given back as null
+@bp.route("/rxn/<int:id>/calibrate", methods=["POST"])
+@login_required
+def calibrate(id: int) -> Response:
+    rxn = get_rxn(id)
+    if request.is_json:
+        body = request.get_json()
+        try:
+            beamEnergy = float(body["beam_energy"])
+            spsAngle = float(body["sps_angle"])
+            magneticField = float(body["b_field"])
+            rhos = np.array(body["rhos"], dtype=float)
+        except (KeyError, TypeError, ValueError):
+            abort(400, "Calibration requests require beam_energy, sps_angle, b_field and a list of rhos")
+        if rhos.ndim != 1:
+            abort(400, "Calibration requests require a flat list of rhos")
+        if magneticField <= 0.0:
+            abort(400, "b_field must be greater than zero")
+    else:
+        beamEnergy = get_float_arg("beam_energy")
+        spsAngle = get_float_arg("sps_angle")
+        magneticField = get_field_arg()
+        upload = request.files.get("rhos")
+        if upload is None:
+            abort(400, "Calibration requests require a CSV file of rhos")
+        rhos = read_rho_csv(TextIOWrapper(upload.stream, encoding="utf-8"))
+    if not np.all(np.isfinite([beamEnergy, spsAngle, magneticField])):
+        abort(400, "beam_energy, sps_angle and b_field must be finite")
+
+    excitations = calibrate_rhos(rxn, beamEnergy, spsAngle, magneticField, rhos)
+    return jsonify({
+        "reaction": rxn.id,
+        "beam_energy": beamEnergy,
+        "sps_angle": spsAngle,
+        "b_field": magneticField,
+        "rhos": finite_to_json(rhos),
+        "excitations": finite_to_json(excitations)
+    })
+
+@bp.cli.command("calibrate")
+@click.option("--rxn", "rxn_id", type=int, required=True, help="Reaction id")
+@click.option("--beam-energy", type=float, required=True, help="Beam energy (MeV)")
+@click.option("--angle", type=float, required=True, help="SPS angle (deg)")
+@click.option("--field", type=float, required=True, help="B-Field (kG)")
+@click.argument("input", type=click.File("r"))
+@click.option("-o", "--output", type=click.File("w"), default="-", help="Output CSV file (default stdout)")
+def calibrate_command(rxn_id: int, beam_energy: float, angle: float, field: float, input: TextIO, output: TextIO) -> None:
+    #Convert a CSV of measured rhos (cm) to excitation energies (MeV) for a reaction
+    rxn: Optional[ReactionData] = db.session.get(ReactionData, rxn_id)
+    if rxn is None:
+        raise click.BadParameter(f"Reaction {rxn_id} does not exist", param_hint="--rxn")
+    if field <= 0.0:
+        raise click.BadParameter("Must be greater than zero", param_hint="--field")
+    rhos = read_rho_csv(input)
+    excitations = calibrate_rhos(rxn, beam_energy, angle, field, rhos)
+    writer = csv.writer(output)
+    writer.writerow(["rho(cm)", "excitation(MeV)"])
+    for rho, ex in zip(rhos, excitations):
+        writer.writerow([rho, "" if np.isnan(ex) else ex])
+
+#Scan results are kept per user so that they can be downloaded and sliced without recomputing
+_scan_cache: Optional[ResultCache] = None
+
+def get_scan_cache() -> ResultCache:
+    global _scan_cache
+    if _scan_cache is None:
+        _scan_cache = ResultCache(current_app.config.get("SCAN_CACHE_MAX_ENTRIES", 16), current_app.config.get("SCAN_CACHE_TTL", 3600.0), current_app.config.get("SCAN_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    return _scan_cache
+
+#Excitations (NNDC levels, then user levels) of each reaction, optionally only those within [exMin, exMax]
+#The levels are selected in SQL, with one query for the NNDC levels and one for the user levels of all reactions
+def get_reactions_excitations(reactions: List[ReactionData], exMin: Optional[float] = None, exMax: Optional[float] = None) -> List[np.ndarray]:
+    if len(reactions) == 0:
+        return []
+    nndcLevels = get_nndc_levels([rxn.residual_nuc_id for rxn in reactions], exMin, exMax)
+    query = select(Level.reaction_id, Level.excitation).where(Level.reaction_id.in_([rxn.id for rxn in reactions]))
+    if exMin is not None:
+        query = query.where(Level.excitation >= exMin)
+    if exMax is not None:
+        query = query.where(Level.excitation <= exMax)
+    userLevels: Dict[int, List[float]] = {rxn.id: [] for rxn in reactions}
+    for reaction_id, excitation in db.session.execute(query.order_by(Level.id)):
+        userLevels[reaction_id].append(excitation)
+    return [np.concatenate((nndcLevels[rxn.residual_nuc_id], np.array(userLevels[rxn.id], dtype=float))) for rxn in reactions]
+
+def get_scan_reactions(reactions: List[ReactionData]) -> List[ScanReaction]:
+    return [
+        ScanReaction(
+            RxnParameters(rxn.target_nuc_id, rxn.projectile_nuc_id, rxn.ejectile_nuc_id, rxn.residual_nuc_id),
+            get_target(rxn.target_material).layer_details,
+            excitations,
+            rxn.rxn_symbol
         )
-    return render_template("spsplot/index.html", reactions=user.reactions, target_mats=user.target_materials, levels=user.levels, form=form, plot=None)
+        for rxn, excitations in zip(reactions, get_reactions_excitations(reactions))
+    ]
+
+def get_scan(token: str) -> ScanResult:
+    result: Optional[ScanResult] = get_scan_cache().get((g.user.id, token))
+    if result is None:
+        abort(404, "Requested scan does not exist or has expired")
+    return result
+
+def count_scan_points(scanReactions: List[ScanReaction], beamEnergies: np.ndarray, angles: np.ndarray, fields: np.ndarray) -> int:
+    return len(beamEnergies) * len(angles) * len(fields) * sum(len(rxn.excitations) for rxn in scanReactions)
+
+def get_scan_token(reactions: List[ReactionData], beamEnergies: np.ndarray, angles: np.ndarray, fields: np.ndarray) -> str:
+    return hashlib.sha1(json.dumps([beamEnergies.tolist(), angles.tolist(), fields.tolist(), get_reactions_fingerprint(reactions)]).encode("utf-8")).hexdigest()
+
+#Run a scan for the current user and keep it in the scan cache under its token, or get it from the cache
+def get_scan_result(token: str, scanReactions: List[ScanReaction], beamEnergies: np.ndarray, angles: np.ndarray, fields: np.ndarray,
+                    progress: Optional[Callable[[float], None]] = None) -> ScanResult:
+    cache = get_scan_cache()
+    result = cache.get((g.user.id, token))
+    if result is None:
+        #Small scans are faster in process than the cost of handing them to the pool
+        nKinematics = len(beamEnergies) * len(angles) * sum(len(rxn.excitations) for rxn in scanReactions)
+        executor = get_process_pool() if nKinematics >= current_app.config.get("SCAN_PARALLEL_MIN_POINTS", 100_000) else None
+        result = run_scan(scanReactions, beamEnergies, angles, fields, executor, progress)
+        cache.put((g.user.id, token), result, result.nbytes())
+    return result
+
+@bp.route("/scan", methods=("GET", "POST"))
+@login_required
+def scan() -> str:
+    form = ScanForm()
+    result = None
+    token = None
+    if form.validate_on_submit():
+        beamEnergies = np.linspace(float(form.beam_energy_min.data), float(form.beam_energy_max.data), form.beam_energy_steps.data)
+        angles = np.linspace(float(form.sps_angle_min.data), float(form.sps_angle_max.data), form.sps_angle_steps.data)
+        fields = np.linspace(float(form.b_field_min.data), float(form.b_field_max.data), form.b_field_steps.data)
+        reactions = get_user_reactions()
+        scanReactions = get_scan_reactions(reactions)
+        nPoints = count_scan_points(scanReactions, beamEnergies, angles, fields)
+        if nPoints > current_app.config.get("SCAN_MAX_POINTS", 10_000_000):
+            flash(f"Scan is too large ({nPoints} level points); reduce the number of steps", 'error')
+        else:
+            token = get_scan_token(reactions, beamEnergies, angles, fields)
+            result = get_scan_result(token, scanReactions, beamEnergies, angles, fields)
+    return render_template("spsplot/scan.html", form=form, result=result, token=token)
+
+#Full scan result as a compressed numpy archive
+@bp.route("/scan/<token>.npz")
+@login_required
+def download_scan(token: str) -> Response:
+    result = get_scan(token)
+    buffer = BytesIO()
+    np.savez_compressed(buffer, beam_energies=result.beamEnergies, angles=result.angles, fields=result.fields, labels=np.array(result.labels, dtype=str),
+                        level_rxns=result.levelRxns, level_excitations=result.levelExcitations, energies=result.energies, valid=result.valid,
+                        rhos=result.rhos, offsets=result.offsets)
+    buffer.seek(0)
+    return send_file(buffer, mimetype="application/octet-stream", as_attachment=True, download_name="sps_scan.npz")
+
+#One (beam energy, angle, field) point of a scan as JSON
+@bp.route("/scan/<token>/slice")
+@login_required
+def scan_slice(token: str) -> Response:
+    result = get_scan(token)
+    ie = request.args.get("beam_energy_index", 0, type=int)
+    ia = request.args.get("sps_angle_index", 0, type=int)
+    ib = request.args.get("b_field_index", 0, type=int)
+    if not (0 <= ie < len(result.beamEnergies) and 0 <= ia < len(result.angles) and 0 <= ib < len(result.fields)):
+        abort(400, "Scan index out of range")
+    valid = result.valid[ie, ia]
+    return jsonify({
+        "beam_energy": float(result.beamEnergies[ie]),
+        "sps_angle": float(result.angles[ia]),
+        "b_field": float(result.fields[ib]),
+        "levels": [
+            {
+                "reaction": result.labels[result.levelRxns[il]],
+                "excitation": float(result.levelExcitations[il]),
+                "energy": float(result.energies[ie, ia, il]),
+                "rho": float(result.rhos[ie, ia, ib, il]),
+                "offset": float(result.offsets[ie, ia, ib, il])
+            }
+            for il in np.flatnonzero(valid)
+        ]
+    })
+
+#Heavy plots and scans can also be run as background jobs (see jobs.py), so that they do not hold a server worker.
+#Submitting returns the job (202) at once; its status and progress are then polled and the result fetched when done
+JOB_PLOT: str = "plot"
+JOB_SCAN: str = "scan"
+
+def get_int_arg(name: str, minimum: int, maximum: int) -> int:
+    value = request.values.get(name, type=int)
+    if value is None or not minimum <= value <= maximum:
+        abort(400, f"Missing or invalid value for {name}, must be an integer from {minimum} to {maximum}")
+    return value
+
+#Jobs run in an app context of their own, so the user of the submitting request is loaded again
+def set_job_user(job: Job) -> None:
+    g.user = db.session.get(User, job.userID)
+
+def job_to_json(job: Job) -> Dict[str, Any]:
+    entry = job.to_dict()
+    entry["status_url"] = url_for("spsplot.job_status", id=job.id)
+    entry["cancel_url"] = url_for("spsplot.cancel_job", id=job.id)
+    entry["result_url"] = url_for("spsplot.job_result", id=job.id)
+    return entry
+
+def submit_job(kind: str, fn: Callable[[Job], Any]) -> Tuple[Response, int]:
+    try:
+        job = get_scheduler().submit(g.user.id, kind, fn)
+    except JobLimitError as error:
+        abort(429, str(error))
+    return jsonify(job_to_json(job)), 202
+
+def get_job(id: str) -> Job:
+    job = get_scheduler().get(id)
+    if job is None:
+        abort(404, "Requested job does not exist or has expired")
+    if job.userID != g.user.id:
+        abort(403)
+    return job
+
+#Takes the plot data arguments (and peak width arguments), rho_min and rho_max (cm), and plot_type (E, K or Z)
+#The result is the plot as SVG
+@bp.route("/jobs/plot", methods=["POST"])
+@login_required
+def submit_plot_job() -> Tuple[Response, int]:
+    beamEnergy = get_float_arg("beam_energy")
+    spsAngle = get_float_arg("sps_angle")
+    magneticField = get_field_arg()
+    rhoMin = get_float_arg("rho_min")
+    rhoMax = get_float_arg("rho_max")
+    plotType = request.values.get("plot_type", PLOT_EX)
+    if plotType not in (PLOT_EX, PLOT_KE, PLOT_Z):
+        abort(400, f"Invalid plot_type {plotType}, must be one of {PLOT_EX}, {PLOT_KE} or {PLOT_Z}")
+    exMin = request.values.get("ex_min", type=float)
+    exMax = request.values.get("ex_max", type=float)
+    resolution = None
+    if request.values.get("widths", default=0, type=int) != 0:
+        resolution = get_resolution_parameters(request.values.get("beam_spread", type=float), request.values.get("acceptance", type=float), request.values.get("events", type=int))
+
+    def run(job: Job) -> str:
+        set_job_user(job)
+        job.report(0.0, "Calculating kinematics")
+        return generate_plot(beamEnergy, spsAngle, magneticField, rhoMin, rhoMax, plotType, exMin, exMax, resolution, job.report)
+    return submit_job(JOB_PLOT, run)
+
+#Takes the scan form arguments (beam_energy_min, beam_energy_max, beam_energy_steps, and the same for sps_angle and
+#b_field). The result gives the scan token, with the download and slice urls of the scan
+@bp.route("/jobs/scan", methods=["POST"])
+@login_required
+def submit_scan_job() -> Tuple[Response, int]:
+    beamEnergies = np.linspace(get_float_arg("beam_energy_min"), get_float_arg("beam_energy_max"), get_int_arg("beam_energy_steps", 1, 100))
+    angles = np.linspace(get_float_arg("sps_angle_min"), get_float_arg("sps_angle_max"), get_int_arg("sps_angle_steps", 1, 100))
+    fields = np.linspace(get_float_arg("b_field_min"), get_float_arg("b_field_max"), get_int_arg("b_field_steps", 1, 1000))
+    if np.any(fields <= 0.0):
+        abort(400, "The B-field must be greater than zero")
+    reactions = get_user_reactions()
+    scanReactions = get_scan_reactions(reactions)
+    nPoints = count_scan_points(scanReactions, beamEnergies, angles, fields)
+    if nPoints > current_app.config.get("SCAN_MAX_POINTS", 10_000_000):
+        abort(400, f"Scan is too large ({nPoints} level points); reduce the number of steps")
+    token = get_scan_token(reactions, beamEnergies, angles, fields)
+
+    def run(job: Job) -> str:
+        set_job_user(job)
+        job.report(0.0, "Scanning beam energies")
+        get_scan_result(token, scanReactions, beamEnergies, angles, fields, lambda fraction: job.report(fraction, "Scanning beam energies"))
+        return token
+    return submit_job(JOB_SCAN, run)
+
+@bp.route("/jobs")
+@login_required
+def list_jobs() -> Response:
+    return jsonify({"jobs": [job_to_json(job) for job in get_scheduler().get_user_jobs(g.user.id)]})
+
+@bp.route("/jobs/<id>")
+@login_required
+def job_status(id: str) -> Response:
+    return jsonify(job_to_json(get_job(id)))
+
+@bp.route("/jobs/<id>/cancel", methods=["POST"])
+@login_required
+def cancel_job(id: str) -> Response:
+    get_scheduler().cancel(get_job(id).id)
+    return jsonify(job_to_json(get_job(id)))
+
+@bp.route("/jobs/<id>/result")
+@login_required
+def job_result(id: str) -> Response:
+    job = get_job(id)
+    if job.status != JOB_DONE:
+        abort(409, f"Job is {job.status}, not done")
+    if job.kind == JOB_PLOT:
+        return Response(base64.b64decode(job.result), mimetype="image/svg+xml")
+    return jsonify({
+        "token": job.result,
+        "download_url": url_for("spsplot.download_scan", token=job.result),
+        "slice_url": url_for("spsplot.scan_slice", token=job.result)
+    })
+
+#Each window selects a reaction and an excitation range; a window without a maximum is a single level
+#Rho is monotonic in excitation, so the window edges bound every level inside the window
+def get_focus_levels(form: OptimizeForm, reactions: List[ReactionData], beamEnergy: float) -> Tuple[List[FocusLevels], List[str]]:
+    rxnMap = {rxn.id: rxn for rxn in reactions}
+    excitations: Dict[int, List[float]] = {}
+    for window in form.windows:
+        if not window.rxn_id.data or window.ex_min.data is None:
+            continue
+        exs = excitations.setdefault(window.rxn_id.data, [])
+        exs.append(float(window.ex_min.data))
+        if window.ex_max.data is not None:
+            exs.append(float(window.ex_max.data))
+    targets = []
+    labels = []
+    for id, exs in excitations.items():
+        rxn = rxnMap[id]
+        targets.append(FocusLevels(build_reaction(rxn, beamEnergy, 0.0, 1.0), np.array(sorted(exs))))
+        labels.append(rxn.rxn_symbol)
+    return targets, labels
+
+@bp.route("/optimize", methods=("GET", "POST"))
+@login_required
+def optimize() -> str:
+    form = OptimizeForm()
+    reactions = get_user_reactions()
+    for window in form.windows:
+        window.rxn_id.choices = [(0, "None")] + [(rxn.id, rxn.rxn_symbol) for rxn in reactions]
+    solution: Optional[FieldSolution] = None
+    labels: List[str] = []
+    targets: List[FocusLevels] = []
+    if form.validate_on_submit():
+        beamEnergy = float(form.beam_energy.data)
+        rhoMin = float(form.rho_min.data)
+        rhoMax = float(form.rho_max.data)
+        targets, labels = get_focus_levels(form, reactions, beamEnergy)
+        if rhoMin >= rhoMax:
+            flash("Rho Min must be less than Rho Max", 'error')
+        elif len(targets) == 0:
+            flash("Select at least one reaction and excitation window", 'error')
+        elif form.optimize_angle.data and (form.angle_min.data is None or form.angle_max.data is None or form.angle_min.data >= form.angle_max.data):
+            flash("Angle optimization requires Angle Min < Angle Max", 'error')
+        else:
+            if form.optimize_angle.data:
+                solution = optimize_field_and_angle(targets, float(form.angle_min.data), float(form.angle_max.data), rhoMin, rhoMax)
+            else:
+                solution = optimize_field(targets, float(form.sps_angle.data), rhoMin, rhoMax)
+            if solution is None:
+                flash("None of the selected levels are kinematically allowed", 'error')
+    return render_template("spsplot/optimize.html", form=form, solution=solution, labels=labels, targets=targets)
 
 @bp.route("/target/add", methods=("GET", "POST"))
 @login_required
@@ -98,32 +835,30 @@ def add_target_material() -> Union[str, Response]:
     form = TargetForm()
     if form.validate_on_submit():
         layer_data: List[List[Tuple[int, int]]] = [[], [], []] #list of all layers
-        thicknesses: List[float] = [] #thickness of all layers
-        symbols: List[str] = [] #layer symbols
+        thicknesses: List[float] = [0.0, 0.0, 0.0] #thickness of all layers
+        symbols: List[str] = ["", "", ""] #layer symbols
         error = None
 
         for i, layer in enumerate(form.layers):
             if layer.thickness.data is not None:
-                thicknesses.append(float(layer.thickness.data))
-                symbol = ""
+                thicknesses[i] = float(layer.thickness.data)
                 for element in layer.elements:
                     if element.z.data is not None and element.a.data is not None and element.s.data is not None:
-                        print(element.z.data, element.a.data)
                         nuc_id = get_nucleus_id(element.z.data, element.a.data)
-                        print(nuc_id)
-                        nuc: Nucleus = db.session.get(Nucleus, nuc_id)
-                        symbol += f"{nuc.isotope}<sub>{element.s.data}</sub>"
-                        layer_data[i].append((nuc_id, element.s.data))
-                if symbol != "":
-                    symbols.append(symbol)
-
-        if len(thicknesses) == 0:
+                        nuc: Optional[Nucleus] = db.session.get(Nucleus, nuc_id)
+                        if nuc is None:
+                            error = f"Illegal nucleus Z={element.z.data} A={element.a.data}"
+                        else:
+                            symbols[i] += f"{nuc.isotope}<sub>{element.s.data}</sub>"
+                            layer_data[i].append((nuc_id, element.s.data))
+
+        if all(len(layer) == 0 for layer in layer_data):
             error = "A target must have at least one layer"
 
         if error is not None:
             flash(error, 'error')
         else:
-            db.session.add(TargetMaterial(user_id=g.user.id, mat_name=form.mat_name.data, mat_symbol=json.dumps(symbols), compounds=json.dumps(layer_data), thicknesses=json.dumps(thicknesses)))
+            db.session.add(TargetMaterial(user_id=g.user.id, mat_name=form.mat_name.data, layers=make_target_layers(symbols, layer_data, thicknesses)))
             db.session.commit()
             return redirect(url_for("spsplot.index"))
     
@@ -148,26 +883,23 @@ def update_target_material(id: int) -> Union[str, Response]:
     #Load up existing target data and put it in the form
     if request.method == "GET":
         form.mat_name.data = mat.mat_name
-        load_thick = json.loads(mat.thicknesses)
-        load_layers = json.loads(mat.compounds)
-        for i, t in enumerate(load_thick):
-            form.layers.entries[i].thickness.data = Decimal(t)
-            for j, comp in enumerate(load_layers[i]):
-                nuc: Nucleus = db.session.get(Nucleus, comp[0])
-                form.layers.entries[i].elements[j].z.data = nuc.z
-                form.layers.entries[i].elements[j].a.data = nuc.a
-                form.layers.entries[i].elements[j].s.data = comp[1]
+        for layer in mat.layers:
+            form.layers.entries[layer.position].thickness.data = Decimal(layer.thickness)
+            for j, comp in enumerate(layer.components):
+                nuc: Nucleus = db.session.get(Nucleus, comp.nucleus_id)
+                form.layers.entries[layer.position].elements[j].z.data = nuc.z
+                form.layers.entries[layer.position].elements[j].a.data = nuc.a
+                form.layers.entries[layer.position].elements[j].s.data = comp.stoichiometry
 
     if form.validate_on_submit():
         layer_data: List[List[Tuple[int, int]]] = [[], [], []] #list of all layers
-        thicknesses: List[float] = [] #thickness of all layers
-        symbols: List[str] = [] #layer symbols
+        thicknesses: List[float] = [0.0, 0.0, 0.0] #thickness of all layers
+        symbols: List[str] = ["", "", ""] #layer symbols
         error = None
 
         for i, layer in enumerate(form.layers):
             if layer.thickness.data is not None:
-                thicknesses.append(float(layer.thickness.data))
-                symbol = ""
+                thicknesses[i] = float(layer.thickness.data)
                 for element in layer.elements:
                     if element.z.data is not None and element.a.data is not None and element.s.data is not None:
                         nuc_id = get_nucleus_id(element.z.data, element.a.data)
@@ -175,22 +907,20 @@ def update_target_material(id: int) -> Union[str, Response]:
                         if nuc is None:
                             error = f"Illegal nucleus Z={element.z.data} A={element.a.data}"
                         else:
-                            symbol += f"{nuc.isotope}<sub>{element.s.data}</sub>"
+                            symbols[i] += f"{nuc.isotope}<sub>{element.s.data}</sub>"
                             layer_data[i].append((nuc_id, element.s.data))
-                if symbol != "":
-                    symbols.append(symbol)
 
-        if len(thicknesses) == 0:
+        if all(len(layer) == 0 for layer in layer_data):
             error = "A target must have at least one layer"
 
         if error is not None:
             flash(error, 'error')
         else:
             mat.mat_name = form.mat_name.data
-            mat.mat_symbol = json.dumps(symbols)
-            mat.compounds = json.dumps(layer_data)
-            mat.thicknesses = json.dumps(thicknesses)
+            mat.layers = make_target_layers(symbols, layer_data, thicknesses)
             db.session.commit()
+            invalidate_target(mat.id)
+            invalidate_reaction_points(targetID=mat.id)
             return redirect(url_for("spsplot.index"))
     
     return render_template("spsplot/update_target.html", mat=mat, form=form)
@@ -201,14 +931,20 @@ def delete_target_material(id: int) -> Response:
     mat = get_target_material(id)
     db.session.delete(mat)
     db.session.commit()
+    invalidate_target(id)
+    invalidate_reaction_points(targetID=id)
     return redirect(url_for("spsplot.index"))
 
+#Make sure the shared NNDC levels of a reaction are available, or queue their fetch if they are not
+def set_reaction_nndc_levels(rxn: ReactionData) -> None:
+    if not request_level_scheme(rxn.residual_nuc_id):
+        flash("NNDC levels are being fetched for this reaction; they will be included in plots once they arrive", "info")
+
 @bp.route("/rxn/add", methods=("GET", "POST"))
 @login_required
 def add_rxn() -> Union[str, Response]:
     form = ReactionForm()
-    user: User = db.session.get(User, g.user.id)
-    form.target_mat.choices = [(mat.id, Markup(mat.mat_name)) for mat in user.target_materials]
+    form.target_mat.choices = [(id, Markup(name)) for id, name in queries.get_target_material_choices(g.user.id)]
 
     if form.validate_on_submit():
         error = None
@@ -238,16 +974,17 @@ def add_rxn() -> Union[str, Response]:
                                "($^{" + str(proj.a) + "}$" + proj.element + \
                                ",$^{" + str(eject.a) + "}$" + eject.element + \
                                ")$^{" + str(resid.a) + "}$" + resid.element
-                excitations = json.dumps(get_excitations(resid_id))
-                db.session.add(ReactionData(user_id=g.user.id, target_mat_id=form.target_mat.data, rxn_symbol=rxn_symbol, latex_rxn_symbol=latex_symbol,
-                                            target_nuc_id=targ_id, projectile_nuc_id=proj_id, ejectile_nuc_id=eject_id, residual_nuc_id=resid_id, nndc_levels=excitations))
+                rxn = ReactionData(user_id=g.user.id, target_mat_id=form.target_mat.data, rxn_symbol=rxn_symbol, latex_rxn_symbol=latex_symbol,
+                                   target_nuc_id=targ_id, projectile_nuc_id=proj_id, ejectile_nuc_id=eject_id, residual_nuc_id=resid_id)
+                db.session.add(rxn)
                 db.session.commit()
+                set_reaction_nndc_levels(rxn)
                 return redirect(url_for("spsplot.index"))
     return render_template("spsplot/add_rxn.html", form=form)
 
-def get_rxn(id: int, check_user: bool = True) -> ReactionData:
+def get_rxn(id: int, check_user: bool = True, with_nuclei: bool = False) -> ReactionData:
 
-    rxn: Optional[ReactionData] = db.session.get(ReactionData, id)
+    rxn: Optional[ReactionData] = queries.get_reaction_with_nuclei(id) if with_nuclei else db.session.get(ReactionData, id)
 
     if rxn is None:
         abort(404, f"Requested reaction {id} does not exist")
@@ -258,10 +995,9 @@ def get_rxn(id: int, check_user: bool = True) -> ReactionData:
 @bp.route("/rxn/<int:id>/update", methods=("GET", "POST"))
 @login_required
 def update_rxn(id: int) -> Union[str, Response]:
-    rxn = get_rxn(id)
+    rxn = get_rxn(id, with_nuclei=True)
     form = ReactionForm()
-    user: User = db.session.get(User, g.user.id)
-    form.target_mat.choices = [(mat.id, mat.mat_name) for mat in user.target_materials]
+    form.target_mat.choices = queries.get_target_material_choices(g.user.id)
 
     if request.method == "GET":
         form.target_mat.data = rxn.target_mat_id
@@ -305,8 +1041,9 @@ def update_rxn(id: int) -> Union[str, Response]:
                 rxn.projectile_nuc_id = proj_id
                 rxn.ejectile_nuc_id = eject_id
                 rxn.residual_nuc_id = resid_id
-                rxn.nndc_levels = json.dumps(get_excitations(resid_id))
                 db.session.commit()
+                invalidate_reaction_points(rxnID=rxn.id)
+                set_reaction_nndc_levels(rxn)
                 return redirect(url_for("spsplot.index"))
     return render_template("spsplot/update_rxn.html", rxn=rxn, form=form)
 
@@ -316,14 +1053,14 @@ def delete_rxn(id: int) -> Response:
     rxn = get_rxn(id)
     db.session.delete(rxn)
     db.session.commit()
+    invalidate_reaction_points(rxnID=id)
     return redirect(url_for("spsplot.index"))
 
 @bp.route("/level/add", methods=["GET", "POST"])
 @login_required
 def add_level() -> Union[str, Response]:
     form = LevelForm()
-    user: User = db.session.get(User, g.user.id)
-    form.rxn_id.choices = [(rxn.id, Markup(rxn.rxn_symbol))  for rxn in user.reactions]
+    form.rxn_id.choices = [(id, Markup(symbol)) for id, symbol in queries.get_reaction_choices(g.user.id)]
 
     if form.validate_on_submit():
         error = None
@@ -335,7 +1072,7 @@ def add_level() -> Union[str, Response]:
         if error is not None:
             flash(error, 'error')
         else:
-            db.session.add(Level(user_id=user.id, reaction_id=form.rxn_id.data, excitation=ex))
+            db.session.add(Level(user_id=g.user.id, reaction_id=form.rxn_id.data, excitation=ex))
             db.session.commit()
             return redirect(url_for("spsplot.index"))
     return render_template("spsplot/add_level.html", form=form)
@@ -354,8 +1091,7 @@ def get_level(id: int, check_user=True) -> Level:
 def update_level(id: int) -> Union[str, Response]:
     level = get_level(id)
     form = LevelForm()
-    user: User = db.session.get(User, g.user.id)
-    form.rxn_id.choices = [(rxn.id, Markup(rxn.rxn_symbol))  for rxn in user.reactions]
+    form.rxn_id.choices = [(id, Markup(symbol)) for id, symbol in queries.get_reaction_choices(g.user.id)]
 
     if request.method == "GET":
         form.rxn_id.data = level.reaction_id
@@ -0,0 +1,235 @@
+// Client side SPSPlot: draws the computed plot data from spsplot.plot_data in the browser.
+// The data is only requested again when the beam energy, angle, field, excitation window or peak width settings
+// change; changing the rho window or the annotation type just redraws the existing data.
+(function () {
+    const SVG_NS = "http://www.w3.org/2000/svg";
+    const WIDTH = 1600;
+    const HEIGHT = 900;
+    const MARGIN = { left: 260, right: 40, top: 30, bottom: 80 };
+    const GARNET = "#782f40";
+    const SLATE = "#2c2a29";
+
+    let dataUrl = null;
+    let plotData = null;
+    let plotKey = null;
+
+    function formValue(id) {
+        return document.getElementById(id).value;
+    }
+
+    function annotationType() {
+        const checked = document.querySelector("input[name='buttons']:checked");
+        return checked ? checked.value : "E";
+    }
+
+    function makeElement(tag, attributes, text) {
+        const element = document.createElementNS(SVG_NS, tag);
+        for (const [name, value] of Object.entries(attributes)) {
+            element.setAttribute(name, value);
+        }
+        if (text !== undefined) {
+            element.textContent = text;
+        }
+        return element;
+    }
+
+    // Reaction symbols are stored as html, i.e. <sup>12</sup>C(<sup>2</sup>H,<sup>1</sup>H)<sup>13</sup>C
+    function appendSymbol(textElement, symbol) {
+        for (const part of symbol.split(/(<sup>.*?<\/sup>)/)) {
+            if (part.length === 0) {
+                continue;
+            }
+            const sup = part.match(/^<sup>(.*)<\/sup>$/);
+            if (sup) {
+                textElement.appendChild(makeElement("tspan", { "baseline-shift": "super", "font-size": "70%" }, sup[1]));
+            } else {
+                textElement.appendChild(makeElement("tspan", {}, part));
+            }
+        }
+    }
+
+    function tickStep(range) {
+        const rough = range / 8.0;
+        const power = Math.pow(10, Math.floor(Math.log10(rough)));
+        for (const factor of [1, 2, 5]) {
+            if (rough <= factor * power) {
+                return factor * power;
+            }
+        }
+        return 10 * power;
+    }
+
+    function showMessage(message) {
+        const area = document.getElementById("client_plot_area");
+        area.replaceChildren();
+        const p = document.createElement("p");
+        p.className = "text-gold text-2xl p-2";
+        p.textContent = message;
+        area.appendChild(p);
+    }
+
+    function draw() {
+        if (plotData === null) {
+            return;
+        }
+        const rhoMin = parseFloat(formValue("rho_min"));
+        const rhoMax = parseFloat(formValue("rho_max"));
+        if (!(rhoMax > rhoMin)) {
+            showMessage("Rho max must be larger than rho min");
+            return;
+        }
+
+        const nRows = plotData.reactions.length + 1;
+        const xScale = (rho) => MARGIN.left + (rho - rhoMin) / (rhoMax - rhoMin) * (WIDTH - MARGIN.left - MARGIN.right);
+        const yScale = (row) => HEIGHT - MARGIN.bottom - (row - 0.5) / nRows * (HEIGHT - MARGIN.top - MARGIN.bottom);
+        const valueKey = { "E": "excitations", "K": "energies", "Z": "offsets" }[annotationType()];
+
+        const svg = makeElement("svg", { viewBox: `0 0 ${WIDTH} ${HEIGHT}`, width: "100%", "font-family": "sans-serif" });
+        svg.appendChild(makeElement("rect", { x: 0, y: 0, width: WIDTH, height: HEIGHT, fill: "white" }));
+        svg.appendChild(makeElement("rect", {
+            x: MARGIN.left, y: MARGIN.top, width: WIDTH - MARGIN.left - MARGIN.right, height: HEIGHT - MARGIN.top - MARGIN.bottom,
+            fill: "none", stroke: SLATE
+        }));
+
+        const step = tickStep(rhoMax - rhoMin);
+        for (let tick = Math.ceil(rhoMin / step) * step; tick <= rhoMax + 1.0e-9; tick += step) {
+            const x = xScale(tick);
+            svg.appendChild(makeElement("line", { x1: x, x2: x, y1: HEIGHT - MARGIN.bottom, y2: HEIGHT - MARGIN.bottom + 8, stroke: SLATE }));
+            svg.appendChild(makeElement("text", { x: x, y: HEIGHT - MARGIN.bottom + 28, "text-anchor": "middle", "font-size": 18, fill: SLATE }, tick.toFixed(2).replace(/\.?0+$/, "")));
+        }
+        svg.appendChild(makeElement("text", { x: (WIDTH + MARGIN.left - MARGIN.right) / 2, y: HEIGHT - 20, "text-anchor": "middle", "font-size": 22, fill: SLATE }, "ρ (cm)"));
+
+        plotData.reactions.forEach((reaction, index) => {
+            const y = yScale(index + 1);
+            const label = makeElement("text", { x: MARGIN.left - 10, y: y + 6, "text-anchor": "end", "font-size": 20, fill: SLATE });
+            appendSymbol(label, reaction.symbol);
+            svg.appendChild(label);
+            reaction.rhos.forEach((rho, i) => {
+                if (rho < rhoMin || rho > rhoMax) {
+                    return;
+                }
+                const x = xScale(rho);
+                if (reaction.widths !== undefined && reaction.widths[i] !== null) {
+                    const halfWidth = 0.5 * reaction.widths[i];
+                    const x1 = xScale(Math.max(rho - halfWidth, rhoMin));
+                    const x2 = xScale(Math.min(rho + halfWidth, rhoMax));
+                    svg.appendChild(makeElement("line", { x1: x1, x2: x2, y1: y, y2: y, stroke: GARNET, "stroke-width": 2 }));
+                    for (const xEnd of [x1, x2]) {
+                        svg.appendChild(makeElement("line", { x1: xEnd, x2: xEnd, y1: y - 6, y2: y + 6, stroke: GARNET, "stroke-width": 2 }));
+                    }
+                }
+                svg.appendChild(makeElement("circle", { cx: x, cy: y, r: 5, fill: GARNET }));
+                svg.appendChild(makeElement("text", {
+                    x: x + 5, y: y - 12, transform: `rotate(-90 ${x + 5} ${y - 12})`, "font-size": 14, fill: SLATE
+                }, reaction[valueKey][i].toFixed(2)));
+            });
+        });
+        svg.appendChild(makeElement("text", { x: MARGIN.left - 10, y: yScale(nRows) + 6, "text-anchor": "end", "font-size": 20, fill: SLATE }, "Reactions"));
+
+        const area = document.getElementById("client_plot_area");
+        area.replaceChildren(svg);
+    }
+
+    function plotParams() {
+        const params = new URLSearchParams({
+            beam_energy: formValue("beam_energy"),
+            sps_angle: formValue("sps_angle"),
+            b_field: formValue("b_field")
+        });
+        for (const id of ["ex_min", "ex_max"]) {
+            if (formValue(id) !== "") {
+                params.set(id, formValue(id));
+            }
+        }
+        if (document.getElementById("show_widths").checked) {
+            params.set("widths", "1");
+            for (const id of ["beam_spread", "acceptance"]) {
+                if (formValue(id) !== "") {
+                    params.set(id, formValue(id));
+                }
+            }
+        }
+        return params;
+    }
+
+    async function fetchAndDraw() {
+        const key = plotParams().toString();
+        if (key !== plotKey) {
+            const response = await fetch(`${dataUrl}?${key}`);
+            if (!response.ok) {
+                showMessage("Unable to calculate the plot; check the beam energy, angle and field");
+                return;
+            }
+            plotData = await response.json();
+            plotKey = key;
+        }
+        draw();
+    }
+
+    // Server side plot as a background job: submit it, poll its progress, then show the SVG result
+    const JOB_POLL_INTERVAL = 1000; // ms
+    let jobUrl = null;
+    let jobCancelUrl = null;
+
+    async function pollJob(job) {
+        while (job.status === "queued" || job.status === "running") {
+            showMessage(`Plot ${job.status}: ${Math.round(100 * job.progress)}% ${job.message}`);
+            await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL));
+            const response = await fetch(job.status_url);
+            if (!response.ok) {
+                showMessage("Lost track of the plot job; it may have expired");
+                return;
+            }
+            job = await response.json();
+        }
+        if (job.status !== "done") {
+            showMessage(job.error ? `Plot ${job.status}: ${job.error}` : `Plot ${job.status}`);
+            return;
+        }
+        const image = document.createElement("img");
+        image.className = "object-scale-down rounded-md";
+        image.src = job.result_url;
+        document.getElementById("client_plot_area").replaceChildren(image);
+    }
+
+    async function submitJob() {
+        if (jobCancelUrl !== null) {
+            await fetch(jobCancelUrl, { method: "POST" });
+        }
+        const params = plotParams();
+        params.set("rho_min", formValue("rho_min"));
+        params.set("rho_max", formValue("rho_max"));
+        params.set("plot_type", annotationType());
+        const response = await fetch(jobUrl, { method: "POST", body: params });
+        if (!response.ok) {
+            showMessage(response.status === 429 ? "Too many plots are waiting; try again when they are done" : "Unable to submit the plot; check the plot settings");
+            return;
+        }
+        const job = await response.json();
+        jobCancelUrl = job.cancel_url;
+        await pollJob(job);
+        if (jobCancelUrl === job.cancel_url) {
+            jobCancelUrl = null;
+        }
+    }
+
+    document.addEventListener("DOMContentLoaded", () => {
+        const jobButton = document.getElementById("job_plot");
+        if (jobButton !== null) {
+            jobUrl = jobButton.dataset.url;
+            jobButton.addEventListener("click", submitJob);
+        }
+        const button = document.getElementById("client_plot");
+        if (button === null) {
+            return;
+        }
+        dataUrl = button.dataset.url;
+        button.addEventListener("click", fetchAndDraw);
+        for (const id of ["rho_min", "rho_max"]) {
+            document.getElementById(id).addEventListener("input", draw);
+        }
+        for (const radio of document.querySelectorAll("input[name='buttons']")) {
+            radio.addEventListener("change", draw);
+        }
+    });
+})();
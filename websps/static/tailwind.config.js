@@ -1,6 +1,6 @@
 /** @type {import('tailwindcss').Config} */
 module.exports = {
-  content: ["./src/**/*.{html, js}", "./../templates/**/*.html"],
+  content: ["./src/**/*.{html, js}", "./js/**/*.js", "./../templates/**/*.html"],
   theme: {
     colors: {
       transparent: 'transparent',
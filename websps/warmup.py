@@ -0,0 +1,55 @@
+import time
+from flask import Flask
+from io import BytesIO
+from sqlalchemy.exc import OperationalError
+from typing import Dict
+
+from .db import db, get_mass_table
+
+#Optional warm-up (WARMUP = True): import the lazily loaded dependencies, initialize catima and matplotlib (font cache
+#and svg backend) and load the mass table while the app is created. Servers which create the app before forking their
+#workers (i.e. gunicorn --preload) then share all of it copy-on-write, and servers which start each process on its own
+#(mod_wsgi daemon processes with WSGIImportScript) do it at process start instead of in the first plot request
+
+def warm_up_catima() -> None:
+    import pycatima as catima
+    catima.dedx(catima.Projectile(1, 1, T=10.0), catima.Material([[12, 6, 1]]))
+
+def warm_up_matplotlib() -> None:
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(4,3))
+    axes = fig.subplots()
+    axes.plot([0.0, 1.0], [0.0, 1.0], marker="o", linestyle="None")
+    axes.annotate("1.00", (0.5, 0.5), rotation="vertical")
+    axes.set_xlabel(r"$\rho$ (cm)")
+    fig.savefig(BytesIO(), format="svg")
+
+def warm_up_nndc() -> None:
+    import requests
+    import lxml.html
+
+#The mass table needs an initialized database; before init-db it is simply left to be loaded on first use
+#The connection pool is reset afterwards: a preforking server would otherwise hand the pooled SQLite connection (and its
+#WAL shared memory mapping) to every worker, and SQLite connections must not be carried across a fork
+def warm_up_mass_table(app: Flask) -> None:
+    with app.app_context():
+        try:
+            get_mass_table()
+        except OperationalError:
+            app.logger.warning("Warm-up could not load the mass table; has the database been initialized?")
+        finally:
+            db.engine.dispose()
+
+#Run every warm-up step, returning the time taken by each (seconds)
+def warm_up(app: Flask) -> Dict[str, float]:
+    timings = {}
+    for name, step in (("catima", warm_up_catima), ("matplotlib", warm_up_matplotlib), ("nndc", warm_up_nndc), ("mass_table", lambda: warm_up_mass_table(app))):
+        start = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - start
+    app.logger.info("Warm-up done: " + ", ".join(f"{name} {duration*1000.0:.0f} ms" for name, duration in timings.items()))
+    return timings
+
+def init_app(app: Flask) -> None:
+    if app.config.get("WARMUP", False):
+        warm_up(app)
@@ -0,0 +1,41 @@
+from flask import current_app
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from typing import Optional
+import multiprocessing
+import os
+
+from .db import MassTable, get_mass_table, set_mass_table
+
+#Shared process pool for heavy kinematics work (setting scans, large plots)
+#Work sent to the pool must be plain picklable data (RxnParameters, TargetLayers, ndarrays), never ORM objects.
+#Each worker process receives a copy of the mass table when it starts, so workers never touch the database
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = Lock()
+
+def init_worker(table: MassTable) -> None:
+    set_mass_table(table)
+
+def get_pool_size() -> int:
+    size = current_app.config.get("PROCESS_POOL_SIZE")
+    return (os.cpu_count() or 1) if size is None else size
+
+#Get the process pool, or None if it is disabled (PROCESS_POOL_SIZE = 0)
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    size = get_pool_size()
+    if size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context(current_app.config.get("PROCESS_POOL_START_METHOD", "spawn"))
+            _pool = ProcessPoolExecutor(max_workers=size, mp_context=context, initializer=init_worker, initargs=(get_mass_table(),))
+        return _pool
+
+def shutdown_process_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None